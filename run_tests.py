@@ -44,6 +44,32 @@ if __name__ == "__main__":
                         choices=[
                             "TestMatchingAlgorithmRunTime",
                             "TestMatchingAlgorithm",
+                            "TestBatchedInference",
+                            "TestModelRegistry",
+                            "TestFeatureVectorizers",
+                            "TestFeatureStore",
+                            "TestInterestIndex",
+                            "TestInterestIndexRegistry",
+                            "TestTopKSelector",
+                            "TestOrientationFilter",
+                            "TestCandidateTable",
+                            "TestMatchSessions",
+                            "TestMatchExecutor",
+                            "TestPrecomputedMatches",
+                            "TestHeightInches",
+                            "TestOrientationCompatibility",
+                            "TestScoringKernel",
+                            "TestBatchMatching",
+                            "TestConcurrentMatching",
+                            "TestNumpyModel",
+                            "TestQuantizedModel",
+                            "TestScalerStats",
+                            "TestPairScoreCache",
+                            "TestPhotoHydration",
+                            "TestMatchCandidates",
+                            "TestStreamingMatch",
+                            "TestConnectionPool",
+                            "TestAsyncDatabase",
                             "TestHeap",
                             "TestRating",
                             "TestBasicRoute",
@@ -51,7 +77,9 @@ if __name__ == "__main__":
                             "TestLoginOps",
                             "TestProtectedRouteOps",
                             "TestAppOps",
-                            "TestChatRequestOps"
+                            "TestChatRequestOps",
+                            "TestRateLimitedRoutes",
+                            "TestConnectionRelease"
                         ])
     
     parser.add_argument('--f', '--function', 
@@ -1,8 +1,160 @@
-import keras
+import numpy as np
+import threading
+import os
+
+from models.ml_numpy_model import NumpyModel
+
+# Absolute path of the matching model so that it can be loaded regardless of
+# the directory the server (or the test suite) is run from. It can be overridden
+# with the MATCHING_MODEL_PATH environment variable.
+MODEL_PATH = os.environ.get(
+    "MATCHING_MODEL_PATH",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "models", "matching_model.h5")
+)
+
+# Weights of the matching model exported for the NumPy backend (see
+# models/ml_numpy_model.py). It can be overridden with the
+# MATCHING_NUMPY_MODEL_PATH environment variable.
+NUMPY_MODEL_PATH = os.environ.get(
+    "MATCHING_NUMPY_MODEL_PATH",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "models", "matching_model.npz")
+)
+
+# Reduced-precision copies of the exported weights.
+QUANTIZED_MODEL_PATHS = {
+    precision: os.environ.get(
+        f"MATCHING_{precision.upper()}_MODEL_PATH",
+        os.path.join(os.path.dirname(os.path.abspath(__file__)), "models", f"matching_model.{precision}.npz")
+    )
+    for precision in ["float16", "int8"]
+}
+
+# Backends that can serve the matching model: "keras" runs the original model
+# with Keras, while "numpy" runs its exported weights with NumPy, without
+# loading TensorFlow, and "numpy_float16" and "numpy_int8" do the same with
+# their reduced-precision copies. It can be selected with the
+# MATCHING_MODEL_BACKEND environment variable.
+MODEL_BACKENDS = {
+    "keras": MODEL_PATH,
+    "numpy": NUMPY_MODEL_PATH,
+    "numpy_float16": QUANTIZED_MODEL_PATHS["float16"],
+    "numpy_int8": QUANTIZED_MODEL_PATHS["int8"]
+}
+
+MODEL_BACKEND = os.environ.get("MATCHING_MODEL_BACKEND", "keras")
 
 class ColabFilteringModel:
-    def __init__(self):
-        self.model: keras.Model = keras.models.load_model('./models/matching_model.h5', compile=True)
+    def __init__(self, path: str = MODEL_PATH):
+        # Keras (and TensorFlow) are only imported when the Keras backend is used.
+        import keras
+
+        self.model: "keras.Model" = keras.models.load_model(path, compile=True)
+
+# Loads the matching model stored at the given path with the given backend.
+def load_matching_model(path: str, backend: str):
+    if backend == "keras":
+        return ColabFilteringModel(path).model
+
+    if backend.startswith("numpy"):
+        return NumpyModel(path)
+
+    raise ValueError(f"Unknown matching model backend: {backend}.")
+
+# Process-wide registry holding the warm matching model so that it is read
+# from disk and compiled once, instead of on every call to /match.
+#
+# Requests only ever hold a reference to the model returned by get(), so
+# swapping in a new .h5 (or .npz) file replaces the model for subsequent
+# requests while the ones already in flight finish with the previous model.
+class ModelRegistry:
+    def __init__(self, path: str | None = None, backend: str = MODEL_BACKEND):
+        if backend not in MODEL_BACKENDS:
+            raise ValueError(f"Unknown matching model backend: {backend}.")
+
+        self.backend: str = backend
+        self.path: str = path or MODEL_BACKENDS[backend]
+        self._model = None
+        self._loaded_mtime: float | None = None
+        self._lock = threading.Lock()
+
+    # Loads the model from the given path and runs a warm-up prediction
+    # through it so that the first request does not pay for building
+    # the graph.
+    def _load_and_warm_up(self, path: str) -> tuple[any, float]:
+        mtime = os.path.getmtime(path)
+        model = load_matching_model(path, self.backend)
+
+        num_features = model.input_shape[-1]
+        model.predict_on_batch(np.zeros((1, num_features), dtype=np.float32))
+
+        return model, mtime
+
+    # Loads the model if it has not been loaded yet. Called once when the
+    # server starts up.
+    def load(self):
+        return self.get()
+
+    def get(self):
+        model = self._model
+
+        if model is None:
+            with self._lock:
+                # Another thread may have loaded the model while this one
+                # was waiting for the lock.
+                if self._model is None:
+                    self._model, self._loaded_mtime = self._load_and_warm_up(self.path)
+
+                model = self._model
+
+        return model
+
+    # Hot-swaps the served model with the one stored at the given path without
+    # restarting the process. The new model is loaded and warmed up before it
+    # replaces the current one, so requests never see a cold model.
+    def swap(self, path: str):
+        model, mtime = self._load_and_warm_up(path)
+
+        with self._lock:
+            self.path = path
+            self._model = model
+            self._loaded_mtime = mtime
+
+        return model
+
+    # Swaps the model if the file at the current path was replaced since it
+    # was last loaded. Returns True if the model was swapped.
+    def reload_if_changed(self) -> bool:
+        try:
+            mtime = os.path.getmtime(self.path)
+        except OSError:
+            return False
+
+        if self._loaded_mtime is not None and mtime != self._loaded_mtime:
+            self.swap(self.path)
+            return True
+
+        return False
+
+    def is_loaded(self) -> bool:
+        return self._model is not None
+
+# Registry shared by every request in the current process, serving the model
+# with the backend selected by MATCHING_MODEL_BACKEND.
+model_registry = ModelRegistry()
+
+_model_registries: dict[str, ModelRegistry] = {MODEL_BACKEND: model_registry}
+_model_registries_lock = threading.Lock()
+
+# Returns the registry of the given backend (or of the selected one, if none is
+# given), e.g. to serve a single request with another backend.
+def get_model_registry(backend: str | None = None) -> ModelRegistry:
+    backend = backend or MODEL_BACKEND
+
+    with _model_registries_lock:
+        if backend not in _model_registries:
+            _model_registries[backend] = ModelRegistry(backend=backend)
+
+        return _model_registries[backend]
 
 class MockProfiles:
     def __init__(self):
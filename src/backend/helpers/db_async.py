@@ -0,0 +1,74 @@
+# Non-blocking database access for the async handlers.
+#
+# psycopg2 is a blocking driver, so a query run straight from an async handler
+# blocks the event loop (and every other request served by the same worker)
+# until it returns. Instead, the handlers are given an AsyncConnection (see
+# create_connection in server.py), whose statements run in a bounded pool of
+# threads and are awaited, so that the event loop keeps serving other requests
+# while they run.
+#
+# psycopg2 cursors are client-side, so the rows of a query are already fetched
+# once its statement was awaited, and reading them (with fetchall, fetchone, or
+# by iterating over the cursor) doesn't block.
+
+from concurrent.futures import ThreadPoolExecutor
+import psycopg2
+import functools
+import asyncio
+import os
+
+from helpers.db_pool import DB_POOL_MAX_SIZE
+
+# Number of threads running the statements. Each one runs a single statement at
+# a time, so there is no use in having more of them than pooled connections.
+DB_EXECUTOR_THREADS = int(os.environ.get("DB_EXECUTOR_THREADS", DB_POOL_MAX_SIZE))
+
+db_executor = ThreadPoolExecutor(max_workers=DB_EXECUTOR_THREADS, thread_name_prefix="db")
+
+# Runs fn(*args) in the database threads and waits for its result without
+# blocking the event loop.
+async def run_blocking(fn, *args):
+    return await asyncio.get_running_loop().run_in_executor(db_executor, functools.partial(fn, *args))
+
+# Cursor whose statements are awaited. Everything else (fetching the rows, the
+# description of the columns, etc.) is the same as with the psycopg2 cursor.
+class AsyncCursor:
+    def __init__(self, cursor: psycopg2.extensions.cursor):
+        self.raw = cursor
+
+    async def execute(self, statement: str, params: list | tuple | None = None) -> None:
+        await run_blocking(self.raw.execute, statement, params)
+
+    async def executemany(self, statement: str, params_seq: list) -> None:
+        await run_blocking(self.raw.executemany, statement, params_seq)
+
+    # Runs a function that takes the psycopg2 cursor as its first argument (e.g.
+    # the functions of the matching algorithm or of the rating system), along
+    # with the given arguments, in the database threads.
+    async def run(self, fn, *args):
+        return await run_blocking(fn, self.raw, *args)
+
+    def __iter__(self):
+        return iter(self.raw)
+
+    def __getattr__(self, name: str):
+        return getattr(self.raw, name)
+
+# Connection whose cursors are AsyncCursors, and whose commits and rollbacks are
+# awaited. Everything else (e.g. its DatabaseError attribute) is the same as with
+# the psycopg2 connection.
+class AsyncConnection:
+    def __init__(self, db: psycopg2.extensions.connection):
+        self.raw = db
+
+    def cursor(self) -> AsyncCursor:
+        return AsyncCursor(self.raw.cursor())
+
+    async def commit(self) -> None:
+        await run_blocking(self.raw.commit)
+
+    async def rollback(self) -> None:
+        await run_blocking(self.raw.rollback)
+
+    def __getattr__(self, name: str):
+        return getattr(self.raw, name)
@@ -0,0 +1,277 @@
+# Shared pool of database connections.
+#
+# Every request used to open its own connection to the database (and
+# check_token another one for every protected route), paying for the TCP, TLS,
+# and authentication handshakes each time. Instead, connections are drawn from
+# this pool (see create_connection in server.py) and handed back to it once the
+# request is done, so that they are reused by the next requests.
+#
+# Connections that were idle for a while are checked with a trivial query
+# before they are handed out, and connections are replaced once they reach
+# their maximum lifetime, so that connections dropped by the database (or by
+# anything in between) are never handed out.
+
+from collections import deque
+import psycopg2
+import psycopg2.extensions
+import threading
+import time
+import os
+
+# Number of connections opened when the pool is opened.
+DB_POOL_MIN_SIZE = int(os.environ.get("DB_POOL_MIN_SIZE", 2))
+
+# Maximum number of connections open at once. Requests wait for a connection to
+# be handed back once they are all in use.
+DB_POOL_MAX_SIZE = int(os.environ.get("DB_POOL_MAX_SIZE", 20))
+
+# Seconds after which a connection is closed and replaced by a new one.
+DB_POOL_MAX_LIFETIME = float(os.environ.get("DB_POOL_MAX_LIFETIME", 1800))
+
+# Seconds a connection can stay idle before it is checked again before being
+# handed out.
+DB_POOL_HEALTH_CHECK_INTERVAL = float(os.environ.get("DB_POOL_HEALTH_CHECK_INTERVAL", 30))
+
+# Seconds a request waits for a connection before giving up.
+DB_POOL_ACQUIRE_TIMEOUT = float(os.environ.get("DB_POOL_ACQUIRE_TIMEOUT", 10))
+
+class PoolTimeoutError(Exception):
+    pass
+
+class ConnectionPool:
+    def __init__(self,
+                 dsn: str | None = None,
+                 min_size: int = DB_POOL_MIN_SIZE,
+                 max_size: int = DB_POOL_MAX_SIZE,
+                 max_lifetime: float = DB_POOL_MAX_LIFETIME,
+                 health_check_interval: float = DB_POOL_HEALTH_CHECK_INTERVAL,
+                 acquire_timeout: float = DB_POOL_ACQUIRE_TIMEOUT,
+                 connect=psycopg2.connect):
+        if max_size < 1 or min_size > max_size:
+            raise ValueError("The pool must hold at least one connection and at most max_size.")
+
+        self.dsn = dsn
+        self.min_size = min_size
+        self.max_size = max_size
+        self.max_lifetime = max_lifetime
+        self.health_check_interval = health_check_interval
+        self.acquire_timeout = acquire_timeout
+        self._connect = connect
+
+        # Idle connections along with the time they were opened and last
+        # handed back, from the least to the most recently used.
+        self._idle: deque[tuple[psycopg2.extensions.connection, float, float]] = deque()
+
+        # Connections that were handed out, keyed by their id, along with the
+        # time they were opened.
+        self._in_use: dict[int, tuple[psycopg2.extensions.connection, float]] = {}
+
+        # Number of open connections, including the ones being opened.
+        self._size = 0
+        self._closed = False
+        self._condition = threading.Condition()
+
+        # Metrics of the pool.
+        self._opened = 0
+        self._discarded = 0
+        self._failed_health_checks = 0
+        self._acquired = 0
+        self._timeouts = 0
+        self._total_wait_time = 0.
+        self._max_wait_time = 0.
+
+    # The connection string is read when the first connection is opened, as the
+    # environment variables are only loaded once the server starts.
+    def _open_connection(self) -> tuple[psycopg2.extensions.connection, float]:
+        db = self._connect(self.dsn or os.environ.get("DB_KEY"))
+
+        with self._condition:
+            self._opened += 1
+
+        return db, time.monotonic()
+
+    # Opens the first min_size connections ahead of the first requests.
+    def open(self) -> None:
+        with self._condition:
+            num_connections = max(0, self.min_size - self._size)
+            self._size += num_connections
+            self._closed = False
+
+        for i in range(num_connections):
+            try:
+                db, opened_at = self._open_connection()
+
+            except Exception:
+                with self._condition:
+                    self._size -= num_connections - i
+                    self._condition.notify_all()
+
+                raise
+
+            with self._condition:
+                self._idle.append((db, opened_at, time.monotonic()))
+                self._condition.notify()
+
+    # Hands out an idle connection, or opens a new one if fewer than max_size are
+    # open. Otherwise, waits up to timeout seconds (acquire_timeout, if None) for
+    # one to be handed back, and raises a PoolTimeoutError if none was.
+    def acquire(self, timeout: float | None = None) -> psycopg2.extensions.connection:
+        timeout = self.acquire_timeout if timeout is None else timeout
+        start = time.monotonic()
+
+        while True:
+            db, opened_at, last_used = self._checkout(start + timeout)
+
+            if db is None:
+                try:
+                    db, opened_at = self._open_connection()
+
+                except Exception:
+                    self._forget()
+                    raise
+
+            elif not self._is_usable(db, opened_at, last_used):
+                self._discard(db)
+                continue
+
+            wait_time = time.monotonic() - start
+
+            with self._condition:
+                self._in_use[id(db)] = (db, opened_at)
+                self._acquired += 1
+                self._total_wait_time += wait_time
+                self._max_wait_time = max(self._max_wait_time, wait_time)
+
+            return db
+
+    # Takes the most recently used idle connection (which is the least likely to
+    # have been dropped), or reserves room for a new one, in which case the
+    # connection is None.
+    def _checkout(self, deadline: float) -> tuple[psycopg2.extensions.connection | None, float, float]:
+        with self._condition:
+            while True:
+                if self._closed:
+                    raise PoolTimeoutError("The connection pool is closed.")
+
+                if self._idle:
+                    return self._idle.pop()
+
+                if self._size < self.max_size:
+                    self._size += 1
+                    return None, 0., 0.
+
+                remaining = deadline - time.monotonic()
+
+                if remaining <= 0:
+                    self._timeouts += 1
+                    raise PoolTimeoutError("Timed out waiting for a database connection. Try again later.")
+
+                self._condition.wait(remaining)
+
+    def _is_usable(self, db: psycopg2.extensions.connection, opened_at: float, last_used: float) -> bool:
+        if db.closed or time.monotonic() - opened_at >= self.max_lifetime:
+            return False
+
+        if time.monotonic() - last_used < self.health_check_interval:
+            return True
+
+        try:
+            cursor = db.cursor()
+            cursor.execute("SELECT 1")
+            cursor.close()
+            db.rollback()
+            return True
+
+        except psycopg2.Error:
+            with self._condition:
+                self._failed_health_checks += 1
+
+            return False
+
+    # Closes a connection and makes room for a new one.
+    def _discard(self, db: psycopg2.extensions.connection) -> None:
+        try:
+            db.close()
+
+        except psycopg2.Error:
+            pass
+
+        with self._condition:
+            self._discarded += 1
+
+        self._forget()
+
+    def _forget(self) -> None:
+        with self._condition:
+            self._size -= 1
+            self._condition.notify()
+
+    # Hands a connection back to the pool. Whatever the request left uncommitted
+    # is rolled back, the same way as closing the connection would have. Broken
+    # connections, and those that reached their maximum lifetime, are closed
+    # instead. Connections that didn't come from the pool are simply closed.
+    def release(self, db: psycopg2.extensions.connection) -> None:
+        with self._condition:
+            entry = self._in_use.pop(id(db), None)
+
+        if entry is None:
+            if not db.closed:
+                db.close()
+
+            return
+
+        _, opened_at = entry
+        usable = not db.closed and not self._closed and time.monotonic() - opened_at < self.max_lifetime
+
+        if usable:
+            try:
+                status = db.get_transaction_status()
+
+                if status == psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN:
+                    usable = False
+                elif status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    db.rollback()
+
+            except psycopg2.Error:
+                usable = False
+
+        if not usable:
+            self._discard(db)
+            return
+
+        with self._condition:
+            self._idle.append((db, opened_at, time.monotonic()))
+            self._condition.notify()
+
+    # Closes every idle connection. Connections that are still in use are closed
+    # once they are handed back.
+    def close(self) -> None:
+        with self._condition:
+            self._closed = True
+            idle, self._idle = list(self._idle), deque()
+            self._condition.notify_all()
+
+        for db, _, _ in idle:
+            self._discard(db)
+
+    # Returns the number of open, idle, and in use connections along with the
+    # counters of the pool.
+    def metrics(self) -> dict[str, any]:
+        with self._condition:
+            return {
+                "min_size": self.min_size,
+                "max_size": self.max_size,
+                "connections": self._size,
+                "idle": len(self._idle),
+                "in_use": len(self._in_use),
+                "opened": self._opened,
+                "discarded": self._discarded,
+                "failed_health_checks": self._failed_health_checks,
+                "acquired": self._acquired,
+                "timeouts": self._timeouts,
+                "avg_acquire_seconds": round(self._total_wait_time / self._acquired, 6) if self._acquired else 0.,
+                "max_acquire_seconds": round(self._max_wait_time, 6)
+            }
+
+# Pool shared by every request in the server process.
+db_pool = ConnectionPool()
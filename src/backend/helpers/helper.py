@@ -1,7 +1,7 @@
 from passlib.context import CryptContext
 from fastapi import HTTPException, Request
 from faker import Faker
-import psycopg2 as p
+from helpers.db_async import AsyncConnection, AsyncCursor
 import datetime as dt
 import jwt
 import random
@@ -53,7 +53,7 @@ async def verify_age(age: int, state_residence: str) -> bool:
 # they are banned from using the web application.
 #
 # Otherwise, they can proceed to use the web application.
-async def determine_account_registration_age(cursor: p.extensions.cursor, 
+async def determine_account_registration_age(cursor: AsyncCursor, 
                                              username: str, 
                                              new_birth_month: str, 
                                              new_birth_date: str, 
@@ -61,7 +61,7 @@ async def determine_account_registration_age(cursor: p.extensions.cursor,
               
     statement = "SELECT account_creation_timestamp, birth_month, birth_date, birth_year, state FROM Users WHERE username=%s"
     params = [username]
-    cursor.execute(statement, params)
+    await cursor.execute(statement, params)
     
     month_index = {
         "January": 1,
@@ -111,12 +111,12 @@ async def determine_account_registration_age(cursor: p.extensions.cursor,
         return False
     
 # Function that verifies the user's credentials.
-async def user_verified(username: str, password: str, cursor: p.extensions.cursor) -> bool:
+async def user_verified(username: str, password: str, cursor: AsyncCursor) -> bool:
     # Retrieve the username and password of the current user from the database
     # to verify the credentials they entered in the login page.
     statement = "SELECT U.username, U.password FROM Users U WHERE U.username=%s"
     params = [username]
-    cursor.execute(statement, params)
+    await cursor.execute(statement, params)
     
     # Append the column names into the "keys" list.
     keys = [attr.name for attr in cursor.description]
@@ -152,43 +152,41 @@ async def user_verified(username: str, password: str, cursor: p.extensions.curso
         else:
             return False
         
-async def session_count(username: str, cursor: p.extensions.cursor) -> int:
+async def session_count(username: str, cursor: AsyncCursor) -> int:
     statement = "SELECT * FROM view_session_count(%s)"
     params = [username]
-    cursor.execute(statement, params)
+    await cursor.execute(statement, params)
 
     session_count: int = cursor.fetchall()[0][0]
 
     return session_count
 
-async def insert_session(username: str, token: str, db: p.extensions.connection, cursor: p.extensions.cursor) -> bool:
+async def insert_session(username: str, token: str, db: AsyncConnection, cursor: AsyncCursor) -> bool:
     statement = "CALL insert_session(%s, %s)"
     params = [username, token]
-    cursor.execute(statement, params)
+    await cursor.execute(statement, params)
 
     s_count: int = await session_count(username, cursor)
 
     if s_count < 3:
-        db.commit()
+        await db.commit()
         return True
  
     return False
     
-async def delete_session(username: str, token: str, db: p.extensions.connection, cursor: p.extensions.cursor) -> None:
+async def delete_session(username: str, token: str, db: AsyncConnection, cursor: AsyncCursor) -> None:
     statement = "CALL delete_session(%s, %s)"
     params = [username, token]
-    cursor.execute(statement, params)
-    db.commit()
+    await cursor.execute(statement, params)
+    await db.commit()
 
-async def verify_session(username: str, token: str, db_key: str, sk_key: str, request: Request) -> bool:
-    # Connect to the database.
-    db = p.connect(db_key)
+async def verify_session(username: str, token: str, db: AsyncConnection, sk_key: str, request: Request) -> bool:
     cursor = db.cursor()
 
     # Retrieved the stored token from the database.
     statement = "SELECT * FROM retrieve_session(%s, %s)"
     params = [username, token]
-    cursor.execute(statement, params)
+    await cursor.execute(statement, params)
 
     # Store the retrieved token in the list.
     retrieved_token: list = [token for token in cursor]
@@ -217,12 +215,12 @@ async def verify_session(username: str, token: str, db_key: str, sk_key: str, re
         return False
         
 # Function that retrieves user's profile picture.
-async def retrieve_profile_pic(username: str, db: p.extensions.connection) -> str:
+async def retrieve_profile_pic(username: str, db: AsyncConnection) -> str:
     cursor = db.cursor()
     
     statement = "SELECT uri FROM Photos WHERE username=%s"
     params = [username]
-    cursor.execute(statement, params)
+    await cursor.execute(statement, params)
     
     photo = [record[0] for record in cursor.fetchall()]
     
@@ -238,17 +236,22 @@ async def retrieve_profile_pic(username: str, db: p.extensions.connection) -> st
 # regardless of whether they have visited it or not.
 async def log_visit(username: str, 
                     visiting_user_username: str, 
-                    db: p.extensions.connection, 
-                    cursor: p.extensions.cursor) -> None:  
+                    db: AsyncConnection, 
+                    cursor: AsyncCursor) -> None:  
     
     # Create a log to keep track of the times that a user has
     # visited a specific profile.
     statement = "CALL create_visitor_log(%s, %s, %s)"
     params = [username, visiting_user_username, "now()"]
-    cursor.execute(statement, params)
-    db.commit()
+    await cursor.execute(statement, params)
+    await db.commit()
 
 # Function that calculates the age of the user.
+# Converts a height in feet and inches into the number of inches stored in
+# the height_inches column of the Profiles table.
+def height_to_inches(feet: int, inches: int) -> int:
+    return (int(feet) * 12) + int(inches)
+
 def retrieve_age(month: str, date: int, year: int) -> int:
     month_index: dict = {
         "January": 1,
@@ -277,12 +280,12 @@ def retrieve_age(month: str, date: int, year: int) -> int:
     return age
 
 # Function that checks whether a user is banned or not.
-async def retrieve_banned_user(db: p.extensions.connection, username: str) -> dict[any, any]:
-    cursor: p.extensions.cursor = db.cursor()
+async def retrieve_banned_user(db: AsyncConnection, username: str) -> dict[any, any]:
+    cursor: AsyncCursor = db.cursor()
         
     statement = "SELECT username FROM Banned WHERE username=%s"
     params = [username]
-    cursor.execute(statement, params)
+    await cursor.execute(statement, params)
     
     keys = [attr.name for attr in cursor.description]
     values = [value for value in cursor.fetchall()]
@@ -0,0 +1,205 @@
+# Dedicated executor for the matching algorithm.
+#
+# The matching algorithm is CPU-heavy and synchronous, so running it directly
+# inside an async handler blocks the event loop (and every other request and
+# Socket.IO event handled by the same worker) until it finishes. Instead, it is
+# run in a pool of worker processes that each load the matching model once when
+# they start, and each keep their own pool of connections to the database.
+#
+# The number of matches waiting for (or running in) a worker is bounded, so
+# that a burst of /match requests is rejected early instead of piling up.
+
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing
+import asyncio
+import threading
+import time
+import os
+
+from helpers.db_pool import ConnectionPool, db_pool
+
+# Number of worker processes running the matching algorithm. If set to 0, the
+# matching algorithm runs in a pool of threads of the server process instead.
+MATCH_WORKERS = int(os.environ.get("MATCH_WORKERS", min(4, os.cpu_count() or 1)))
+
+# Number of threads running the matching algorithm when MATCH_WORKERS is 0. Each
+# run keeps its state in its own MatchContext (see ml_match_algo.py), so several
+# of them can run at the same time.
+MATCH_THREADS = int(os.environ.get("MATCH_THREADS", min(4, os.cpu_count() or 1)))
+
+# Maximum number of matches that can be waiting for or running in a worker at once.
+MATCH_QUEUE_SIZE = int(os.environ.get("MATCH_QUEUE_SIZE", 64))
+
+class MatchQueueFullError(Exception):
+    pass
+
+# Pool of database connections of the current worker process, opened by
+# preload_matching_model. Each worker runs one match at a time, so it only needs
+# a single connection, which is reused by every match it runs.
+worker_db_pool: ConnectionPool | None = None
+
+# Runs once in each worker process when it starts, so that the model, the
+# vectorizers, and the scaling statistics are loaded before the first match
+# instead of during it.
+def preload_matching_model() -> None:
+    from class_models import model_registry
+    from models.ml_feature_fitting import vectorizer_registry
+    from models.ml_scaler_stats import scaler_stats_registry
+
+    global worker_db_pool
+    worker_db_pool = ConnectionPool(min_size=0, max_size=1)
+
+    model_registry.load()
+    vectorizer_registry.get()
+    scaler_stats_registry.get()
+
+# Runs the matching algorithm with a connection drawn from the pool of the
+# worker process (as connections can't be shared across processes), or from the
+# shared pool of the server process if the match runs in one of its threads.
+def run_match_in_worker(username: str, use_so_filter: bool, top_k: int | None) -> list[dict[str, any]]:
+    from class_models import model_registry
+    from models.ml_feature_fitting import vectorizer_registry
+    from models.ml_scaler_stats import scaler_stats_registry
+    from main import run_matching_algorithm
+
+    # Pick up the model (or vectorizers, or scaling statistics) if they were
+    # replaced on disk, as the server process only hot-swaps its own copy of them.
+    model_registry.reload_if_changed()
+    vectorizer_registry.reload_if_changed()
+    scaler_stats_registry.reload_if_changed()
+
+    pool = worker_db_pool if worker_db_pool is not None else db_pool
+    db = pool.acquire()
+    released = False
+
+    # The matching algorithm hands the connection back as soon as it loaded its
+    # inputs. It is handed back here instead if the algorithm failed before.
+    def release(db) -> None:
+        nonlocal released
+
+        if not released:
+            released = True
+            pool.release(db)
+
+    try:
+        return run_matching_algorithm(username=username, db=db, cursor=db.cursor(), use_so_filter=use_so_filter,
+                                      top_k=top_k, release=release)
+
+    finally:
+        release(db)
+
+class MatchExecutor:
+    def __init__(self,
+                 workers: int = MATCH_WORKERS,
+                 queue_size: int = MATCH_QUEUE_SIZE,
+                 initializer=preload_matching_model,
+                 threads: int = MATCH_THREADS):
+        self.workers = workers
+        self.threads = threads
+        self.queue_size = queue_size
+        self.initializer = initializer
+        self._executor: Executor | None = None
+        self._lock = threading.Lock()
+
+        # Metrics of the executor.
+        self._in_flight = 0
+        self._max_in_flight = 0
+        self._completed = 0
+        self._failed = 0
+        self._rejected = 0
+        self._restarts = 0
+        self._total_wait_time = 0.
+
+    def start(self) -> None:
+        with self._lock:
+            if self._executor is None:
+                self._executor = self._create_executor()
+
+    def _create_executor(self) -> Executor:
+        if self.workers > 0:
+            # Worker processes are spawned rather than forked, as TensorFlow
+            # can't be used safely in a forked process.
+            return ProcessPoolExecutor(max_workers=self.workers,
+                                       mp_context=multiprocessing.get_context("spawn"),
+                                       initializer=self.initializer)
+
+        return ThreadPoolExecutor(max_workers=self.threads, thread_name_prefix="match")
+
+    def shutdown(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    # Runs fn(*args) in the executor and waits for its result without blocking
+    # the event loop. Raises a MatchQueueFullError if too many matches are
+    # already waiting for or running in a worker.
+    async def submit(self, fn, *args):
+        self.start()
+
+        with self._lock:
+            if self._in_flight >= self.queue_size:
+                self._rejected += 1
+                raise MatchQueueFullError("Too many matches are being calculated. Try again later.")
+
+            self._in_flight += 1
+            self._max_in_flight = max(self._max_in_flight, self._in_flight)
+
+        start = time.monotonic()
+        executor = self._executor
+
+        try:
+            result = await asyncio.get_running_loop().run_in_executor(executor, fn, *args)
+
+            with self._lock:
+                self._completed += 1
+
+            return result
+
+        except BrokenProcessPool:
+            # One of the workers died (e.g. it ran out of memory), which leaves
+            # the pool unusable. Replace it, unless a concurrent match that
+            # failed along with this one already did, so that the next matches
+            # don't fail as well.
+            with self._lock:
+                self._failed += 1
+
+                if self._executor is executor:
+                    executor.shutdown(wait=False, cancel_futures=True)
+                    self._executor = self._create_executor()
+                    self._restarts += 1
+
+            raise
+
+        except Exception:
+            with self._lock:
+                self._failed += 1
+
+            raise
+
+        finally:
+            with self._lock:
+                self._in_flight -= 1
+                self._total_wait_time += time.monotonic() - start
+
+    # Returns the current depth of the queue along with the counters of the executor.
+    def metrics(self) -> dict[str, any]:
+        with self._lock:
+            finished = self._completed + self._failed
+            concurrency = self.workers if self.workers > 0 else self.threads
+
+            return {
+                "workers": self.workers,
+                "queue_size": self.queue_size,
+                "in_flight": self._in_flight,
+                "queue_depth": max(0, self._in_flight - concurrency),
+                "max_in_flight": self._max_in_flight,
+                "completed": self._completed,
+                "failed": self._failed,
+                "rejected": self._rejected,
+                "restarts": self._restarts,
+                "avg_latency_seconds": round(self._total_wait_time / finished, 4) if finished else 0.
+            }
+
+# Executor shared by every request in the server process.
+match_executor = MatchExecutor()
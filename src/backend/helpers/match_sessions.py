@@ -0,0 +1,170 @@
+# Server-side match sessions used to paginate the results of /match.
+#
+# The first request for matches runs the matching algorithm once and stores
+# the whole ranked list in a session. Each page returned to the client comes
+# with an opaque cursor pointing to the next one, so that requesting more
+# matches is a lookup into the stored list instead of a new run of the
+# matching algorithm.
+#
+# Sessions are kept in the memory of the server process, so the API has to be
+# served by a single process (see startup in server.py). Cursors resolved by a
+# restarted process are rejected as expired, and the client starts over.
+
+from collections import OrderedDict
+import base64
+import json
+import os
+import secrets
+import threading
+import time
+
+from models.ml_ranking import RECOMMENDATION_LIMIT
+
+# Number of seconds a session (and the cursors pointing into it) stays valid.
+MATCH_SESSION_TTL = int(os.environ.get("MATCH_SESSION_TTL", 600))
+
+# Maximum number of sessions kept in memory. The least recently used ones are
+# evicted first.
+MATCH_SESSION_MAX_SESSIONS = int(os.environ.get("MATCH_SESSION_MAX_SESSIONS", 10000))
+
+# Maximum number of ranked matches stored in a session.
+MATCH_SESSION_MAX_RESULTS = int(os.environ.get("MATCH_SESSION_MAX_RESULTS", 1000))
+
+# Maximum number of matches returned in a page, whatever limit the client asks
+# for. Defaults to the number of matches /match returned before it was paginated.
+MATCH_PAGE_LIMIT = int(os.environ.get("MATCH_PAGE_LIMIT", RECOMMENDATION_LIMIT))
+
+class MatchSession:
+    def __init__(self, username: str, use_so_filter: bool, matches: list[dict[str, any]], ttl: int):
+        self.id: str = secrets.token_urlsafe(16)
+        self.username = username
+        self.use_so_filter = use_so_filter
+        self.matches = matches
+        self.expires_at: float = time.monotonic() + ttl
+
+    def is_expired(self) -> bool:
+        return time.monotonic() >= self.expires_at
+
+    # Returns the matches in [offset, offset + limit), whether there are any
+    # left after them, and the cursor of the next page (or None if there are
+    # no more pages). The limit is capped at MATCH_PAGE_LIMIT.
+    def page(self, offset: int, limit: int) -> tuple[list[dict[str, any]], bool, str | None]:
+        limit = min(int(limit), MATCH_PAGE_LIMIT)
+        matches = self.matches[offset:offset + limit]
+        next_offset = offset + len(matches)
+        has_more = next_offset < len(self.matches)
+
+        return matches, has_more, encode_cursor(self.id, next_offset) if has_more else None
+
+# Cursors are the id of the session and the offset of the page, encoded as
+# URL-safe base64 so that the client treats them as opaque strings.
+def encode_cursor(session_id: str, offset: int) -> str:
+    payload = json.dumps({"s": session_id, "o": offset}, separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(payload).decode("ascii")
+
+class InvalidCursorError(Exception):
+    pass
+
+def decode_cursor(cursor: str) -> tuple[str, int]:
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+        session_id, offset = payload["s"], int(payload["o"])
+
+    except (ValueError, KeyError, TypeError, UnicodeError) as e:
+        raise InvalidCursorError("The cursor is invalid.") from e
+
+    if not isinstance(session_id, str) or offset < 0:
+        raise InvalidCursorError("The cursor is invalid.")
+
+    return session_id, offset
+
+class MatchSessionStore:
+    def __init__(self, ttl: int = MATCH_SESSION_TTL, max_sessions: int = MATCH_SESSION_MAX_SESSIONS):
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self._sessions: OrderedDict[str, MatchSession] = OrderedDict()
+
+        # Id of the latest session of each user for each setting of the sexual
+        # orientation filter.
+        self._latest: dict[tuple[str, bool], str] = {}
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    def create(self, username: str, use_so_filter: bool, matches: list[dict[str, any]]) -> MatchSession:
+        session = MatchSession(username, use_so_filter, matches, self.ttl)
+
+        with self._lock:
+            previous_id = self._latest.get((username, use_so_filter))
+
+            if previous_id is not None:
+                self._sessions.pop(previous_id, None)
+
+            self._sessions[session.id] = session
+            self._latest[(username, use_so_filter)] = session.id
+            self._evict()
+
+        return session
+
+    # Returns the user's latest session for the given setting of the sexual
+    # orientation filter, if it has not expired.
+    def latest(self, username: str, use_so_filter: bool) -> MatchSession | None:
+        with self._lock:
+            session_id = self._latest.get((username, use_so_filter))
+            return self._get(session_id) if session_id is not None else None
+
+    # Returns the session a cursor points into along with the offset of the
+    # page, or raises an InvalidCursorError if the session does not exist
+    # anymore or belongs to another user.
+    def resolve(self, username: str, cursor: str) -> tuple[MatchSession, int]:
+        session_id, offset = decode_cursor(cursor)
+
+        with self._lock:
+            session = self._get(session_id)
+
+        if session is None or session.username != username:
+            raise InvalidCursorError("The match session has expired.")
+
+        return session, offset
+
+    # Removes every session of the user, e.g. after they updated their profile.
+    def invalidate(self, username: str) -> None:
+        with self._lock:
+            for use_so_filter in [True, False]:
+                session_id = self._latest.pop((username, use_so_filter), None)
+
+                if session_id is not None:
+                    self._sessions.pop(session_id, None)
+
+    def _get(self, session_id: str) -> MatchSession | None:
+        session = self._sessions.get(session_id)
+
+        if session is None:
+            return None
+
+        if session.is_expired():
+            self._remove(session)
+            return None
+
+        self._sessions.move_to_end(session_id)
+        return session
+
+    def _remove(self, session: MatchSession) -> None:
+        self._sessions.pop(session.id, None)
+
+        if self._latest.get((session.username, session.use_so_filter)) == session.id:
+            del self._latest[(session.username, session.use_so_filter)]
+
+    # Drops the expired sessions at the front of the store (the least recently
+    # used ones), as well as the least recently used sessions over the limit.
+    def _evict(self) -> None:
+        while self._sessions and next(iter(self._sessions.values())).is_expired():
+            self._remove(next(iter(self._sessions.values())))
+
+        while len(self._sessions) > self.max_sessions:
+            _, session = next(iter(self._sessions.items()))
+            self._remove(session)
+
+# Sessions shared by every request in the current process.
+match_sessions = MatchSessionStore()
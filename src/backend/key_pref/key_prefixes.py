@@ -1,14 +1,14 @@
 from fastapi import Request
-import asyncio
+
+# Reads the JSON body of the request ahead of the rate limiter, as its key
+# functions are called synchronously from within the event loop on async routes
+# (see visit_key_func). Used as a dependency of the rate limited routes.
+async def read_json_body(request: Request):
+    request.state.json_body = await request.json()
 
 def visit_key_func(request: Request):
-    data: dict = asyncio.run(request.json())
+    data: dict = request.state.json_body
     username = request.cookies.get("username")
     visiting_user = data.get("visiting_user")
-    
-    return (username, visiting_user)
 
-def matches_key(*args, **kwargs):
-    request: Request = kwargs["kwargs"]["r"]
-    username, session_id = request.cookies.get("username"), request.cookies.get("user_session")
-    return f"{username}-matches-page-{session_id}"
\ No newline at end of file
+    return (username, visiting_user)
@@ -1,4 +1,6 @@
-from models.ml_match_algo import run_algorithm
+from models.ml_match_algo import run_algorithm, close_connection
+from models.ml_streaming_match import run_streaming_algorithm, MATCH_STREAMING
+from models.ml_ranking import RECOMMENDATION_LIMIT
 from models.ml_match_algo_mock import run_mock_algorithm
 import time
 import psycopg2 as p
@@ -7,9 +9,17 @@ import os
 def run_matching_algorithm(username: str,
                            db: p.extensions.connection,
                            cursor: p.extensions.cursor,  
-                           use_so_filter: bool):
+                           use_so_filter: bool,
+                           top_k: int | None = RECOMMENDATION_LIMIT,
+                           release=close_connection):
+
+    # Very large candidate pools can be streamed from the database instead of
+    # being loaded all at once (see ml_streaming_match.py).
+    if MATCH_STREAMING:
+        matched_users = run_streaming_algorithm(username, cursor, db, use_so_filter, top_k, release=release)
+    else:
+        matched_users = run_algorithm(username, cursor, db, use_so_filter, top_k, release)
 
-    matched_users = run_algorithm(username, cursor, db, use_so_filter)
     return matched_users
 
 
@@ -1,8 +1,124 @@
 import unittest
+import os
+import shutil
+import tempfile
+import copy
+import itertools
+import asyncio
+import threading
+import time
+import datetime as dt
+import types
+from unittest.mock import patch
+import numpy as np
+import keras
+import psycopg2
+import pandas as pd
+import scipy.sparse as sp
+from sklearn.preprocessing import normalize
 from main import return_run_time
 from rating_sys import rating_sys
-from class_models import MockProfiles
-from models.ml_match_algo_mock import run_mock_algorithm
+from class_models import MockProfiles, ModelRegistry, MODEL_BACKENDS
+from models.ml_match_algo_mock import run_mock_algorithm, load_mock_data, process_mock_data, filter_matches
+from models.ml_inference import predict_in_chunks
+from models.ml_feature_fitting import (FeatureSpace,
+                                       fit_feature_vectorizers,
+                                       save_feature_vectorizers,
+                                       load_feature_vectorizers,
+                                       TEXT_FEATURES)
+from models.ml_sim_calcs import (interests_dot_prod,
+                                 sexual_orientation_similarity,
+                                 residence_dot_prod,
+                                 relationship_status_dot_prod,
+                                 height_dot_prod,
+                                 threshold_orientation_similarity,
+                                 initialize_vectorizer,
+                                 initialize_min_max_scaler,
+                                 update_user_numbers,
+                                 round_scores,
+                                 round_decimals)
+from models.ml_scoring import ScoringKernel
+from models.ml_score_cache import PairScoreCache
+from models.ml_scaler_stats import ScalerStats, ScalerStatsRegistry, save_scaler_stats, scaler_stats_registry
+from models import ml_batch_matching, ml_streaming_match
+from models.ml_numpy_model import NumpyModel, export_model_weights, quantize_model_weights, compare_rankings, synthetic_features
+from models.ml_batch_matching import rank_users
+from models.ml_precomputed_matches import load_precomputed_matches, PRECOMPUTED_MATCH_MAX_AGE
+from models.ml_streaming_match import run_streaming_algorithm, StreamingTopK
+from sklearn.metrics.pairwise import cosine_similarity
+from models.ml_ann_index import InterestIndex, InterestIndexRegistry
+from models.ml_ranking import TopKSelector
+from models.ml_orientation import encode_orientations, orientation_mask
+from models.ml_candidates import fetch_columns, load_candidate_table, load_profile_table, CandidateTable, ProfileTable, height_inches, hydrate_photos, load_match_candidates, PROFILE_METADATA_COLUMNS, MATCH_CANDIDATE_COLUMNS
+from models.ml_match_algo import (process_data,
+                                  load_data,
+                                  SENSITIVE_COLUMNS,
+                                  rank_candidates,
+                                  build_features,
+                                  score_candidates,
+                                  MatchContext,
+                                  filter_matches as filter_candidates)
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from helpers.match_sessions import MatchSessionStore, InvalidCursorError, MATCH_PAGE_LIMIT
+from helpers.match_executor import MatchExecutor, MatchQueueFullError, run_match_in_worker
+from helpers.db_pool import ConnectionPool, PoolTimeoutError
+from helpers.db_async import AsyncConnection, AsyncCursor
+from helpers.helper import height_to_inches
+from models.ml_feature_store import (encode_feature_row,
+                                     decode_feature_row,
+                                     stack_feature_rows,
+                                     parse_height_inches)
+
+MODEL_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "models", "matching_model.h5")
+
+# ===================================== REFERENCE IMPLEMENTATIONS ===================================== #
+# Straightforward versions of the scores calculated by the scoring kernel (see
+# models/ml_scoring.py), which its results are checked against.
+
+# Height similarity of each candidate, from the heights (in inches) of the
+# candidates and the current user.
+def height_similarity(users_heights: np.ndarray, current_user_height: float) -> np.ndarray:
+    return (100 - np.abs(np.asarray(users_heights, dtype=np.float64) - current_user_height)) / 100
+
+# Calculates the scores of every attribute from the precomputed feature rows of
+# the candidates and the current user (see ml_feature_store.py) instead of from
+# their raw text, as the columns of a matrix in the same order as the attributes
+# are stored in the user dictionary.
+def feature_row_dot_prods(users_matrix: sp.csr_matrix,
+                          users_heights: np.ndarray,
+                          segment_matrix: sp.csr_matrix,
+                          current_user_height: float,
+                          user_dict: dict | None = None) -> np.ndarray:
+    dot_prods = (users_matrix @ segment_matrix).toarray()
+    scores = {
+        "interests": dot_prods[:, [0]],
+        "height": height_similarity(users_heights, current_user_height).reshape(-1, 1),
+        "sexual_orientation": threshold_orientation_similarity(dot_prods[:, [1]]),
+        "residence": dot_prods[:, [2]],
+        "relationship_status": dot_prods[:, [3]]
+    }
+
+    if user_dict is not None:
+        for attr, attr_scores in scores.items():
+            update_user_numbers(attr_scores, user_dict, attr)
+
+    return np.column_stack([round_scores(attr_scores) for attr_scores in scores.values()])
+
+# Same as calculate_similarity_score, but from a matrix of attribute scores (one
+# column per attribute, excluding the visits) and the visits of each candidate.
+def similarity_scores(attr_scores: np.ndarray,
+                      visits: np.ndarray,
+                      scaling: tuple[np.ndarray, np.ndarray] | None = None) -> np.ndarray:
+    if scaling is None:
+        scaled_scores = initialize_min_max_scaler().fit_transform(attr_scores)
+    else:
+        scaled_scores = attr_scores * scaling[0] + scaling[1]
+
+    sum_all_attr_scores = np.round((scaled_scores.sum(axis=1) + visits) / (attr_scores.shape[1] + 1), 3)
+
+    return round_scores(sum_all_attr_scores)
+# ===================================================================================================== #
 
 class TestMatchingAlgorithmRunTime(unittest.TestCase):
     # Test algorithm and check if run time is less than or equal to 5 seconds.
@@ -137,6 +253,1608 @@ class TestMatchingAlgorithm(unittest.TestCase):
         self.doCleanups()
         self.doClassCleanups()   
         
+class TestBatchedInference(unittest.TestCase):
+    def setUp(self):
+        profiles = MockProfiles()
+        df, current_df, _ = load_mock_data(profiles.mock_user_profiles, profiles.mock_current_user_profile)
+        preprocessed_data, _ = process_mock_data(df, current_df, {})
+
+        self.features = preprocessed_data.drop(columns=['similarity_score']).to_numpy(dtype=np.float32)
+        self.model: keras.Model = keras.models.load_model(MODEL_PATH)
+
+    # Scores produced by sending the whole candidate matrix through the model
+    # in chunks should be the same as the ones produced one row at a time.
+    def test_chunked_scores_match_per_row_scores(self):
+        per_row_scores = np.array([
+            self.model.predict(np.array([row]), batch_size=20, verbose=0)[0][0]
+            for row in self.features
+        ])
+
+        for chunk_size in [1, 3, 1024]:
+            chunked_scores = predict_in_chunks(self.model, self.features, chunk_size)
+
+            self.assertEqual(chunked_scores.shape, (len(self.features),))
+            np.testing.assert_allclose(chunked_scores, per_row_scores, rtol=1e-5, atol=1e-6)
+            self.assertEqual([round(s * 100, 2) for s in chunked_scores],
+                             [round(s * 100, 2) for s in per_row_scores])
+
+    def test_empty_candidate_matrix(self):
+        scores = predict_in_chunks(self.model, np.empty((0, self.features.shape[1])))
+        self.assertEqual(len(scores), 0)
+
+    def test_invalid_chunk_size(self):
+        with self.assertRaises(ValueError):
+            predict_in_chunks(self.model, self.features, 0)
+
+class TestModelRegistry(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.model_path = os.path.join(self.temp_dir, "matching_model.h5")
+        shutil.copy(MODEL_PATH, self.model_path)
+        self.registry = ModelRegistry(self.model_path, backend="keras")
+
+    # The model should only be loaded once and then shared.
+    def test_model_is_shared(self):
+        self.assertFalse(self.registry.is_loaded())
+        model = self.registry.get()
+        self.assertTrue(self.registry.is_loaded())
+        self.assertIs(self.registry.get(), model)
+
+    # Swapping to a new file should replace the served model.
+    def test_swap(self):
+        model = self.registry.get()
+        new_model_path = os.path.join(self.temp_dir, "new_matching_model.h5")
+        shutil.copy(MODEL_PATH, new_model_path)
+
+        new_model = self.registry.swap(new_model_path)
+
+        self.assertIsNot(new_model, model)
+        self.assertIs(self.registry.get(), new_model)
+        self.assertEqual(self.registry.path, new_model_path)
+
+    # Replacing the file in place should only reload the model once.
+    def test_reload_if_changed(self):
+        model = self.registry.get()
+        self.assertFalse(self.registry.reload_if_changed())
+
+        mtime = os.path.getmtime(self.model_path)
+        os.utime(self.model_path, (mtime + 10, mtime + 10))
+
+        self.assertTrue(self.registry.reload_if_changed())
+        self.assertIsNot(self.registry.get(), model)
+        self.assertFalse(self.registry.reload_if_changed())
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+class TestFeatureVectorizers(unittest.TestCase):
+    def setUp(self):
+        profiles = MockProfiles()
+        self.df, self.current_df, _ = load_mock_data(profiles.mock_user_profiles, profiles.mock_current_user_profile)
+
+    # Runs the text similarity calculations with the given vectorizers
+    # (or without them) and returns the scores of each user.
+    def calculate_scores(self, df: pd.DataFrame, vectorizers: dict) -> dict:
+        users_dictionary = {attr: {user: 0 for user in df['username'].values} for attr in TEXT_FEATURES}
+
+        interests_dot_prod(df['interests'], self.current_df['interests'], users_dictionary, vectorizers.get("interests"))
+        sexual_orientation_similarity(df[['gender', 'interested_in']], self.current_df[['gender', 'interested_in']],
+                                      users_dictionary, vectorizers.get("sexual_orientation"))
+        residence_dot_prod(df[['city_residence', 'state_residence']], self.current_df[['state_residence', 'city_residence']],
+                           users_dictionary, vectorizers.get("residence"))
+        relationship_status_dot_prod(df['relationship_status'], self.current_df['relationship_status'],
+                                     users_dictionary, vectorizers.get("relationship_status"))
+
+        return users_dictionary
+
+    # Vectorizers fitted ahead of time on the same profiles should produce the
+    # same scores as the ones fitted on the candidate pool during the request.
+    def test_prefitted_vectorizers_match_request_time_fitting(self):
+        vectorizers = fit_feature_vectorizers(self.df)
+        self.assertEqual(self.calculate_scores(self.df, vectorizers), self.calculate_scores(self.df, {}))
+
+    # With pre-fitted vectorizers, the score of a user should not depend on who
+    # else happens to be in the candidate pool.
+    def test_scores_are_stable_across_pools(self):
+        vectorizers = fit_feature_vectorizers(self.df)
+        full_pool_scores = self.calculate_scores(self.df, vectorizers)
+        smaller_pool_scores = self.calculate_scores(self.df.iloc[0:2], vectorizers)
+
+        for attr in TEXT_FEATURES:
+            for user, score in smaller_pool_scores[attr].items():
+                self.assertEqual(score, full_pool_scores[attr][user])
+
+    def test_save_and_load(self):
+        vectorizers = fit_feature_vectorizers(self.df)
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = os.path.join(temp_dir, "feature_vectorizers.joblib")
+            save_feature_vectorizers(vectorizers, path)
+            loaded_vectorizers = load_feature_vectorizers(path)
+
+        self.assertEqual(self.calculate_scores(self.df, loaded_vectorizers), self.calculate_scores(self.df, vectorizers))
+
+class TestFeatureStore(unittest.TestCase):
+    def setUp(self):
+        profiles = MockProfiles()
+        self.df, self.current_df, _ = load_mock_data(profiles.mock_user_profiles, profiles.mock_current_user_profile)
+        self.vectorizers = fit_feature_vectorizers(self.df)
+        self.feature_space = FeatureSpace(self.vectorizers)
+
+    # Stored feature rows should decode to exactly the rows that were encoded.
+    def test_encode_and_decode(self):
+        matrix = self.feature_space.transform(self.df)
+        rows = [decode_feature_row(encode_feature_row(matrix[i])) for i in range(matrix.shape[0])]
+        stacked_matrix = stack_feature_rows(rows, self.feature_space.num_columns)
+
+        self.assertEqual(stacked_matrix.shape, matrix.shape)
+        self.assertEqual(abs(stacked_matrix - matrix).sum(), 0)
+
+    # Scoring the feature rows should produce the same scores as calculating
+    # them from the raw profiles with the same vectorizers.
+    def test_feature_rows_match_raw_profile_scores(self):
+        attrs = ["interests", "height", "sexual_orientation", "residence", "relationship_status"]
+        usernames = self.df['username'].values
+
+        raw_scores = {attr: {user: 0 for user in usernames} for attr in attrs}
+        interests_dot_prod(self.df['interests'], self.current_df['interests'], raw_scores, self.vectorizers["interests"])
+        height_dot_prod(self.df['height'], self.current_df['height'], raw_scores)
+        sexual_orientation_similarity(self.df[['gender', 'interested_in']], self.current_df[['gender', 'interested_in']],
+                                      raw_scores, self.vectorizers["sexual_orientation"])
+        residence_dot_prod(self.df[['city_residence', 'state_residence']], self.current_df[['state_residence', 'city_residence']],
+                           raw_scores, self.vectorizers["residence"])
+        relationship_status_dot_prod(self.df['relationship_status'], self.current_df['relationship_status'],
+                                     raw_scores, self.vectorizers["relationship_status"])
+
+        feature_scores = {attr: {user: 0 for user in usernames} for attr in attrs}
+        users_heights = np.array([parse_height_inches(height) for height in self.df['height'].values], dtype=np.float64)
+        current_user_row = self.feature_space.transform(self.current_df)
+        feature_row_dot_prods(self.feature_space.transform(self.df),
+                              users_heights,
+                              self.feature_space.segment_matrix(current_user_row),
+                              parse_height_inches(self.current_df['height'].values[0]),
+                              feature_scores)
+
+        self.assertEqual(feature_scores, raw_scores)
+
+class TestInterestIndex(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(7)
+
+        # Sparse, normalized vectors similar to the TF-IDF vectors of the
+        # interests of 400 users.
+        self.matrix = normalize(sp.random(400, 60, density=0.1, format="csr", random_state=7))
+        self.usernames = [f"user_{i}" for i in range(400)]
+        self.query = normalize(sp.random(1, 60, density=0.2, format="csr", random_state=rng.integers(1000)))
+
+        self.index = InterestIndex(60)
+        self.index.build(self.usernames, self.matrix)
+
+    def exact_top_k(self, k: int, excluded: set = set()) -> list:
+        similarities = (self.matrix @ self.query.T).toarray().reshape(-1)
+        order = np.argsort(-similarities, kind="stable")
+        return [self.usernames[i] for i in order if self.usernames[i] not in excluded][0:k]
+
+    # Probing every list should return the exact top-K users.
+    def test_probing_every_list_is_exact(self):
+        self.index.num_probes = len(self.index.centroids)
+        results = [username for username, _ in self.index.search(self.query, 10)]
+        self.assertEqual(results, self.exact_top_k(10))
+
+    # Probing only a few lists should still find most of the top-K users.
+    def test_recall(self):
+        results = {username for username, _ in self.index.search(self.query, 10)}
+        self.assertGreaterEqual(len(results & set(self.exact_top_k(10))), 7)
+
+    def test_insert_and_delete(self):
+        # A user whose interests are exactly those of the query should be found first.
+        self.index.add("new_user", self.query)
+        self.assertEqual(self.index.search(self.query, 1)[0][0], "new_user")
+
+        # Deleted users should no longer be returned.
+        self.index.remove("new_user")
+        top_user = self.index.search(self.query, 1)[0][0]
+        self.index.remove(top_user)
+
+        results = [username for username, _ in self.index.search(self.query, 10)]
+        self.assertNotIn("new_user", results)
+        self.assertNotIn(top_user, results)
+        self.assertEqual(len(self.index), 399)
+
+    def test_allowed_users(self):
+        allowed = set(self.usernames[0:50])
+        results = self.index.search(self.query, 10, allowed=allowed)
+        self.assertTrue(all(username in allowed for username, _ in results))
+
+    # Small sets of allowed users (e.g. the users of a region) spread over many
+    # lists should still return k users, probing more lists if needed.
+    def test_allowed_region(self):
+        self.index.num_probes = 2
+        allowed = set(self.usernames[0::10])
+        results = [username for username, _ in self.index.search(self.query, 30, allowed=allowed)]
+
+        self.assertEqual(len(results), 30)
+        self.assertTrue(all(username in allowed for username in results))
+        self.assertEqual(len(self.index.search(self.query, 100, allowed=allowed)), 40)
+
+# Cursor over the feature store rows and deletions (whose features are None) of
+# the given users, which records whether the lock of the registry was held
+# while querying them.
+class MockFeatureStoreCursor:
+    def __init__(self, registry: InterestIndexRegistry, records: list[tuple], xmin: int):
+        self.registry = registry
+        self.records = records
+        self.xmin = xmin
+        self.locked: list[bool] = []
+
+    def execute(self, statement: str, params: list | None = None) -> None:
+        self.locked.append(self.registry._lock.locked())
+
+        if "txid_snapshot_xmin" in statement:
+            self.rows = [(self.xmin,)]
+        else:
+            synced_txid = params[1]
+            self.rows = sorted([record for record in self.records
+                                if (synced_txid is None and record[1] is not None)
+                                or (synced_txid is not None and record[2] >= synced_txid)],
+                               key=lambda record: (record[2], record[1] is not None))
+
+    def fetchone(self) -> tuple:
+        return self.rows[0]
+
+    def fetchall(self) -> list[tuple]:
+        return self.rows
+
+class TestInterestIndexRegistry(unittest.TestCase):
+    def setUp(self):
+        self.matrix = normalize(sp.random(100, 60, density=0.1, format="csr", random_state=7))
+        self.feature_space = types.SimpleNamespace(id="test", offsets=np.array([0, 60]), num_columns=60)
+        self.records = [(f"user_{i}", encode_feature_row(self.matrix[i]), i + 1) for i in range(100)]
+
+    # The index should be built, and then kept in sync with the inserted and
+    # deleted users, without holding the lock during the round trips to the
+    # database.
+    def test_sync(self):
+        registry = InterestIndexRegistry()
+        cursor = MockFeatureStoreCursor(registry, list(self.records), xmin=101)
+
+        index = registry.get(cursor, self.feature_space)
+        self.assertEqual(len(index), 100)
+
+        cursor.records += [("new_user", encode_feature_row(self.matrix[0]), 101),
+                           ("user_5", None, 102)]
+        cursor.xmin = 103
+
+        self.assertIs(registry.get(cursor, self.feature_space), index)
+        self.assertEqual(len(index), 100)
+        self.assertIn("new_user", index.vectors)
+        self.assertNotIn("user_5", index.vectors)
+        self.assertEqual(cursor.locked, [False] * 4)
+
+    # Rows written by transactions that commit after a later transaction was
+    # synced should still be applied.
+    def test_late_commit(self):
+        registry = InterestIndexRegistry()
+        cursor = MockFeatureStoreCursor(registry, list(self.records), xmin=101)
+        index = registry.get(cursor, self.feature_space)
+
+        # Transaction 101 is still in progress when the row of transaction 102
+        # is synced.
+        cursor.records.append(("late_user", encode_feature_row(self.matrix[1]), 102))
+        registry.get(cursor, self.feature_space)
+
+        cursor.records.append(("slow_user", encode_feature_row(self.matrix[2]), 101))
+        cursor.xmin = 103
+        registry.get(cursor, self.feature_space)
+
+        self.assertIn("late_user", index.vectors)
+        self.assertIn("slow_user", index.vectors)
+
+    # Users deleted and then signed up again within the same transaction should
+    # stay in the index.
+    def test_deleted_and_inserted_again(self):
+        registry = InterestIndexRegistry()
+        cursor = MockFeatureStoreCursor(registry, list(self.records), xmin=101)
+        index = registry.get(cursor, self.feature_space)
+
+        cursor.records[0] = ("user_0", encode_feature_row(self.matrix[0]), 101)
+        cursor.records.append(("user_0", None, 101))
+        cursor.xmin = 102
+        registry.get(cursor, self.feature_space)
+
+        self.assertIn("user_0", index.vectors)
+
+class TestTopKSelector(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(3)
+
+        # Scores rounded to 2 decimal places like the ones returned by the
+        # matching algorithm, so that many of them are tied.
+        self.scores = np.round(rng.uniform(0, 100, size=5000), 0)
+
+    def sorted_top_k(self, k: int) -> list:
+        ranked = sorted(enumerate(self.scores), key=lambda x: x[1], reverse=True)[0:k]
+        return [i for i, _ in ranked]
+
+    # The selected users should be the same (and in the same order) as the ones
+    # returned by sorting every score, including the order of tied users.
+    def test_matches_full_sort(self):
+        for k in [1, 10, 100]:
+            selector = TopKSelector(k)
+            selector.push(self.scores)
+            ids, scores = selector.result()
+
+            self.assertEqual(ids.tolist(), self.sorted_top_k(k))
+            self.assertEqual(scores.tolist(), self.scores[self.sorted_top_k(k)].tolist())
+
+    def test_chunked_pushes(self):
+        selector = TopKSelector(10)
+
+        for start in range(0, len(self.scores), 333):
+            selector.push(self.scores[start:start + 333])
+
+        self.assertEqual(selector.result()[0].tolist(), self.sorted_top_k(10))
+
+    def test_fewer_scores_than_k(self):
+        selector = TopKSelector(10)
+        selector.push(self.scores[0:4])
+        self.assertEqual(selector.result()[0].tolist(), sorted(range(4), key=lambda i: self.scores[i], reverse=True))
+
+class TestOrientationFilter(unittest.TestCase):
+    def setUp(self):
+        genders = ["Male", "Female", "Non-binary", "Transgender Man", "Transgender Woman", "Other"]
+        gender_interests = ["Males", "Females", "Males, Females", "Enbies", "Females, Enbies", "Anyone"]
+        sexual_orientations = ["Heterosexual", "Homosexual", "Bisexual", "Pansexual"]
+
+        # Every combination of gender, gender interests, and sexual orientation.
+        self.profiles = [
+            {"username": f"user_{i}", "gender": gender, "interested_in": interested_in, "sexual_orientation": sexual_orientation}
+            for i, (gender, interested_in, sexual_orientation) in enumerate(itertools.product(genders, gender_interests, sexual_orientations))
+        ]
+
+        self.df = encode_orientations(pd.DataFrame(self.profiles))
+
+    # The vectorized mask should keep exactly the same users as the original
+    # filter, for every kind of current user.
+    def test_matches_original_filter(self):
+        for current_user in self.profiles:
+            expected = [match["username"] for match in filter_matches(copy.deepcopy(self.profiles), copy.deepcopy(current_user))]
+
+            mask = orientation_mask(self.df["gender_bits"].to_numpy(), self.df["interest_bits"].to_numpy(), current_user)
+
+            self.assertEqual(self.df["username"][mask].tolist(), expected)
+
+    # The profiles of the users should no longer be modified by the filter.
+    def test_profiles_are_not_modified(self):
+        current_user = dict(self.profiles[0])
+        orientation_mask(self.df["gender_bits"].to_numpy(), self.df["interest_bits"].to_numpy(), current_user)
+
+        self.assertEqual(current_user, self.profiles[0])
+        self.assertEqual(self.df["interested_in"].tolist(), [profile["interested_in"] for profile in self.profiles])
+
+# Cursor returning a fixed set of rows, in the same way as a psycopg2 cursor.
+class MockCursor:
+    def __init__(self, columns: list, records: list):
+        self.description = [(column,) for column in columns]
+        self.records = list(records)
+
+    def fetchmany(self, size: int) -> list:
+        records, self.records = self.records[0:size], self.records[size:]
+        return records
+
+class TestCandidateTable(unittest.TestCase):
+    def setUp(self):
+        profiles = MockProfiles()
+        self.columns = ["username", "gender", "interested_in", "height", "visits", "uri", "birth_month", "birth_date", "birth_year"]
+        self.records = [
+            tuple((bytes(profile[column], 'utf-8') if column == "uri" else profile.get(column, 0)) for column in self.columns)
+            for profile in profiles.mock_user_profiles
+        ]
+
+    # Streaming the rows in batches should produce one typed array per column.
+    def test_fetch_columns(self):
+        columns = fetch_columns(MockCursor(self.columns, self.records), batch_size=2)
+
+        self.assertEqual(list(columns.keys()), self.columns)
+        self.assertEqual(columns["username"].tolist(), [record[0] for record in self.records])
+        self.assertEqual(columns["visits"].dtype, np.float64)
+        self.assertEqual(columns["visits"].tolist(), [float(record[4]) for record in self.records])
+
+    def test_take_and_exclude(self):
+        candidates = load_candidate_table(MockCursor(self.columns, self.records))
+        excluded = candidates.exclude(self.records[0][0])
+
+        self.assertEqual(len(excluded), len(self.records) - 1)
+        self.assertNotIn(self.records[0][0], excluded["username"].tolist())
+        self.assertEqual(candidates.take(np.array([2, 0]))["username"].tolist(), [self.records[2][0], self.records[0][0]])
+
+    # Profiles should be built from their row the same way load_data used to build them.
+    def test_profile_table(self):
+        profiles = load_profile_table(MockCursor(self.columns, self.records))
+        profile = profiles.profile(profiles.row_id(self.records[1][0]))
+
+        self.assertEqual(profile["username"], self.records[1][0])
+        self.assertEqual(profile["uri"], self.records[1][5].decode('utf-8'))
+        self.assertIn("age", profile)
+
+class TestMatchSessions(unittest.TestCase):
+    def setUp(self):
+        self.store = MatchSessionStore(ttl=600, max_sessions=3)
+        self.matches = [{"username": f"user_{i}"} for i in range(25)]
+
+    # Following the cursors should return every match exactly once, in order.
+    def test_pagination(self):
+        session = self.store.create("tim_johnson", False, self.matches)
+        page, has_more, cursor = session.page(0, 10)
+        results = list(page)
+
+        while has_more:
+            session, offset = self.store.resolve("tim_johnson", cursor)
+            page, has_more, cursor = session.page(offset, 10)
+            results.extend(page)
+
+        self.assertEqual(results, self.matches)
+        self.assertIsNone(cursor)
+
+    # Pages should hold at most MATCH_PAGE_LIMIT matches, whatever the client
+    # asks for.
+    def test_page_limit(self):
+        session = self.store.create("tim_johnson", False, self.matches)
+        page, has_more, _ = session.page(0, 100)
+
+        self.assertEqual(len(page), MATCH_PAGE_LIMIT)
+        self.assertTrue(has_more)
+
+    def test_latest_session_is_reused(self):
+        session = self.store.create("tim_johnson", True, self.matches)
+
+        self.assertIs(self.store.latest("tim_johnson", True), session)
+        self.assertIsNone(self.store.latest("tim_johnson", False))
+
+        self.store.invalidate("tim_johnson")
+        self.assertIsNone(self.store.latest("tim_johnson", True))
+
+    # Cursors of expired sessions, of other users, or that were tampered
+    # with should be rejected.
+    def test_invalid_cursors(self):
+        _, _, cursor = self.store.create("tim_johnson", False, self.matches).page(0, 10)
+
+        with self.assertRaises(InvalidCursorError):
+            self.store.resolve("annie_white", cursor)
+
+        with self.assertRaises(InvalidCursorError):
+            self.store.resolve("tim_johnson", "not-a-cursor")
+
+        expired_store = MatchSessionStore(ttl=0)
+        _, _, expired_cursor = expired_store.create("tim_johnson", False, self.matches).page(0, 10)
+
+        with self.assertRaises(InvalidCursorError):
+            expired_store.resolve("tim_johnson", expired_cursor)
+
+    def test_least_recently_used_sessions_are_evicted(self):
+        for i in range(5):
+            self.store.create(f"user_{i}", False, self.matches)
+
+        self.assertEqual(len(self.store), 3)
+        self.assertIsNone(self.store.latest("user_0", False))
+        self.assertIsNotNone(self.store.latest("user_4", False))
+
+class TestMatchExecutor(unittest.TestCase):
+    # Work submitted to the worker processes should return its result to the event loop.
+    def test_process_pool(self):
+        executor = MatchExecutor(workers=1, queue_size=4, initializer=None)
+
+        try:
+            self.assertEqual(asyncio.run(executor.submit(pow, 2, 10)), 1024)
+            self.assertEqual(executor.metrics()["completed"], 1)
+        
+        finally:
+            executor.shutdown()
+
+    # A worker that died should fail its match and get the pool replaced, so that
+    # the following matches still run.
+    def test_broken_worker(self):
+        executor = MatchExecutor(workers=1, queue_size=4, initializer=None)
+
+        try:
+            with self.assertRaises(BrokenProcessPool):
+                asyncio.run(executor.submit(os._exit, 1))
+
+            self.assertEqual(asyncio.run(executor.submit(pow, 2, 10)), 1024)
+
+            metrics = executor.metrics()
+            self.assertEqual((metrics["completed"], metrics["failed"], metrics["restarts"]), (1, 1, 1))
+        
+        finally:
+            executor.shutdown()
+
+    # Once the queue is full, new work should be rejected instead of waiting.
+    def test_bounded_queue(self):
+        executor = MatchExecutor(workers=0, queue_size=1, initializer=None)
+        release = threading.Event()
+
+        async def submit_twice():
+            first = asyncio.create_task(executor.submit(release.wait, 5))
+            await asyncio.sleep(0.1)
+
+            self.assertEqual(executor.metrics()["in_flight"], 1)
+
+            with self.assertRaises(MatchQueueFullError):
+                await executor.submit(release.wait, 5)
+
+            release.set()
+            return await first
+
+        try:
+            self.assertTrue(asyncio.run(submit_twice()))
+
+            metrics = executor.metrics()
+            self.assertEqual((metrics["in_flight"], metrics["completed"], metrics["rejected"]), (0, 1, 1))
+        
+        finally:
+            executor.shutdown()
+
+    # Matches should draw their connection from the pool of the worker, and hand
+    # it back exactly once, whether or not the matching algorithm failed.
+    def test_worker_connections(self):
+        pool = ConnectionPool(dsn="test", min_size=0, max_size=1, connect=MockConnection)
+
+        def match(username, db, cursor, use_so_filter, top_k, release):
+            release(db)
+
+            if username == "missing_user":
+                raise KeyError(username)
+
+            return [{"username": "user_1"}]
+
+        with patch("helpers.match_executor.worker_db_pool", pool), patch("main.run_matching_algorithm", match):
+            self.assertEqual(run_match_in_worker("user_0", False, 10), [{"username": "user_1"}])
+
+            with self.assertRaises(KeyError):
+                run_match_in_worker("missing_user", False, 10)
+
+        metrics = pool.metrics()
+        self.assertEqual((metrics["opened"], metrics["acquired"], metrics["idle"]), (1, 2, 1))
+
+# Cursor over the stored match list of a user, along with whether each match
+# changed their profile after it was computed.
+class MockPrecomputedMatchesCursor:
+    def __init__(self, records: list[tuple]):
+        self.records = records
+        self.params: list = []
+
+    def execute(self, statement: str, params: list) -> None:
+        self.params = params
+
+    def fetchall(self) -> list[tuple]:
+        return self.records
+
+class TestPrecomputedMatches(unittest.TestCase):
+    def setUp(self):
+        profiles = MockProfiles()
+        self.user_profiles = profiles.mock_user_profiles
+        self.current_user_profile = profiles.mock_current_user_profile
+
+        columns = ["username", "first_name", "middle_name", "last_name", "interests", "height", "gender",
+                   "sexual_orientation", "interested_in", "state_residence", "city_residence", "relationship_status"]
+
+        def table(rows: list) -> CandidateTable:
+            return CandidateTable({column: np.array([row[column] for row in rows], dtype=object) for column in columns})
+
+        self.candidates = encode_orientations(table(self.user_profiles))
+        self.candidates["visits"] = np.array([row.get("visits", 0) for row in self.user_profiles], dtype=np.float64)
+        self.current_user = table(self.current_user_profile)
+
+    # The batch job ranks every candidate. The ranking should start with the same
+    # users the matching algorithm recommends, from the highest to the lowest score.
+    def test_ranking_matches_recommendations(self):
+        username = self.current_user_profile[0]["username"]
+        scores = process_data(self.candidates, self.current_user, username)
+
+        candidates = self.candidates.exclude(username)
+
+        for use_so_filter in [False, True]:
+            eligible = filter_candidates(candidates, self.current_user_profile[0]) if use_so_filter else None
+            ranked_users, ranked_scores = rank_candidates(scores, candidates["username"], eligible, top_k=None)
+
+            expected = run_mock_algorithm(copy.deepcopy(self.user_profiles), copy.deepcopy(self.current_user_profile), use_so_filter)
+
+            self.assertEqual(ranked_users[0:len(expected)], [user["username"] for user in expected])
+            self.assertTrue(np.all(np.diff(ranked_scores) <= 0))
+
+    # A mask of eligible users that doesn't line up with the candidates should be
+    # rejected instead of being cut to their length.
+    def test_misaligned_eligible_mask(self):
+        username = self.current_user_profile[0]["username"]
+        scores = process_data(self.candidates, self.current_user, username)
+        candidates = self.candidates.exclude(username)
+
+        with self.assertRaises(ValueError):
+            rank_candidates(scores, candidates["username"], np.ones(len(candidates) + 1, dtype=bool))
+
+    # Lists that are missing, or whose top matches changed their profile after
+    # they were computed, should be recomputed instead of served.
+    def test_stale_matches(self):
+        self.assertIsNone(load_precomputed_matches(MockPrecomputedMatchesCursor([]), "user_0", False))
+
+        cursor = MockPrecomputedMatchesCursor([("user_1", False), ("user_2", True), ("user_3", False)])
+
+        self.assertIsNone(load_precomputed_matches(cursor, "user_0", True, 2))
+        self.assertEqual(cursor.params, [2, "user_0", True, PRECOMPUTED_MATCH_MAX_AGE])
+
+class TestHeightInches(unittest.TestCase):
+    def setUp(self):
+        profiles = MockProfiles()
+        self.df, self.current_df, _ = load_mock_data(profiles.mock_user_profiles, profiles.mock_current_user_profile)
+
+    def test_height_to_inches(self):
+        self.assertEqual(height_to_inches("5", "9"), 69)
+        self.assertEqual(height_to_inches(6, 0), 72)
+
+    # Heights that were not stored in inches yet should be parsed from their text.
+    def test_missing_heights_are_parsed(self):
+        heights = [parse_height_inches(height) for height in self.df['height'].values]
+        candidates = CandidateTable({
+            "height": self.df['height'].to_numpy(dtype=object),
+            "height_inches": np.array([heights[0], np.nan] + heights[2:], dtype=np.float64)
+        })
+
+        self.assertEqual(height_inches(candidates).tolist(), heights)
+
+    # The vectorized height similarity should give the same scores as parsing the heights.
+    def test_height_similarity(self):
+        usernames = self.df['username'].values
+        scores = {"height": {user: 0 for user in usernames}}
+        height_dot_prod(self.df['height'], self.current_df['height'], scores)
+
+        similarity = height_similarity(height_inches(self.df), height_inches(self.current_df)[0])
+
+        self.assertEqual([round(score, 2) for score in similarity.tolist()], list(scores["height"].values()))
+
+class TestOrientationCompatibility(unittest.TestCase):
+    def setUp(self):
+        genders = ["Male", "Female", "Non-binary", "Transgender Man", "Transgender Woman", "Other"]
+        gender_interests = ["Males", "Females", "Males, Females", "Anyone", "Non-binary"]
+        combinations = list(itertools.product(genders, gender_interests))
+
+        # Every orientation appears several times among the candidates.
+        self.df = pd.DataFrame(combinations * 3, columns=["gender", "interested_in"])
+        self.current_dfs = [pd.DataFrame([combination], columns=["gender", "interested_in"]) for combination in combinations]
+
+    # Scores of the orientations calculated over every row, the way they
+    # were before the compatibility table.
+    def legacy_scores(self, current_df: pd.DataFrame, vectorizer=None) -> list[float]:
+        users = [', '.join(row) for row in self.df.values]
+        current_user = [', '.join(row) for row in current_df.values]
+
+        if vectorizer is None:
+            vectorizer = initialize_vectorizer()
+            users_vect = vectorizer.fit_transform(users)
+        else:
+            users_vect = vectorizer.transform(users)
+
+        sim = cosine_similarity(normalize(users_vect), normalize(vectorizer.transform(current_user)))
+        return [round(score, 2) for score in threshold_orientation_similarity(sim).reshape(-1).tolist()]
+
+    def test_matches_legacy_scores_without_fitted_vectorizer(self):
+        for current_df in self.current_dfs:
+            scores = sexual_orientation_similarity(self.df, current_df, None)
+            self.assertEqual(scores.tolist(), self.legacy_scores(current_df))
+
+    def test_matches_legacy_scores_with_fitted_vectorizer(self):
+        vectorizer = initialize_vectorizer().fit([', '.join(row) for row in self.df.values])
+
+        # The second pass is served from the table filled in by the first one.
+        for _ in range(2):
+            for current_df in self.current_dfs:
+                scores = sexual_orientation_similarity(self.df, current_df, None, vectorizer)
+                self.assertEqual(scores.tolist(), self.legacy_scores(current_df, vectorizer))
+
+    # Scores should also be stored in the user dictionary, the same way as before.
+    def test_updates_user_dict(self):
+        current_df = self.current_dfs[0]
+        user_dict = {"sexual_orientation": {i: 0 for i in range(len(self.df))}}
+        sexual_orientation_similarity(self.df, current_df, user_dict)
+
+        self.assertEqual(list(user_dict["sexual_orientation"].values()), self.legacy_scores(current_df))
+
+class TestScoringKernel(unittest.TestCase):
+    def setUp(self):
+        profiles = MockProfiles()
+        self.df, self.current_df, _ = load_mock_data(profiles.mock_user_profiles, profiles.mock_current_user_profile)
+        self.feature_space = FeatureSpace(fit_feature_vectorizers(self.df))
+        self.rng = np.random.default_rng(11)
+
+    # Feature rows of a random candidate pool of the given size.
+    def random_pool(self, num_users: int):
+        rows = sp.random(num_users, 30, density=0.2, format="csr", random_state=num_users)
+        users_matrix = sp.csr_matrix(normalize(rows)) if num_users > 0 else rows
+        segment_matrix = sp.random(30, 4, density=0.3, format="csr", random_state=num_users + 1)
+        users_heights = self.rng.integers(55, 80, num_users).astype(np.float64)
+        visits = self.rng.integers(0, 10, num_users).astype(np.float64)
+
+        return users_matrix, users_heights, segment_matrix, 66., visits
+
+    # The kernel should give the same scores as scoring each attribute on its own.
+    def test_matches_attribute_scores(self):
+        users_matrix = self.feature_space.transform(self.df)
+        segment_matrix = self.feature_space.segment_matrix(self.feature_space.transform(self.current_df))
+        users_heights = height_inches(self.df)
+        current_user_height = height_inches(self.current_df)[0]
+        visits = self.df['visits'].to_numpy(dtype=np.float64)
+
+        scores = ScoringKernel().score(users_matrix, users_heights, segment_matrix, current_user_height, visits)
+        attr_scores = feature_row_dot_prods(users_matrix, users_heights, segment_matrix, current_user_height)
+
+        self.assertTrue(np.array_equal(scores[:, 0:5], attr_scores))
+        self.assertTrue(np.array_equal(scores[:, 5], visits))
+        self.assertTrue(np.array_equal(scores[:, 6], similarity_scores(attr_scores, visits)))
+
+    # Reusing (and growing) the buffers across pools of different sizes should
+    # not change the scores.
+    def test_reuses_buffers(self):
+        kernel = ScoringKernel(capacity=8)
+
+        for num_users in [5, 100, 0, 3, 1000, 20]:
+            users_matrix, users_heights, segment_matrix, current_user_height, visits = self.random_pool(num_users)
+            scores = kernel.score(users_matrix, users_heights, segment_matrix, current_user_height, visits)
+
+            self.assertEqual(scores.shape, (num_users, 7))
+
+            if num_users > 0:
+                attr_scores = feature_row_dot_prods(users_matrix, users_heights, segment_matrix, current_user_height)
+                self.assertTrue(np.array_equal(scores[:, 0:5], attr_scores))
+                self.assertTrue(np.array_equal(scores[:, 6], similarity_scores(attr_scores, visits)))
+
+        self.assertGreaterEqual(kernel.capacity, 1000)
+
+    # Vectorized rounding should give the same results as Python's round,
+    # including for values halfway between two roundings.
+    def test_round_decimals(self):
+        halfway = (np.arange(-2000, 2000) + 0.5) / 100
+
+        # Values just above and below the halfway ones, and exact ties (e.g. 0.125).
+        values = np.concatenate([self.rng.random(10000) * 4 - 2,
+                                 halfway,
+                                 np.nextafter(halfway, np.inf),
+                                 np.nextafter(halfway, -np.inf),
+                                 (np.arange(-100, 100) * 2 + 1) / 8])
+
+        for decimals in [2, 3]:
+            expected = [round(value, decimals) for value in values.tolist()]
+            self.assertEqual(round_decimals(values, decimals).tolist(), expected)
+
+# Table of every mock user (including the current one), in which every user is
+# a candidate of every other user.
+def mock_candidate_pool() -> CandidateTable:
+    profiles = MockProfiles()
+    rows = profiles.mock_user_profiles + profiles.mock_current_user_profile
+
+    columns = ["username", "first_name", "middle_name", "last_name", "interests", "height", "gender",
+               "sexual_orientation", "interested_in", "state_residence", "city_residence", "relationship_status"]
+
+    pool = encode_orientations(CandidateTable({column: np.array([row[column] for row in rows], dtype=object) for column in columns}))
+    pool["visits"] = np.array([row.get("visits", 0) for row in rows], dtype=np.float64)
+
+    return pool
+
+class TestBatchMatching(unittest.TestCase):
+    def setUp(self):
+        self.pool = mock_candidate_pool()
+        self.usernames: list[str] = self.pool["username"].tolist()
+
+        self.feature_space = FeatureSpace(fit_feature_vectorizers(self.pool))
+        self.users_matrix = self.feature_space.transform(self.pool)
+        self.users_heights = height_inches(self.pool)
+
+        # Every user is a candidate of every other user.
+        self.candidate_lists = {}
+
+        for username in self.usernames:
+            candidates = self.pool.exclude(username)
+            self.candidate_lists[username] = (candidates["username"], candidates["visits"])
+
+    def rank(self, usernames: list[str]):
+        return rank_users(usernames, self.pool, self.feature_space, self.users_matrix, self.users_heights,
+                          self.candidate_lists, [False, True], top_k=None)
+
+    # Each user should get the same ranking as the matching algorithm gives them
+    # on their own.
+    def test_matches_single_user_rankings(self):
+        rankings = self.rank(self.usernames)
+
+        for i, username in enumerate(self.usernames):
+            candidates = self.pool.exclude(username)
+            current_user = self.pool.take(np.array([i]))
+            scores = process_data(candidates, current_user, username, build_features(self.feature_space, candidates, current_user))
+
+            for use_so_filter in [False, True]:
+                profile = {name: current_user[name][0] for name in ["gender", "interested_in", "sexual_orientation"]}
+                eligible = filter_candidates(candidates, profile) if use_so_filter else None
+                ranked_users, ranked_scores = rank_candidates(scores, candidates["username"], eligible, top_k=None)
+
+                self.assertEqual(rankings[username][use_so_filter][0], ranked_users)
+                self.assertEqual(rankings[username][use_so_filter][1].tolist(), ranked_scores.tolist())
+
+    # Scoring the users in several smaller blocks should give the same rankings.
+    def test_blocks(self):
+        rankings = self.rank(self.usernames)
+        max_dot_prods = ml_batch_matching.BATCH_MAX_DOT_PRODS
+
+        try:
+            ml_batch_matching.BATCH_MAX_DOT_PRODS = 1
+            block_rankings = self.rank(self.usernames)
+        finally:
+            ml_batch_matching.BATCH_MAX_DOT_PRODS = max_dot_prods
+
+        for username in self.usernames:
+            for use_so_filter in [False, True]:
+                self.assertEqual(block_rankings[username][use_so_filter][0], rankings[username][use_so_filter][0])
+
+    # Users that are not in the pool should get empty rankings.
+    def test_unknown_users(self):
+        rankings = self.rank(["unknown_user", self.usernames[0]])
+
+        self.assertEqual(rankings["unknown_user"][False][0], [])
+        self.assertEqual(rankings["unknown_user"][True][0], [])
+        self.assertGreater(len(rankings[self.usernames[0]][False][0]), 0)
+
+class TestConcurrentMatching(unittest.TestCase):
+    def setUp(self):
+        self.pool = mock_candidate_pool()
+        self.usernames: list[str] = self.pool["username"].tolist()
+        self.feature_space = FeatureSpace(fit_feature_vectorizers(self.pool))
+
+    # Builds the context of a run of the matching algorithm for the given user,
+    # the same way load_match_inputs does from the database.
+    def match_context(self, username: str, use_so_filter: bool) -> MatchContext:
+        i = self.usernames.index(username)
+        context = MatchContext(username, use_so_filter)
+
+        context.candidates = self.pool.exclude(username)
+        context.current_user = self.pool.take(np.array([i]))
+        context.user_features = build_features(self.feature_space, context.candidates, context.current_user)
+
+        if use_so_filter:
+            profile = {name: context.current_user[name][0] for name in ["gender", "interested_in", "sexual_orientation"]}
+            context.eligible = filter_candidates(context.candidates, profile)
+
+        return context
+
+    def run_match(self, username: str, use_so_filter: bool) -> tuple[list[str], list[float]]:
+        context = score_candidates(self.match_context(username, use_so_filter))
+        ranked_users, ranked_scores = rank_candidates(context.scores, context.usernames, context.eligible, top_k=None)
+
+        return ranked_users, ranked_scores.tolist()
+
+    # Many matches of different users running at the same time should each get
+    # the same results as when they run one after the other.
+    def test_concurrent_matches(self):
+        runs = list(itertools.product(self.usernames, [False, True])) * 10
+        expected = {run: self.run_match(*run) for run in set(runs)}
+
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            results = list(executor.map(lambda run: self.run_match(*run), runs))
+
+        for run, result in zip(runs, results):
+            self.assertEqual(result, expected[run])
+
+    # Only the candidates of the context's own user should be ranked.
+    def test_contexts_are_independent(self):
+        contexts = [score_candidates(self.match_context(username, False)) for username in self.usernames]
+
+        for context in contexts:
+            self.assertNotIn(context.username, context.usernames.tolist())
+            self.assertEqual(len(context.usernames), len(context.scores))
+
+class TestNumpyModel(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.npz_path = os.path.join(self.temp_dir, "matching_model.npz")
+        export_model_weights(MODEL_PATH, self.npz_path)
+
+        self.keras_model = keras.models.load_model(MODEL_PATH, compile=True)
+        self.numpy_model = NumpyModel(self.npz_path)
+
+        # Random preprocessed rows, with the same ranges as the attribute scores
+        # and visits of real candidates.
+        rng = np.random.default_rng(5)
+        self.features = np.column_stack([
+            rng.random(2000),
+            rng.uniform(0.7, 1., 2000),
+            rng.choice([-1., 1.], 2000),
+            rng.random(2000),
+            rng.random(2000),
+            rng.integers(0, 20, 2000)
+        ]).astype(np.float32)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    # The NumPy forward pass should give the same scores as the Keras model.
+    def test_matches_keras_model(self):
+        keras_scores = np.asarray(self.keras_model.predict_on_batch(self.features)).reshape(-1)
+        numpy_scores = self.numpy_model.predict_on_batch(self.features).reshape(-1)
+
+        self.assertEqual(self.numpy_model.input_shape, self.keras_model.input_shape)
+        np.testing.assert_allclose(numpy_scores, keras_scores, rtol=1e-5, atol=1e-6)
+
+    # Both backends should rank the candidates the same way.
+    def test_rankings_match_keras_model(self):
+        pool = mock_candidate_pool()
+        username = pool["username"][0]
+        candidates = pool.exclude(username)
+        scores = process_data(candidates, pool.take(np.array([0])), username)
+
+        rankings = {}
+
+        for backend in ["keras", "numpy"]:
+            rankings[backend] = rank_candidates(scores, candidates["username"], top_k=None, backend=backend)
+
+        self.assertEqual(rankings["numpy"][0], rankings["keras"][0])
+        np.testing.assert_allclose(rankings["numpy"][1], rankings["keras"][1], atol=0.01)
+
+    def test_registry_backends(self):
+        registry = ModelRegistry(self.npz_path, backend="numpy")
+        self.assertIsInstance(registry.get(), NumpyModel)
+
+        with self.assertRaises(ValueError):
+            ModelRegistry(self.npz_path, backend="unknown")
+
+class TestQuantizedModel(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.npz_path = os.path.join(self.temp_dir, "matching_model.npz")
+        export_model_weights(MODEL_PATH, self.npz_path)
+
+        self.model = NumpyModel(self.npz_path)
+        self.features = synthetic_features(5000, seed=7)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def quantize(self, precision: str) -> NumpyModel:
+        path = os.path.join(self.temp_dir, f"matching_model.{precision}.npz")
+        quantize_model_weights(self.npz_path, path, precision)
+
+        return NumpyModel(path)
+
+    # float16 weights should rank the candidates the same way as the float32
+    # ones, with the scores rounded to percentages barely moving.
+    def test_float16_rankings(self):
+        model = self.quantize("float16")
+        agreement = compare_rankings(self.model, model, self.features)
+
+        self.assertEqual(model.precision, "float16")
+        self.assertLess(model.nbytes(), self.model.nbytes() / 1.5)
+        self.assertEqual(agreement["top_k_overlap"], 1.)
+        self.assertLessEqual(agreement["max_score_difference"], 0.05)
+
+    # int8 weights are 4 times smaller and should keep nearly every candidate
+    # of the top k.
+    def test_int8_rankings(self):
+        model = self.quantize("int8")
+        agreement = compare_rankings(self.model, model, self.features)
+
+        self.assertEqual(model.precision, "int8")
+        self.assertLess(model.nbytes(), self.model.nbytes() / 3)
+        self.assertGreaterEqual(agreement["top_k_overlap"], 0.95)
+        self.assertLessEqual(agreement["max_score_difference"], 5.)
+
+    # The reduced-precision backends serve the weights committed next to the model.
+    def test_registry_backends(self):
+        for backend, precision in [("numpy_float16", "float16"), ("numpy_int8", "int8")]:
+            model = ModelRegistry(MODEL_BACKENDS[backend], backend=backend).get()
+
+            self.assertIsInstance(model, NumpyModel)
+            self.assertEqual(model.precision, precision)
+            self.assertEqual(model.predict_on_batch(self.features[0:10]).shape, (10, 1))
+
+    def test_invalid_precision(self):
+        with self.assertRaises(ValueError):
+            self.quantize("int4")
+
+        # Only full-precision weights can be quantized.
+        int8_model_path = os.path.join(self.temp_dir, "matching_model.int8.npz")
+        quantize_model_weights(self.npz_path, int8_model_path, "int8")
+
+        with self.assertRaises(ValueError):
+            quantize_model_weights(int8_model_path, os.path.join(self.temp_dir, "twice.npz"), "float16")
+
+class TestScalerStats(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.temp_dir, "scaler_stats.npz")
+
+        profiles = MockProfiles()
+        self.df, self.current_df, _ = load_mock_data(profiles.mock_user_profiles, profiles.mock_current_user_profile)
+
+        self.stats = ScalerStats()
+        self.stats.update(height_inches(pd.concat([self.df, self.current_df])))
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_update(self):
+        stats = ScalerStats()
+
+        self.assertTrue(stats.update([60., 70., np.nan]))
+        self.assertFalse(stats.update([65.]))
+        self.assertFalse(stats.update([]))
+        self.assertTrue(stats.update([75.]))
+        self.assertEqual((stats.min_height, stats.max_height), (60., 75.))
+
+        data_min, data_max = stats.data_range()
+        np.testing.assert_allclose(data_min, [0., 0.85, -1., 0., 0.])
+        np.testing.assert_allclose(data_max, [1., 1., 1., 1., 1.])
+
+    # Scaling with the statistics should be the same as fitting a MinMaxScaler
+    # on scores that span the whole range of each attribute.
+    def test_scaling(self):
+        data_min, data_max = self.stats.data_range()
+        attr_scores = np.vstack([data_min, data_max, (data_min + data_max) / 2])
+        visits = np.array([0., 3., 1.])
+
+        self.assertTrue(np.array_equal(similarity_scores(attr_scores, visits, self.stats.scaling), similarity_scores(attr_scores, visits)))
+
+    # The similarity score of a candidate should no longer depend on the other
+    # candidates of the pool.
+    def test_scores_independent_of_pool(self):
+        rng = np.random.default_rng(3)
+        rows = sp.csr_matrix(normalize(sp.random(200, 30, density=0.2, format="csr", random_state=3)))
+        segment_matrix = sp.random(30, 4, density=0.3, format="csr", random_state=4)
+        users_heights = rng.integers(55, 80, 200).astype(np.float64)
+        visits = rng.integers(0, 10, 200).astype(np.float64)
+
+        stats = ScalerStats()
+        stats.update(users_heights)
+
+        kernel = ScoringKernel()
+        scores = kernel.score(rows, users_heights, segment_matrix, 66., visits, scaling=stats.scaling).copy()
+        subset_scores = kernel.score(rows[0:20], users_heights[0:20], segment_matrix, 66., visits[0:20], scaling=stats.scaling)
+
+        self.assertTrue(np.array_equal(subset_scores, scores[0:20]))
+        self.assertTrue(np.array_equal(scores[:, 6], similarity_scores(scores[:, 0:5], visits, stats.scaling)))
+
+    # The matching algorithm and the mock should scale the scores the same way
+    # once the statistics have been computed.
+    def test_matches_mock_algorithm(self):
+        pool = mock_candidate_pool()
+        username = pool["username"][-1]
+
+        with patch.object(scaler_stats_registry, "get_scaling", return_value=self.stats.scaling):
+            scores = process_data(pool.exclude(username), pool.take(np.array([len(pool) - 1])), username)
+            mock_scores, _ = process_mock_data(self.df, self.current_df, {})
+
+        self.assertTrue(np.array_equal(scores[:, 6], mock_scores["similarity_score"].to_numpy(dtype=np.float64)))
+
+    def test_registry(self):
+        registry = ScalerStatsRegistry(self.path)
+
+        # Nothing is scaled with the statistics until they have been computed.
+        self.assertIsNone(registry.get_scaling())
+
+        save_scaler_stats(self.stats, self.path)
+        self.assertIsNotNone(registry.get_scaling())
+        self.assertFalse(registry.reload_if_changed())
+
+        # Recomputed statistics should be picked up by the running servers.
+        stats = ScalerStats(self.stats.min_height - 10, self.stats.max_height)
+        save_scaler_stats(stats, self.path)
+        os.utime(self.path, (0, 0))
+
+        self.assertTrue(registry.reload_if_changed())
+        self.assertEqual(registry.get().min_height, self.stats.min_height - 10)
+        self.assertEqual(os.listdir(self.temp_dir), ["scaler_stats.npz"])
+
+class TestPairScoreCache(unittest.TestCase):
+    def setUp(self):
+        self.pool = mock_candidate_pool()
+        self.username = self.pool["username"][-1]
+        self.candidates = self.pool.exclude(self.username)
+        self.current_user = self.pool.take(np.array([len(self.pool) - 1]))
+
+        self.feature_space = FeatureSpace(fit_feature_vectorizers(self.pool))
+        self.user_features = build_features(self.feature_space, self.candidates, self.current_user)
+        self.versions = np.arange(1, len(self.candidates) + 1, dtype=np.int64)
+
+    def test_lookup(self):
+        cache = PairScoreCache()
+        usernames = np.array(["b", "a", "c"])
+        scores = np.arange(15, dtype=np.float64).reshape(3, 5)
+
+        cache.store("viewer", 1, usernames, np.array([1, 1, 2]), scores)
+
+        out = np.zeros((4, 5))
+        hits = cache.lookup("viewer", 1, np.array(["a", "c", "d", "b"]), np.array([1, 1, 1, 1]), out)
+
+        # "c" changed since it was cached, and "d" was never cached.
+        self.assertEqual(hits.tolist(), [True, False, False, True])
+        self.assertTrue(np.array_equal(out[[0, 3]], scores[[1, 0]]))
+
+        # Nothing is cached for other versions of the viewer.
+        self.assertFalse(cache.lookup("viewer", 2, usernames, np.array([1, 1, 2]), out).any())
+        self.assertEqual((cache.metrics()["hits"], cache.metrics()["misses"]), (2, 5))
+
+    def test_eviction(self):
+        scores = np.zeros((10, 5))
+        usernames = np.array([f"user_{i}" for i in range(10)])
+        versions = np.ones(10, dtype=np.int64)
+
+        cache = PairScoreCache(max_bytes=1)
+        cache.store("viewer", 1, usernames, versions, scores)
+        self.assertEqual(len(cache), 0)
+
+        cache = PairScoreCache()
+        cache.store("viewer_0", 1, usernames, versions, scores)
+        cache.max_bytes = 3 * cache.nbytes
+
+        for viewer in ["viewer_1", "viewer_2"]:
+            cache.store(viewer, 1, usernames, versions, scores)
+
+        # Looking up viewer_0 makes viewer_1 the least recently used one.
+        cache.lookup("viewer_0", 1, usernames, versions, scores.copy())
+        cache.store("viewer_3", 1, usernames, versions, scores)
+
+        self.assertEqual(len(cache), 3)
+        self.assertLessEqual(cache.nbytes, cache.max_bytes)
+        self.assertFalse(cache.lookup("viewer_1", 1, usernames, versions, scores.copy()).any())
+        self.assertTrue(cache.lookup("viewer_0", 1, usernames, versions, scores.copy()).all())
+
+        cache.invalidate("viewer_0")
+        self.assertEqual(len(cache), 2)
+
+    # Cached scores should be the same as the ones scored from scratch, and
+    # pairs should be scored again once either of the two users changed.
+    def test_process_data(self):
+        expected = process_data(self.candidates, self.current_user, self.username, self.user_features)
+        cache = PairScoreCache()
+
+        with patch("models.ml_match_algo.pair_score_cache", cache):
+            for _ in range(2):
+                scores = process_data(self.candidates, self.current_user, self.username, self.user_features, (self.versions, 1))
+                self.assertTrue(np.array_equal(scores, expected))
+
+            self.assertEqual(cache.metrics()["hits"], len(self.candidates))
+
+            # The first candidate updated their profile to the same one as the
+            # current user.
+            users_matrix, users_heights, segment_matrix, current_user_height = self.user_features
+            updated_matrix = sp.vstack([self.feature_space.transform(self.current_user), users_matrix[1:]], format="csr")
+            updated_heights = np.concatenate([[current_user_height], users_heights[1:]])
+            updated_versions = self.versions.copy()
+            updated_versions[0] += 1
+
+            updated_features = (updated_matrix, updated_heights, segment_matrix, current_user_height)
+            expected = process_data(self.candidates, self.current_user, self.username, updated_features)
+            scores = process_data(self.candidates, self.current_user, self.username, updated_features, (updated_versions, 1))
+
+            self.assertTrue(np.array_equal(scores, expected))
+            self.assertEqual(scores[0, 1], 1.)
+
+            # Rows without a version yet are never cached.
+            process_data(self.candidates, self.current_user, self.username, self.user_features, (self.versions, -1))
+            self.assertEqual(cache.metrics()["viewers"], 1)
+
+# Cursor returning the photos of the users it's asked for, recording every query.
+class MockPhotoCursor:
+    def __init__(self, photos: dict[str, str]):
+        self.photos = photos
+        self.queries: list[tuple[str, list]] = []
+
+    def execute(self, statement: str, params: list) -> None:
+        self.queries.append((statement, params))
+        self.records = [(username, bytes(self.photos[username], 'utf-8')) for username in params[0] if username in self.photos]
+
+    def fetchall(self) -> list:
+        return self.records
+
+class TestPhotoHydration(unittest.TestCase):
+    def setUp(self):
+        self.profiles = [{key: value for key, value in profile.items() if key != "uri"} for profile in MockProfiles().mock_user_profiles]
+        self.photos = {profile["username"]: f"photo_of_{profile['username']}" for profile in self.profiles[1:]}
+
+    # The candidates should be loaded without their photos.
+    def test_metadata_columns(self):
+        self.assertNotIn("uri", PROFILE_METADATA_COLUMNS)
+        self.assertIn("username", PROFILE_METADATA_COLUMNS)
+
+    # The photos of a whole page should be loaded with a single query.
+    def test_hydrate_photos(self):
+        cursor = MockPhotoCursor(self.photos)
+        page = self.profiles[0:3]
+        hydrated = hydrate_photos(cursor, page)
+
+        self.assertEqual(len(cursor.queries), 1)
+        self.assertEqual(cursor.queries[0][1], [[profile["username"] for profile in page]])
+
+        # Users without a photo get None.
+        self.assertEqual([profile["uri"] for profile in hydrated], [None] + [self.photos[profile["username"]] for profile in page[1:]])
+        self.assertEqual([profile["username"] for profile in hydrated], [profile["username"] for profile in page])
+
+        # The profiles of the page are left without their photos.
+        self.assertTrue(all("uri" not in profile for profile in page))
+
+    def test_empty_page(self):
+        cursor = MockPhotoCursor(self.photos)
+
+        self.assertEqual(hydrate_photos(cursor, []), [])
+        self.assertEqual(cursor.queries, [])
+
+# Cursor returning the rows of get_match_candidates, recording every query.
+class MockMatchCandidatesCursor(MockCursor):
+    def __init__(self, viewer: dict[str, any], candidates: list[dict[str, any]]):
+        columns = ["is_viewer"] + MATCH_CANDIDATE_COLUMNS
+        records = [(True,) + tuple(viewer.get(column) for column in MATCH_CANDIDATE_COLUMNS)]
+        records += [(False,) + tuple(candidate.get(column, 0 if column == "visits" else None) for column in MATCH_CANDIDATE_COLUMNS) for candidate in candidates]
+
+        super().__init__(columns, records)
+        self.queries: list[tuple[str, list]] = []
+        self.batch_sizes: list[int] = []
+        self.closed = False
+
+    def execute(self, statement: str, params: list) -> None:
+        self.queries.append((statement, params))
+
+    def fetchmany(self, size: int) -> list:
+        self.batch_sizes.append(size)
+        return super().fetchmany(size)
+
+    def close(self) -> None:
+        self.closed = True
+
+class TestMatchCandidates(unittest.TestCase):
+    def setUp(self):
+        profiles = MockProfiles()
+        self.viewer = {key: value for key, value in profiles.mock_current_user_profile[0].items() if key != "uri"}
+        self.candidates = [{key: value for key, value in profile.items() if key != "uri"} for profile in profiles.mock_user_profiles]
+
+    # The candidates and the current user should be loaded with a single query.
+    def test_load_match_candidates(self):
+        cursor = MockMatchCandidatesCursor(self.viewer, self.candidates)
+        candidates, current_user = load_match_candidates(cursor, self.viewer["username"])
+
+        self.assertEqual(len(cursor.queries), 1)
+        self.assertIn("get_match_candidates", cursor.queries[0][0])
+        self.assertEqual(cursor.queries[0][1], [self.viewer["username"]])
+
+        self.assertEqual(current_user["username"].tolist(), [self.viewer["username"]])
+        self.assertEqual(candidates["username"].tolist(), [candidate["username"] for candidate in self.candidates])
+        self.assertNotIn("is_viewer", candidates)
+
+    # load_data should build the same tables from the single query as it did
+    # from the four separate ones.
+    def test_load_data(self):
+        cursor = MockMatchCandidatesCursor(self.viewer, self.candidates)
+        candidates, current_user, user_profiles, logged_in_user_profile = load_data(self.viewer["username"], None, cursor)
+
+        self.assertEqual(len(cursor.queries), 1)
+        self.assertEqual(len(candidates), len(self.candidates))
+        self.assertIn("gender_bits", candidates)
+        self.assertEqual(current_user["interests"].tolist(), [self.viewer["interests"]])
+
+        for name in ["gender", "interested_in", "sexual_orientation"]:
+            self.assertEqual(logged_in_user_profile[name], self.viewer[name])
+
+        # The profiles are built without their photos.
+        profile = user_profiles.profile(user_profiles.row_id(self.candidates[1]["username"]))
+
+        self.assertNotIn("uri", profile)
+        self.assertEqual(profile["first_name"], self.candidates[1]["first_name"])
+        self.assertIn("age", profile)
+
+# Connection whose server-side cursors stream the rows of the given cursor.
+class MockStreamingConnection:
+    def __init__(self, stream: MockMatchCandidatesCursor):
+        self.stream = stream
+        self.cursor_names: list[str] = []
+        self.commits = 0
+        self.closed = False
+
+    def cursor(self, name: str | None = None) -> MockMatchCandidatesCursor:
+        self.cursor_names.append(name)
+        return self.stream
+
+    def commit(self) -> None:
+        self.commits += 1
+
+    def close(self) -> None:
+        self.closed = True
+
+class TestStreamingMatch(unittest.TestCase):
+    def setUp(self):
+        profiles = MockProfiles()
+        self.viewer = {key: value for key, value in profiles.mock_current_user_profile[0].items() if key != "uri"}
+        self.candidates = [{key: value for key, value in profile.items() if key != "uri"} for profile in profiles.mock_user_profiles]
+        self.feature_space = FeatureSpace(fit_feature_vectorizers(mock_candidate_pool()))
+
+    # Runs the streaming mode with the feature rows built from the profiles
+    # instead of being gathered from the feature store.
+    def run_streaming(self, use_so_filter: bool, top_k: int | None, itersize: int) -> tuple[list[dict[str, any]], MockMatchCandidatesCursor, MockStreamingConnection]:
+        stream = MockMatchCandidatesCursor(self.viewer, self.candidates)
+        db = MockStreamingConnection(stream)
+
+        def load_features(cursor, feature_space, profiles):
+            return feature_space.transform(profiles), height_inches(profiles)
+
+        with patch.object(ml_streaming_match.vectorizer_registry, "get_feature_space", return_value=self.feature_space), \
+             patch.object(ml_streaming_match, "load_user_features", load_features):
+            matches = run_streaming_algorithm(self.viewer["username"], MockMatchCandidatesCursor(self.viewer, []), db,
+                                              use_so_filter, top_k, itersize=itersize, backend="numpy")
+
+        return matches, stream, db
+
+    # Streaming the candidates in chunks should rank them the same way as
+    # scoring the whole pool at once.
+    def test_matches_whole_pool_ranking(self):
+        candidates, current_user = load_match_candidates(MockMatchCandidatesCursor(self.viewer, self.candidates), self.viewer["username"])
+        candidates = encode_orientations(candidates)
+        scores = process_data(candidates, current_user, self.viewer["username"], build_features(self.feature_space, candidates, current_user))
+
+        for use_so_filter, top_k in itertools.product([False, True], [3, None]):
+            eligible = filter_candidates(candidates, {name: self.viewer[name] for name in ["gender", "interested_in", "sexual_orientation"]}) if use_so_filter else None
+            ranked_users, _ = rank_candidates(scores, candidates["username"], eligible, top_k=top_k, backend="numpy")
+
+            matches, _, _ = self.run_streaming(use_so_filter, top_k, itersize=2)
+
+            self.assertEqual([match["username"] for match in matches], ranked_users)
+            self.assertTrue(all(column not in match for match in matches for column in SENSITIVE_COLUMNS))
+
+    # The candidates should be fetched from a server-side cursor, itersize rows
+    # at a time, which is closed along with the connection.
+    def test_server_side_cursor(self):
+        _, stream, db = self.run_streaming(False, 3, itersize=2)
+
+        self.assertIsNotNone(db.cursor_names[0])
+        self.assertEqual(stream.itersize, 2)
+        self.assertEqual(set(stream.batch_sizes), {2})
+        # The current user and the candidates, followed by the empty batch that
+        # ends the stream.
+        self.assertEqual(len(stream.batch_sizes), (len(self.candidates) + 2) // 2 + 1)
+        self.assertTrue(stream.closed and db.closed)
+        self.assertEqual(db.commits, 1)
+
+    # Only the profiles of the running top k should be kept.
+    def test_running_top_k(self):
+        ranking = StreamingTopK(2, False)
+        profiles = ProfileTable({"username": np.array(["a", "b", "c"], dtype=object)})
+
+        ranking.push(np.array([1., 3., 2.]), np.arange(3), profiles)
+        ranking.push(np.array([4.]), np.array([3]), ProfileTable({"username": np.array(["d"], dtype=object)}))
+
+        self.assertEqual(sorted(ranking.profiles), [1, 3])
+        self.assertEqual([profile["username"] for profile in ranking.result()], ["d", "b"])
+
+    # Every candidate should be ranked if none of them pass the sexual
+    # orientation filter.
+    def test_no_eligible_candidates(self):
+        ranking = StreamingTopK(2, True)
+        profiles = ProfileTable({"username": np.array(["a", "b", "c"], dtype=object)})
+
+        ranking.push(np.array([1., 3., 2.]), np.arange(3), profiles, np.zeros(3, dtype=bool))
+        self.assertEqual([profile["username"] for profile in ranking.result()], ["b", "c"])
+
+        ranking.push(np.array([0.]), np.array([3]), ProfileTable({"username": np.array(["d"], dtype=object)}), np.ones(1, dtype=bool))
+        self.assertEqual([profile["username"] for profile in ranking.result()], ["d"])
+
+# Connection to a database that can be dropped, in the same way as a psycopg2
+# connection.
+class MockConnection:
+    def __init__(self, dsn: str | None):
+        self.dsn = dsn
+        self.closed = 0
+        self.dropped = False
+        self.rollbacks = 0
+        self.status = psycopg2.extensions.TRANSACTION_STATUS_IDLE
+
+    def cursor(self) -> "MockConnectionCursor":
+        return MockConnectionCursor(self)
+
+    def get_transaction_status(self) -> int:
+        return self.status
+
+    def rollback(self) -> None:
+        self.rollbacks += 1
+        self.status = psycopg2.extensions.TRANSACTION_STATUS_IDLE
+
+    def close(self) -> None:
+        self.closed = 1
+
+class MockConnectionCursor:
+    def __init__(self, db: MockConnection):
+        self.db = db
+
+    def execute(self, statement: str) -> None:
+        if self.db.dropped:
+            raise psycopg2.OperationalError("server closed the connection unexpectedly")
+
+        self.db.status = psycopg2.extensions.TRANSACTION_STATUS_INTRANS
+
+    def close(self) -> None:
+        pass
+
+class TestConnectionPool(unittest.TestCase):
+    def pool(self, **kwargs) -> ConnectionPool:
+        options = {"dsn": "test", "min_size": 1, "max_size": 2, "connect": MockConnection}
+        options.update(kwargs)
+
+        return ConnectionPool(**options)
+
+    # Connections should be reused instead of opened for every request.
+    def test_reuse(self):
+        pool = self.pool()
+        pool.open()
+
+        db = pool.acquire()
+        pool.release(db)
+
+        self.assertIs(pool.acquire(), db)
+        self.assertEqual(pool.metrics()["opened"], 1)
+        self.assertEqual(pool.metrics()["acquired"], 2)
+
+    # Requests should wait for a connection once max_size of them are in use,
+    # and give up after the timeout.
+    def test_max_size(self):
+        pool = self.pool()
+        connections = [pool.acquire(), pool.acquire()]
+
+        with self.assertRaises(PoolTimeoutError):
+            pool.acquire(timeout=0.01)
+
+        threading.Timer(0.05, pool.release, [connections[0]]).start()
+
+        self.assertIs(pool.acquire(timeout=5), connections[0])
+        self.assertEqual(pool.metrics()["timeouts"], 1)
+        self.assertEqual(pool.metrics()["connections"], 2)
+        self.assertGreater(pool.metrics()["max_acquire_seconds"], 0)
+
+    # Whatever a request left uncommitted should be rolled back.
+    def test_release_rolls_back(self):
+        pool = self.pool()
+        db = pool.acquire()
+        db.cursor().execute("UPDATE Profiles SET interests='' WHERE username='user'")
+
+        pool.release(db)
+
+        self.assertEqual(db.rollbacks, 1)
+        self.assertIs(pool.acquire(), db)
+
+    # Connections that were dropped should be replaced before they are handed out.
+    def test_health_check(self):
+        pool = self.pool(health_check_interval=0)
+        db = pool.acquire()
+        pool.release(db)
+
+        # Connections that are still alive are handed out as they are.
+        self.assertIs(pool.acquire(), db)
+        pool.release(db)
+
+        db.dropped = True
+        new_db = pool.acquire()
+
+        self.assertIsNot(new_db, db)
+        self.assertTrue(db.closed)
+        self.assertEqual(pool.metrics()["failed_health_checks"], 1)
+        self.assertEqual(pool.metrics()["connections"], 1)
+
+    def test_max_lifetime(self):
+        pool = self.pool(max_lifetime=0)
+        db = pool.acquire()
+        pool.release(db)
+
+        self.assertTrue(db.closed)
+        self.assertIsNot(pool.acquire(), db)
+        self.assertEqual(pool.metrics()["discarded"], 1)
+
+    # Connections that didn't come from the pool should simply be closed.
+    def test_foreign_connection(self):
+        pool = self.pool()
+        db = MockConnection("test")
+        pool.release(db)
+
+        self.assertTrue(db.closed)
+        self.assertEqual(pool.metrics()["idle"], 0)
+
+    def test_close(self):
+        pool = self.pool(min_size=2)
+        pool.open()
+        db = pool.acquire()
+        pool.close()
+
+        self.assertEqual(pool.metrics()["idle"], 0)
+
+        with self.assertRaises(PoolTimeoutError):
+            pool.acquire()
+
+        # Connections still in use are closed once they are handed back.
+        pool.release(db)
+        self.assertTrue(db.closed)
+        self.assertEqual(pool.metrics()["connections"], 0)
+
+# Cursor of a blocking driver, which records the threads its statements run in.
+class MockBlockingCursor:
+    def __init__(self):
+        self.threads: list[str] = []
+        self.rows: list[tuple] = []
+        self.description = [("username",)]
+
+    def execute(self, statement: str, params: list | None = None) -> None:
+        self.threads.append(threading.current_thread().name)
+        time.sleep(0.1)
+        self.rows = [(username,) for username in params]
+
+    def fetchall(self) -> list[tuple]:
+        return self.rows
+
+    def __iter__(self):
+        return iter(self.rows)
+
+class MockBlockingConnection:
+    DatabaseError = psycopg2.DatabaseError
+
+    def __init__(self):
+        self.raw_cursor = MockBlockingCursor()
+        self.commits = 0
+
+    def cursor(self) -> MockBlockingCursor:
+        return self.raw_cursor
+
+    def commit(self) -> None:
+        self.commits += 1
+
+class TestAsyncDatabase(unittest.TestCase):
+    # Statements should run in the database threads, and the event loop should
+    # keep running other tasks in the meantime.
+    def test_execute_does_not_block(self):
+        async def run() -> tuple[list[tuple], int, AsyncConnection]:
+            db = AsyncConnection(MockBlockingConnection())
+            cursor = db.cursor()
+            ticks = 0
+
+            async def tick():
+                nonlocal ticks
+
+                while True:
+                    ticks += 1
+                    await asyncio.sleep(0.01)
+
+            ticker = asyncio.create_task(tick())
+            await cursor.execute("SELECT username FROM Users WHERE username IN (%s, %s)", ["a", "b"])
+            await db.commit()
+            ticker.cancel()
+
+            return cursor.fetchall(), ticks, db
+
+        rows, ticks, db = asyncio.run(run())
+
+        self.assertEqual(rows, [("a",), ("b",)])
+        self.assertGreater(ticks, 1)
+        self.assertTrue(db.raw.raw_cursor.threads[0].startswith("db"))
+        self.assertEqual(db.raw.commits, 1)
+
+    # Everything else should be the same as with the psycopg2 cursor and connection.
+    def test_delegation(self):
+        db = AsyncConnection(MockBlockingConnection())
+        cursor = db.cursor()
+        asyncio.run(cursor.execute("SELECT username FROM Users WHERE username = %s", ["a"]))
+
+        self.assertIsInstance(cursor, AsyncCursor)
+        self.assertEqual(list(cursor), [("a",)])
+        self.assertEqual(cursor.description, [("username",)])
+        self.assertIs(db.DatabaseError, psycopg2.DatabaseError)
+
+    # Functions taking the psycopg2 cursor should be given the raw cursor.
+    def test_run(self):
+        db = AsyncConnection(MockBlockingConnection())
+        cursor = db.cursor()
+
+        def count(raw_cursor: MockBlockingCursor, *usernames: str) -> int:
+            raw_cursor.execute("SELECT username FROM Users WHERE username = ANY(%s)", list(usernames))
+            return len(raw_cursor.fetchall())
+
+        self.assertEqual(asyncio.run(cursor.run(count, "a", "b", "c")), 3)
+        self.assertTrue(cursor.raw.threads[0].startswith("db"))
+
 class TestRating(unittest.TestCase):
     # Test the happy paths of the rating system.
     def test_change_rating(self):
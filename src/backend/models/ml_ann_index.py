@@ -0,0 +1,291 @@
+# Approximate nearest-neighbour (ANN) index over the normalized interest
+# vectors of every user.
+#
+# The index is an inverted file (IVF): the interest vectors are clustered
+# with spherical k-means, and every user is stored in the list of the
+# centroid closest to them. A search only scores the users in the few lists
+# whose centroids are closest to the query, so finding the top-K most
+# similar users no longer requires a dot product with every candidate.
+
+from sklearn.preprocessing import normalize
+import scipy.sparse as sp
+import numpy as np
+import psycopg2
+import threading
+import os
+
+from .ml_feature_fitting import FeatureSpace
+from .ml_feature_store import decode_feature_row, stack_feature_rows
+from .ml_candidates import CandidateTable
+
+# Candidate pools smaller than this are scored in full. For larger ones, only
+# the ANN_CANDIDATE_LIMIT users whose interests are the most similar to those
+# of the current user are passed on to the rest of the matching algorithm.
+ANN_MIN_POOL_SIZE = int(os.environ.get("ANN_MIN_POOL_SIZE", 5000))
+ANN_CANDIDATE_LIMIT = int(os.environ.get("ANN_CANDIDATE_LIMIT", 2000))
+
+class InterestIndex:
+    def __init__(self, num_columns: int, num_probes: int = 8, num_iterations: int = 10, seed: int = 0):
+        self.num_columns = num_columns
+        self.num_probes = num_probes
+        self.num_iterations = num_iterations
+        self.seed = seed
+
+        self.centroids: np.ndarray = np.zeros((1, num_columns))
+
+        # Vectors of every user and the list each of them is stored in.
+        self.vectors: dict[str, sp.csr_matrix] = {}
+        self.assignments: dict[str, int] = {}
+
+        # Usernames stored in each list, along with the matrix of their vectors,
+        # which is rebuilt lazily after users are inserted into or deleted from it.
+        self.lists: list[dict[str, None]] = [{}]
+        self._list_matrices: list[tuple[list[str], sp.csr_matrix] | None] = [None]
+
+        # Number of users the centroids were trained on.
+        self._trained_size = 0
+
+    def __len__(self) -> int:
+        return len(self.vectors)
+
+    # Clusters the given vectors into roughly sqrt(N) lists.
+    def build(self, usernames: list[str], matrix: sp.csr_matrix) -> None:
+        matrix = sp.csr_matrix(matrix)
+        num_lists = max(1, int(np.sqrt(len(usernames))))
+
+        if len(usernames) > 0:
+            # Initialize the centroids with randomly chosen vectors, and then
+            # refine them with spherical k-means.
+            rng = np.random.default_rng(self.seed)
+            initial_rows = rng.choice(len(usernames), size=num_lists, replace=False)
+            centroids = matrix[initial_rows].toarray()
+
+            for _ in range(self.num_iterations):
+                assignments = np.asarray((matrix @ centroids.T).argmax(axis=1)).reshape(-1)
+                membership = sp.csr_matrix((np.ones(len(usernames)), (assignments, np.arange(len(usernames)))),
+                                           shape=(num_lists, len(usernames)))
+                new_centroids = normalize(np.asarray((membership @ matrix).todense()))
+
+                # Keep the previous centroid of any list that ended up empty.
+                empty_lists = np.asarray(membership.sum(axis=1)).reshape(-1) == 0
+                new_centroids[empty_lists] = centroids[empty_lists]
+                centroids = new_centroids
+
+            self.centroids = centroids
+        else:
+            self.centroids = np.zeros((1, self.num_columns))
+
+        self.vectors = {}
+        self.assignments = {}
+        self.lists = [{} for _ in range(len(self.centroids))]
+        self._list_matrices = [None] * len(self.centroids)
+        self._trained_size = len(usernames)
+
+        for i, username in enumerate(usernames):
+            self.add(username, matrix[i])
+
+    # Inserts a user into the list of their closest centroid, replacing them if
+    # they were already in the index.
+    def add(self, username: str, vector: sp.csr_matrix) -> None:
+        self.remove(username)
+
+        vector = sp.csr_matrix(vector)
+        list_id = int(np.argmax(vector @ self.centroids.T))
+
+        self.vectors[username] = vector
+        self.assignments[username] = list_id
+        self.lists[list_id][username] = None
+        self._list_matrices[list_id] = None
+
+        # Retrain the centroids once the index has doubled in size since they
+        # were trained, so that the lists stay balanced.
+        if len(self.vectors) > max(2 * self._trained_size, 64):
+            self.rebuild()
+
+    def remove(self, username: str) -> None:
+        list_id = self.assignments.pop(username, None)
+
+        if list_id is not None:
+            del self.vectors[username]
+            del self.lists[list_id][username]
+            self._list_matrices[list_id] = None
+
+    def rebuild(self) -> None:
+        usernames = list(self.vectors.keys())
+        matrix = sp.vstack([self.vectors[username] for username in usernames], format="csr") if usernames else sp.csr_matrix((0, self.num_columns))
+        self.build(usernames, matrix)
+
+    def _list_matrix(self, list_id: int) -> tuple[list[str], sp.csr_matrix]:
+        if self._list_matrices[list_id] is None:
+            usernames = list(self.lists[list_id].keys())
+            matrix = sp.vstack([self.vectors[username] for username in usernames], format="csr") if usernames else sp.csr_matrix((0, self.num_columns))
+            self._list_matrices[list_id] = (usernames, matrix)
+
+        return self._list_matrices[list_id]
+
+    # Returns up to k (username, similarity) pairs of the users whose vectors are
+    # the most similar to the query, from most to least similar. If allowed is
+    # given, only the users in it are returned, and more lists are probed (from
+    # the closest to the farthest) until k of them were found or every list was
+    # probed, as the allowed users (e.g. the users of a region) may be spread
+    # over lists that are farther from the query.
+    def search(self, query: sp.csr_matrix, k: int, allowed: set[str] | None = None) -> list[tuple[str, float]]:
+        query = sp.csr_matrix(query)
+
+        # Probe the lists whose centroids are the most similar to the query.
+        centroid_sims = np.asarray(query @ self.centroids.T).reshape(-1)
+        num_probes = min(self.num_probes, len(centroid_sims))
+        ranked_lists = np.argsort(-centroid_sims, kind="stable")
+
+        usernames: list[str] = []
+        similarities: list[np.ndarray] = []
+
+        for num_probed, list_id in enumerate(ranked_lists):
+            if num_probed >= num_probes and (allowed is None or len(usernames) >= k):
+                break
+
+            list_usernames, matrix = self._list_matrix(list_id)
+
+            if not list_usernames:
+                continue
+
+            list_similarities = (matrix @ query.T).toarray().reshape(-1)
+
+            if allowed is not None:
+                mask = np.fromiter((username in allowed for username in list_usernames), dtype=bool, count=len(list_usernames))
+                list_usernames = [username for username, keep in zip(list_usernames, mask) if keep]
+                list_similarities = list_similarities[mask]
+
+            usernames.extend(list_usernames)
+            similarities.append(list_similarities)
+
+        if not usernames:
+            return []
+
+        similarities = np.concatenate(similarities)
+        order = np.argsort(-similarities, kind="stable")[0:k]
+
+        return [(usernames[i], float(similarities[i])) for i in order]
+
+# Interest vectors of a matrix of feature rows (see FeatureSpace).
+def interest_vectors(feature_space: FeatureSpace, matrix: sp.csr_matrix) -> sp.csr_matrix:
+    return matrix[:, int(feature_space.offsets[0]):int(feature_space.offsets[1])]
+
+# Process-wide interest index, built from the feature store the first time it
+# is needed and then kept in sync with it incrementally, by applying the rows
+# that were written or deleted since the last time it was synced.
+#
+# Rows are synced on the id of the transaction that last wrote them (see
+# change_txid in sql/user_features.sql), rather than on the time they were
+# written, as transactions don't commit in the order they started. Each sync
+# first reads the oldest transaction still in progress (the xmin of the
+# snapshot): every transaction before it has committed (or rolled back) by
+# then, so the next sync only has to read the rows written by it or by later
+# transactions. Rows may be read more than once, which is harmless, as the
+# index keeps the id of the transaction it applied for each user and skips
+# the ones that are not newer.
+#
+# Deleted users are read from User_Feature_Deletions, which is filled in by a
+# trigger whenever a row is deleted (e.g. along with the user's account).
+class InterestIndexRegistry:
+    def __init__(self):
+        self._index: InterestIndex | None = None
+        self._feature_space_id: str | None = None
+        self._synced_txid: int | None = None
+        self._applied_txids: dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def get(self, cursor: psycopg2.extensions.cursor, feature_space: FeatureSpace) -> InterestIndex:
+        with self._lock:
+            # Start over if the vectorizers were refitted.
+            if self._index is None or self._feature_space_id != feature_space.id:
+                self._index = InterestIndex(int(feature_space.offsets[1] - feature_space.offsets[0]))
+                self._feature_space_id = feature_space.id
+                self._synced_txid = None
+                self._applied_txids = {}
+
+            index, synced_txid = self._index, self._synced_txid
+
+        # The rows are read outside of the lock, so that concurrent requests
+        # don't wait on each other's round trips to the database.
+        cursor.execute("SELECT txid_snapshot_xmin(txid_current_snapshot())")
+        xmin = cursor.fetchone()[0]
+
+        # Deleted users come first within the same transaction, in case they
+        # were deleted and then inserted again. Their features are NULL.
+        statement = '''
+            SELECT username, features, change_txid FROM User_Features
+            WHERE feature_space_id=%s AND (%s::BIGINT IS NULL OR change_txid >= %s)
+            UNION ALL
+            SELECT username, NULL, change_txid FROM User_Feature_Deletions
+            WHERE %s::BIGINT IS NOT NULL AND change_txid >= %s
+            ORDER BY 3, 2 NULLS FIRST
+        '''
+        cursor.execute(statement, [feature_space.id, synced_txid, synced_txid, synced_txid, synced_txid])
+        records = cursor.fetchall()
+
+        with self._lock:
+            # The index was replaced in the meantime, as the vectorizers were
+            # refitted.
+            if self._index is not index:
+                return self._index
+
+            # Skip the changes that were already applied, e.g. by a request that
+            # synced the index in the meantime.
+            records = [record for record in records if record[2] > self._applied_txids.get(record[0], -1)]
+            rows = [record for record in records if record[1] is not None]
+
+            usernames = [record[0] for record in rows]
+            matrix = stack_feature_rows([decode_feature_row(bytes(record[1])) for record in rows],
+                                        feature_space.num_columns)
+            vectors = interest_vectors(feature_space, matrix)
+
+            # The first sync reads every row and no deletions.
+            if self._synced_txid is None:
+                self._index.build(usernames, vectors)
+            else:
+                row_id = 0
+
+                for username, features, _ in records:
+                    if features is None:
+                        self._index.remove(username)
+                    else:
+                        self._index.add(username, vectors[row_id])
+                        row_id += 1
+
+            for record in records:
+                self._applied_txids[record[0]] = record[2]
+
+            self._synced_txid = xmin if self._synced_txid is None else max(self._synced_txid, xmin)
+
+            return self._index
+
+# Registry shared by every request in the current process.
+interest_index_registry = InterestIndexRegistry()
+
+# Narrows a large candidate pool down to the users whose interests are the most
+# similar to those of the current user. Smaller pools are returned as they are.
+def select_candidates(candidates: CandidateTable,
+                      current_user: CandidateTable,
+                      feature_space: FeatureSpace,
+                      cursor: psycopg2.extensions.cursor,
+                      min_pool_size: int = ANN_MIN_POOL_SIZE,
+                      candidate_limit: int = ANN_CANDIDATE_LIMIT) -> CandidateTable:
+    if len(candidates) < min_pool_size:
+        return candidates
+
+    index = interest_index_registry.get(cursor, feature_space)
+    query = interest_vectors(feature_space, feature_space.transform(current_user))
+    neighbours = index.search(query, candidate_limit, allowed=set(candidates["username"]))
+
+    # Fewer neighbours are found if some of the candidates are missing from the
+    # index (e.g. the feature store has not been filled in yet), in which case
+    # the pool is scored in full rather than silently cut down to them.
+    if len(neighbours) < candidate_limit:
+        return candidates
+
+    # Keep the order of the original pool so that the rest of the algorithm
+    # behaves the same way it does for smaller pools.
+    selected = {username for username, _ in neighbours}
+
+    return candidates.take(np.flatnonzero([username in selected for username in candidates["username"]]))
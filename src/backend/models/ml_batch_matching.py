@@ -0,0 +1,206 @@
+# Batch matching API.
+#
+# Ranks the candidates of many users at once, e.g. for the batch
+# recommendation job (see ml_precomputed_matches.py) or to warm up caches.
+# Instead of loading the candidate pool of every user on their own, the
+# profiles of every candidate are loaded (and their feature rows gathered)
+# once, along with the list of candidates of each user. The text features of
+# a whole block of users are then scored against the pool with a single
+# sparse matrix-matrix product, and the block is sent through the model in
+# one pass.
+#
+# Unlike run_algorithm, the candidate pools are not narrowed down with the
+# interest index, as the batch is meant to rank every candidate.
+
+import psycopg2
+import numpy as np
+import scipy.sparse as sp
+import os
+
+from .ml_candidates import CandidateTable, load_candidate_table, fetch_columns, height_inches
+from .ml_feature_fitting import FeatureSpace, vectorizer_registry, fit_feature_vectorizers
+from .ml_feature_store import load_user_features
+from .ml_inference import predict_in_chunks, DEFAULT_PREDICT_CHUNK_SIZE
+from .ml_orientation import encode_orientations, orientation_mask
+from .ml_ranking import TopKSelector, RECOMMENDATION_LIMIT
+from .ml_scoring import get_scoring_kernel
+from .ml_scaler_stats import scaler_stats_registry
+from .ml_match_algo import SCORE_COLUMNS
+from class_models import model_registry
+
+# Maximum number of dot products held in memory at once. The users of a batch
+# are scored in blocks small enough for the dot products of the whole block
+# with the pool to fit in it.
+BATCH_MAX_DOT_PRODS = int(os.environ.get("BATCH_MAX_DOT_PRODS", 2 ** 24))
+
+# Number of text features scored by the segment matrix of each user.
+NUM_TEXT_FEATURES = 4
+
+# Candidates of each of the given users, in the same order as
+# retrieve_possible_matches returns them, along with the number of visits of
+# each candidate. The users are excluded from their own candidates.
+def load_candidate_lists(cursor: psycopg2.extensions.cursor,
+                         usernames: list[str]) -> dict[str, tuple[np.ndarray, np.ndarray]]:
+    statement = '''
+        SELECT U.username AS viewer, M.username, M.visits
+        FROM unnest(%s::text[]) WITH ORDINALITY AS U(username, position)
+        CROSS JOIN LATERAL retrieve_possible_matches(U.username) WITH ORDINALITY AS M
+        ORDER BY U.position, M.ordinality
+    '''
+    cursor.execute(statement, [usernames])
+    columns = fetch_columns(cursor)
+
+    viewers, candidates, visits = columns["viewer"], columns["username"], columns["visits"]
+    candidate_lists: dict[str, tuple[np.ndarray, np.ndarray]] = {
+        username: (np.empty(0, dtype=object), np.empty(0, dtype=np.float64)) for username in usernames
+    }
+
+    # The candidates of each user are returned next to each other.
+    starts = np.flatnonzero(np.concatenate([[True], viewers[1:] != viewers[:-1]])) if len(viewers) > 0 else []
+    ends = np.append(starts[1:], len(viewers))
+
+    for start, end in zip(starts, ends):
+        username = viewers[start]
+        rows = start + np.flatnonzero(candidates[start:end] != username)
+        candidate_lists[username] = (candidates[rows], visits[rows])
+
+    return candidate_lists
+
+# Loads the profiles of the given users (the pool shared by every user of the
+# batch), with their gender and gender interests encoded for the sexual
+# orientation filter.
+def load_candidate_pool(cursor: psycopg2.extensions.cursor, usernames: list[str]) -> CandidateTable:
+    statement = '''
+        SELECT username, interests, height, height_inches, gender,
+        sexual_orientation, interested_in, state_residence, city_residence,
+        relationship_status FROM Profiles
+        WHERE username = ANY(%s)
+    '''
+    cursor.execute(statement, [usernames])
+
+    return encode_orientations(load_candidate_table(cursor).fill_missing())
+
+# Feature rows and heights of every user of the pool. They are gathered from
+# the feature store, or built from the profiles with vectorizers fitted on the
+# pool if the vectorizers have not been fitted yet. In that case, the scores
+# differ slightly from those of run_algorithm, which fits them on the
+# candidates of each user instead.
+def load_pool_features(pool: CandidateTable,
+                       db: psycopg2.extensions.connection,
+                       cursor: psycopg2.extensions.cursor) -> tuple[FeatureSpace, sp.csr_matrix, np.ndarray]:
+    feature_space = vectorizer_registry.get_feature_space()
+
+    if feature_space is None:
+        feature_space = FeatureSpace(fit_feature_vectorizers(pool))
+        return feature_space, feature_space.transform(pool), height_inches(pool)
+
+    users_matrix, users_heights = load_user_features(cursor, feature_space, pool)
+
+    # Commit the rows that were missing from the feature store.
+    db.commit()
+
+    return feature_space, users_matrix, users_heights
+
+# Ranks the candidates of every given user for each of the given settings of the
+# sexual orientation filter.
+#
+# Returns the usernames of the top k candidates of each user (or of all of them,
+# if k is None) from most to least similar, along with their scores as
+# percentages, keyed by the username and then by the setting of the filter.
+# Users that are not in the pool get empty lists.
+def rank_users(usernames: list[str],
+               pool: CandidateTable,
+               feature_space: FeatureSpace,
+               users_matrix: sp.csr_matrix,
+               users_heights: np.ndarray,
+               candidate_lists: dict[str, tuple[np.ndarray, np.ndarray]],
+               use_so_filters: list[bool] = [False, True],
+               top_k: int | None = RECOMMENDATION_LIMIT,
+               predict_chunk_size: int = DEFAULT_PREDICT_CHUNK_SIZE) -> dict[str, dict[bool, tuple[list[str], np.ndarray]]]:
+    row_ids: dict[str, int] = {username: i for i, username in enumerate(pool["username"])}
+    empty = ([], np.empty(0))
+    rankings = {username: {use_so_filter: empty for use_so_filter in use_so_filters} for username in usernames}
+
+    scored_users = [username for username in usernames if username in row_ids and len(candidate_lists.get(username, empty)[0]) > 0]
+    block_size = max(1, BATCH_MAX_DOT_PRODS // (NUM_TEXT_FEATURES * max(len(pool), 1)))
+    scaling = scaler_stats_registry.get_scaling()
+
+    for start in range(0, len(scored_users), block_size):
+        block = scored_users[start:start + block_size]
+
+        # Score the text features of every user of the block against the whole
+        # pool in a single product, with their segment matrices side by side.
+        segment_matrices = sp.hstack([feature_space.segment_matrix(users_matrix[row_ids[username]]) for username in block], format="csr")
+        dot_prods = (users_matrix @ segment_matrices).toarray()
+
+        block_features: list[np.ndarray] = []
+        block_candidates: list[tuple[str, bool, np.ndarray, np.ndarray]] = []
+
+        for i, username in enumerate(block):
+            candidates, visits = candidate_lists[username]
+            rows = np.array([row_ids.get(candidate, -1) for candidate in candidates], dtype=np.int64)
+
+            # Candidates without a profile (e.g. that deleted their account in
+            # the meantime) are skipped.
+            found = np.flatnonzero(rows >= 0)
+            candidates, visits, rows = candidates[found], visits[found], rows[found]
+
+            scores = get_scoring_kernel().score_dot_prods(dot_prods[rows, i * NUM_TEXT_FEATURES:(i + 1) * NUM_TEXT_FEATURES],
+                                                          users_heights[rows],
+                                                          users_heights[row_ids[username]],
+                                                          visits,
+                                                          scaling=scaling)
+
+            # Drop the similarity score column before the scores are sent
+            # through the model.
+            features = scores[:, 0:SCORE_COLUMNS.index('similarity_score')].astype(np.float32)
+            current_user = {name: pool[name][row_ids[username]] for name in ["gender", "interested_in", "sexual_orientation"]}
+
+            for use_so_filter in use_so_filters:
+                if use_so_filter:
+                    eligible = orientation_mask(pool["gender_bits"][rows], pool["interest_bits"][rows], current_user)
+
+                    # Every user is kept if none of them pass the filter, the same
+                    # way as filter_matches does.
+                    eligible_ids = np.flatnonzero(eligible) if eligible.any() else np.arange(len(rows))
+                else:
+                    eligible_ids = np.arange(len(rows))
+
+                block_features.append(features[eligible_ids])
+                block_candidates.append((username, use_so_filter, candidates, eligible_ids))
+
+        # Send the candidates of the whole block through the model at once.
+        predictions = predict_in_chunks(model_registry.get(), np.concatenate(block_features), predict_chunk_size)
+        offset = 0
+
+        for username, use_so_filter, candidates, eligible_ids in block_candidates:
+            # Scores are rounded to percentages with 2 decimal places before
+            # they are ranked, the same way as in rank_candidates.
+            selector = TopKSelector(len(eligible_ids) if top_k is None else top_k)
+            selector.push(np.round(predictions[offset:offset + len(eligible_ids)] * np.float32(100), 2), eligible_ids)
+            offset += len(eligible_ids)
+
+            ranked_ids, ranked_scores = selector.result()
+            rankings[username][use_so_filter] = ([candidates[i] for i in ranked_ids], ranked_scores)
+
+    return rankings
+
+# Loads the candidate pool shared by the given users once and ranks the
+# candidates of each of them (see rank_users).
+def run_batch_algorithm(usernames: list[str],
+                        db: psycopg2.extensions.connection,
+                        cursor: psycopg2.extensions.cursor,
+                        use_so_filters: list[bool] = [False, True],
+                        top_k: int | None = RECOMMENDATION_LIMIT) -> dict[str, dict[bool, tuple[list[str], np.ndarray]]]:
+    candidate_lists = load_candidate_lists(cursor, usernames)
+
+    # The pool holds every candidate of every user, as well as the users themselves.
+    pool_usernames = set(usernames)
+
+    for candidates, _ in candidate_lists.values():
+        pool_usernames.update(candidates.tolist())
+
+    pool = load_candidate_pool(cursor, sorted(pool_usernames))
+    feature_space, users_matrix, users_heights = load_pool_features(pool, db, cursor)
+
+    return rank_users(usernames, pool, feature_space, users_matrix, users_heights, candidate_lists, use_so_filters, top_k)
@@ -0,0 +1,218 @@
+# Columnar storage of the candidates and profiles loaded by the matching
+# algorithm.
+#
+# Rows are streamed from the cursor in batches straight into one typed NumPy
+# array per column, instead of being turned into a DataFrame (and a nested
+# dictionary of profiles) on every request. Profiles are only turned into
+# dictionaries once they are returned to the user.
+
+import numpy as np
+import psycopg2
+
+from helpers.helper import retrieve_age
+from .ml_sim_calcs import parse_height_inches
+
+# Number of rows fetched from the cursor at a time.
+FETCH_BATCH_SIZE = 2000
+
+# Types of the columns that are not stored as Python objects (e.g. text).
+COLUMN_DTYPES = {
+    "visits": np.float64,
+    "height_inches": np.float64,
+    "rating": np.float64,
+    "is_viewer": np.bool_
+}
+
+# Streams the rows of the last query run by the cursor into one array per
+# column, keyed by the name of the column.
+def fetch_columns(cursor: psycopg2.extensions.cursor,
+                  batch_size: int = FETCH_BATCH_SIZE) -> dict[str, np.ndarray]:
+    names: list[str] = [column[0] for column in cursor.description]
+    dtypes = [np.dtype(COLUMN_DTYPES.get(name, object)) for name in names]
+    chunks: list[list[np.ndarray]] = [[] for _ in names]
+
+    while True:
+        records = cursor.fetchmany(batch_size)
+
+        if not records:
+            break
+
+        for chunk, values in zip(chunks, batch_columns(names, records).values()):
+            chunk.append(values)
+
+    return {
+        name: np.concatenate(chunk) if chunk else np.empty(0, dtype=dtype)
+        for name, dtype, chunk in zip(names, dtypes, chunks)
+    }
+
+# Turns a batch of rows into one typed array per column.
+def batch_columns(names: list[str], records: list[tuple]) -> dict[str, np.ndarray]:
+    columns: dict[str, np.ndarray] = {}
+
+    for name, values in zip(names, zip(*records)):
+        columns[name] = np.empty(len(values), dtype=np.dtype(COLUMN_DTYPES.get(name, object)))
+        columns[name][:] = values
+
+    return columns
+
+# Table of candidates (or of the current user), stored column by column.
+# Columns are accessed by name, the same way as the columns of a DataFrame.
+class CandidateTable:
+    def __init__(self, columns: dict[str, np.ndarray]):
+        self.columns = columns
+
+    def __len__(self) -> int:
+        return len(next(iter(self.columns.values()))) if self.columns else 0
+
+    def __getitem__(self, name: str) -> np.ndarray:
+        return self.columns[name]
+
+    def __setitem__(self, name: str, values: np.ndarray) -> None:
+        self.columns[name] = np.asarray(values)
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.columns
+
+    # Returns a new table with the given rows, in the given order.
+    def take(self, rows: np.ndarray) -> "CandidateTable":
+        return CandidateTable({name: values[rows] for name, values in self.columns.items()})
+
+    # Returns a new table without the rows of the given user.
+    def exclude(self, username: str) -> "CandidateTable":
+        return self.take(np.flatnonzero(self.columns["username"] != username))
+
+    # Replaces the missing values of every text column.
+    def fill_missing(self, value: str = "") -> "CandidateTable":
+        for values in self.columns.values():
+            if values.dtype == object:
+                values[np.array([v is None for v in values], dtype=bool)] = value
+
+        return self
+
+    # Stacks the rows of several tables, keeping only the columns they all share.
+    @staticmethod
+    def concat(tables: list["CandidateTable"]) -> "CandidateTable":
+        names = [name for name in tables[0].columns if all(name in table for table in tables)]
+        return CandidateTable({name: np.concatenate([table[name] for table in tables]) for name in names})
+
+def load_candidate_table(cursor: psycopg2.extensions.cursor) -> CandidateTable:
+    return CandidateTable(fetch_columns(cursor))
+
+# Streams the rows of the last query run by the cursor as one table per batch of
+# rows, so that only a single batch is held in memory at once (e.g. with a
+# server-side cursor, see ml_streaming_match.py).
+def iter_candidate_tables(cursor: psycopg2.extensions.cursor, batch_size: int = FETCH_BATCH_SIZE):
+    while True:
+        records = cursor.fetchmany(batch_size)
+
+        if not records:
+            break
+
+        # The columns of a server-side cursor are only described once its
+        # first rows were fetched.
+        yield CandidateTable(batch_columns([column[0] for column in cursor.description], records))
+
+# Heights of the profiles (a CandidateTable or a DataFrame) in inches. Profiles
+# whose height_inches column was not filled in yet have theirs parsed from their
+# height.
+def height_inches(profiles: CandidateTable) -> np.ndarray:
+    if "height_inches" in profiles:
+        heights = np.array(profiles["height_inches"], dtype=np.float64)
+    else:
+        heights = np.full(len(profiles), np.nan)
+
+    missing = np.isnan(heights)
+
+    if missing.any():
+        heights[missing] = [parse_height_inches(height) for height in np.asarray(profiles["height"], dtype=object)[missing]]
+
+    return heights
+
+# Columns of get_user_profiles loaded for the candidates. Their photos (the uri
+# column) are left out, as they are by far the largest column and only the
+# photos of the matches returned to the user are needed (see hydrate_photos).
+PROFILE_METADATA_COLUMNS = [
+    "username",
+    "first_name",
+    "middle_name",
+    "last_name",
+    "interests",
+    "height",
+    "gender",
+    "sexual_orientation",
+    "interested_in",
+    "state_residence",
+    "city_residence",
+    "relationship_status",
+    "birth_month",
+    "birth_date",
+    "birth_year",
+    "rating"
+]
+
+# Profiles of the candidates, as returned by get_user_profiles, stored column by
+# column. Each profile is identified by its integer row id, and is only turned
+# into a dictionary when it is returned to the user.
+class ProfileTable:
+    def __init__(self, columns: dict[str, np.ndarray]):
+        self.columns = columns
+        self.row_ids: dict[str, int] = {username: i for i, username in enumerate(columns.get("username", []))}
+
+    def __len__(self) -> int:
+        return len(self.row_ids)
+
+    def __contains__(self, username: str) -> bool:
+        return username in self.row_ids
+
+    def row_id(self, username: str) -> int:
+        return self.row_ids[username]
+
+    # Builds the profile of the user stored at the given row, along with the
+    # decoded URI of their profile picture and their age.
+    def profile(self, row_id: int) -> dict[str, any]:
+        profile = {name: values[row_id:row_id + 1].tolist()[0] for name, values in self.columns.items()}
+
+        if "uri" in profile and profile["uri"] is not None:
+            profile["uri"] = bytes(profile["uri"]).decode('utf-8')
+
+        if "birth_month" in profile:
+            profile["age"] = retrieve_age(profile["birth_month"], int(profile["birth_date"]), int(profile["birth_year"]))
+
+        return profile
+
+def load_profile_table(cursor: psycopg2.extensions.cursor) -> ProfileTable:
+    return ProfileTable(fetch_columns(cursor))
+
+# Columns of the candidates (and of the current user) loaded by the matching
+# algorithm from get_match_candidates (see sql/match_candidates.sql): their
+# profiles without their photos, along with their visits and their height in inches.
+MATCH_CANDIDATE_COLUMNS = PROFILE_METADATA_COLUMNS + ["visits", "height_inches"]
+
+# Loads the candidates of the given user along with the user themselves in a
+# single query. Returns the table of the candidates and the table (with a single
+# row, unless the user doesn't exist) of the user.
+def load_match_candidates(cursor: psycopg2.extensions.cursor, username: str) -> tuple[CandidateTable, CandidateTable]:
+    cursor.execute(f"SELECT is_viewer, {', '.join(MATCH_CANDIDATE_COLUMNS)} FROM get_match_candidates(%s)", [username])
+
+    rows = load_candidate_table(cursor)
+    is_viewer = rows.columns.pop("is_viewer")
+
+    return rows.take(np.flatnonzero(~is_viewer)), rows.take(np.flatnonzero(is_viewer))
+
+# Decoded URIs of the photos of the given users, keyed by their username, loaded
+# in a single query.
+def load_photos(cursor: psycopg2.extensions.cursor, usernames: list[str]) -> dict[str, str]:
+    if not usernames:
+        return {}
+
+    cursor.execute("SELECT username, uri FROM Photos WHERE username = ANY(%s)", [usernames])
+
+    return {username: bytes(uri).decode('utf-8') for username, uri in cursor.fetchall() if uri is not None}
+
+# Returns copies of the given profiles (loaded without their photos) with the
+# URI of their photo, or None if they don't have one. The profiles themselves
+# are left as they are, e.g. so that the ones stored in a match session stay small.
+def hydrate_photos(cursor: psycopg2.extensions.cursor, profiles: list[dict[str, any]]) -> list[dict[str, any]]:
+    photos = load_photos(cursor, [profile["username"] for profile in profiles])
+
+    return [{**profile, "uri": photos.get(profile["username"])} for profile in profiles]
@@ -0,0 +1,206 @@
+# Feature-fitting stage of the matching algorithm.
+#
+# Instead of fitting a new TF-IDF vectorizer on the candidate pool on every
+# request, the vocabularies and IDF weights of the text features are fitted
+# offline (or periodically) on every profile and saved to disk. At request
+# time, the matching algorithm then only has to call transform on them.
+#
+# To (re)fit the vectorizers, run the following command from the src/backend
+# directory:
+#
+#   python -m models.ml_feature_fitting
+
+from sklearn.feature_extraction.text import TfidfVectorizer
+from sklearn.preprocessing import normalize
+from dotenv import load_dotenv
+import scipy.sparse as sp
+import numpy as np
+import pandas as pd
+import psycopg2
+import threading
+import hashlib
+import joblib
+import os
+
+from .ml_sim_calcs import initialize_vectorizer, join_text_columns
+
+# Location of the fitted vectorizers. It can be overridden with the
+# FEATURE_VECTORIZERS_PATH environment variable.
+FEATURE_VECTORIZERS_PATH = os.environ.get(
+    "FEATURE_VECTORIZERS_PATH",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "feature_vectorizers.joblib")
+)
+
+# Text features that are vectorized by the matching algorithm.
+TEXT_FEATURES = ["interests", "sexual_orientation", "residence", "relationship_status"]
+
+# Builds the text of each feature the same way the similarity calculations in
+# ml_sim_calcs.py do, so that the fitted vocabularies line up with the text
+# they transform at request time.
+#
+# The profiles can either be a DataFrame or a CandidateTable (see ml_candidates.py).
+def build_feature_text(profiles: pd.DataFrame) -> dict[str, list[str]]:
+    return {
+        "interests": list(profiles["interests"]),
+        "sexual_orientation": join_text_columns([profiles["gender"], profiles["interested_in"]]),
+        "residence": join_text_columns([profiles["city_residence"], profiles["state_residence"]]),
+        "relationship_status": list(profiles["relationship_status"])
+    }
+
+def fit_feature_vectorizers(profiles: pd.DataFrame) -> dict[str, TfidfVectorizer]:
+    feature_text = build_feature_text(profiles)
+    vectorizers: dict[str, TfidfVectorizer] = {}
+
+    for feature in TEXT_FEATURES:
+        vectorizer = initialize_vectorizer()
+        vectorizer.fit(feature_text[feature])
+        vectorizers[feature] = vectorizer
+
+    return vectorizers
+
+def save_feature_vectorizers(vectorizers: dict[str, TfidfVectorizer], path: str = FEATURE_VECTORIZERS_PATH) -> None:
+    # Write to a temporary file first and then move it in place, so that a
+    # server reloading the vectorizers never reads a half-written file.
+    temp_path = f"{path}.tmp"
+    joblib.dump(vectorizers, temp_path)
+    os.replace(temp_path, path)
+
+def load_feature_vectorizers(path: str = FEATURE_VECTORIZERS_PATH) -> dict[str, TfidfVectorizer]:
+    return joblib.load(path)
+
+# The combined vector space of the fitted text features.
+#
+# Each user is represented by a single sparse row in which the L2-normalized
+# TF-IDF vectors of the text features are laid out one after the other, so
+# that the features of many users can be stored and scored as one matrix.
+class FeatureSpace:
+    def __init__(self, vectorizers: dict[str, TfidfVectorizer]):
+        self.vectorizers = vectorizers
+        sizes = [len(vectorizers[feature].vocabulary_) for feature in TEXT_FEATURES]
+
+        # Column at which each feature starts (and the last one ends) in a row.
+        self.offsets: np.ndarray = np.cumsum([0] + sizes)
+        self.num_columns: int = int(self.offsets[-1])
+
+        # Fingerprint of the vocabularies and IDF weights, used to tell whether
+        # a stored vector was built with the vectorizers currently in use.
+        fingerprint = hashlib.sha1()
+
+        for feature in TEXT_FEATURES:
+            vocabulary = sorted(vectorizers[feature].vocabulary_.items())
+            fingerprint.update(repr(vocabulary).encode("utf-8"))
+            fingerprint.update(np.asarray(vectorizers[feature].idf_).tobytes())
+
+        self.id: str = fingerprint.hexdigest()
+
+    # Builds the feature rows of the given profiles.
+    def transform(self, profiles: pd.DataFrame) -> sp.csr_matrix:
+        feature_text = build_feature_text(profiles)
+        blocks = [normalize(self.vectorizers[feature].transform(feature_text[feature])) for feature in TEXT_FEATURES]
+
+        return sp.hstack(blocks, format="csr", dtype=np.float64)
+
+    # Spreads a single feature row over one column per feature, so that
+    # multiplying the feature rows of many users by it returns the dot
+    # product of every feature in a single sparse product.
+    def segment_matrix(self, row: sp.csr_matrix) -> sp.csr_matrix:
+        segments = np.searchsorted(self.offsets, row.indices, side="right") - 1
+
+        return sp.csr_matrix((row.data, (row.indices, segments)), shape=(self.num_columns, len(TEXT_FEATURES)))
+
+# Retrieves the text attributes of every profile to fit the vectorizers on.
+def load_profiles_for_fitting(cursor: psycopg2.extensions.cursor) -> pd.DataFrame:
+    statement = '''
+        SELECT interests, gender, interested_in,
+        city_residence, state_residence, relationship_status
+        FROM Profiles
+    '''
+    cursor.execute(statement)
+
+    columns = [column.name for column in cursor.description]
+    profiles = pd.DataFrame(cursor.fetchall(), columns=columns)
+
+    return profiles.fillna("")
+
+# Process-wide registry of the fitted vectorizers, following the same
+# pattern as the ModelRegistry in class_models.py.
+#
+# If the vectorizers have not been fitted yet, get() returns None and the
+# matching algorithm falls back to fitting them on the candidate pool.
+class VectorizerRegistry:
+    def __init__(self, path: str = FEATURE_VECTORIZERS_PATH):
+        self.path: str = path
+        self._vectorizers: dict[str, TfidfVectorizer] | None = None
+        self._feature_space: FeatureSpace | None = None
+        self._loaded_mtime: float | None = None
+        self._lock = threading.Lock()
+
+    def get(self) -> dict[str, TfidfVectorizer] | None:
+        vectorizers = self._vectorizers
+
+        if vectorizers is None and os.path.isfile(self.path):
+            with self._lock:
+                if self._vectorizers is None:
+                    self._loaded_mtime = os.path.getmtime(self.path)
+                    self._vectorizers = load_feature_vectorizers(self.path)
+                    self._feature_space = FeatureSpace(self._vectorizers)
+
+                vectorizers = self._vectorizers
+
+        return vectorizers
+
+    # Returns the feature space of the fitted vectorizers, or None if they
+    # have not been fitted yet.
+    def get_feature_space(self) -> FeatureSpace | None:
+        if self.get() is None:
+            return None
+
+        return self._feature_space
+
+    # Swaps the vectorizers if they were refitted since they were last
+    # loaded. Returns True if they were swapped.
+    def reload_if_changed(self) -> bool:
+        try:
+            mtime = os.path.getmtime(self.path)
+        except OSError:
+            return False
+
+        if self._loaded_mtime is not None and mtime != self._loaded_mtime:
+            vectorizers = load_feature_vectorizers(self.path)
+            feature_space = FeatureSpace(vectorizers)
+
+            with self._lock:
+                self._vectorizers = vectorizers
+                self._feature_space = feature_space
+                self._loaded_mtime = mtime
+
+            return True
+
+        return False
+
+# Registry shared by every request in the current process.
+vectorizer_registry = VectorizerRegistry()
+
+if __name__ == "__main__":
+    load_dotenv("secret.env")
+
+    db = psycopg2.connect(os.environ.get("DB_KEY"))
+    cursor = db.cursor()
+
+    try:
+        profiles = load_profiles_for_fitting(cursor)
+        vectorizers = fit_feature_vectorizers(profiles)
+        save_feature_vectorizers(vectorizers)
+        print(f"Fitted feature vectorizers on {len(profiles)} profiles and saved them to {FEATURE_VECTORIZERS_PATH}.")
+
+        # Rebuild the feature store, as the rows built with the previous
+        # vectorizers no longer line up with the new vocabularies.
+        from .ml_feature_store import rebuild_feature_store
+
+        num_rebuilt = rebuild_feature_store(cursor, FeatureSpace(vectorizers))
+        db.commit()
+        print(f"Rebuilt the features of {num_rebuilt} users.")
+
+    finally:
+        cursor.close()
+        db.close()
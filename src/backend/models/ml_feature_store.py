@@ -0,0 +1,158 @@
+# Persistent per-user feature store for the matching algorithm.
+#
+# Every user has one precomputed feature row stored in the User_Features
+# table (see sql/user_features.sql): their height in inches and the sparse
+# vector holding the L2-normalized TF-IDF vectors of their interests, sexual
+# orientation (gender and gender interests), residence, and relationship
+# status, laid out in the feature space of the fitted vectorizers.
+#
+# A row is only rebuilt when the user signs up or updates their profile
+# (and whenever the vectorizers are refitted), so that /match only has to
+# gather the rows of the candidates and score them.
+
+import scipy.sparse as sp
+import numpy as np
+import pandas as pd
+import psycopg2
+
+from .ml_feature_fitting import FeatureSpace
+from .ml_sim_calcs import parse_height_inches
+from .ml_candidates import CandidateTable, load_candidate_table, height_inches
+
+# Columns of the raw profile needed to build a feature row.
+PROFILE_FEATURE_COLUMNS = [
+    "username",
+    "interests",
+    "height",
+    "height_inches",
+    "gender",
+    "interested_in",
+    "state_residence",
+    "city_residence",
+    "relationship_status"
+]
+
+# A feature row is stored as its int32 column indices followed by its
+# float64 values.
+def encode_feature_row(row: sp.csr_matrix) -> bytes:
+    return row.indices.astype(np.int32).tobytes() + row.data.astype(np.float64).tobytes()
+
+def decode_feature_row(data: bytes) -> tuple[np.ndarray, np.ndarray]:
+    nnz = len(data) // 12
+    indices = np.frombuffer(data, dtype=np.int32, count=nnz)
+    values = np.frombuffer(data, dtype=np.float64, count=nnz, offset=nnz * 4)
+
+    return indices, values
+
+# Builds the sparse matrix of the given rows (in order) from their
+# decoded indices and values.
+def stack_feature_rows(rows: list[tuple[np.ndarray, np.ndarray]], num_columns: int) -> sp.csr_matrix:
+    indptr = np.zeros(len(rows) + 1, dtype=np.int64)
+    indptr[1:] = np.cumsum([len(indices) for indices, _ in rows])
+
+    indices = np.concatenate([indices for indices, _ in rows]) if rows else np.empty(0, dtype=np.int32)
+    values = np.concatenate([values for _, values in rows]) if rows else np.empty(0, dtype=np.float64)
+
+    return sp.csr_matrix((values, indices, indptr), shape=(len(rows), num_columns))
+
+# Inserts or replaces the feature rows of the given profiles and returns them.
+# The version of a row is bumped every time it is replaced.
+#
+# The profiles can either be a DataFrame or a CandidateTable.
+def upsert_user_features(cursor: psycopg2.extensions.cursor,
+                         feature_space: FeatureSpace,
+                         profiles: CandidateTable | pd.DataFrame) -> sp.csr_matrix:
+    if len(profiles) == 0:
+        return sp.csr_matrix((0, feature_space.num_columns), dtype=np.float64)
+
+    matrix = feature_space.transform(profiles)
+
+    statement = '''
+        INSERT INTO User_Features (username, feature_space_id, height_inches, features, version, updated_at)
+        VALUES (%s, %s, %s, %s, 1, now())
+        ON CONFLICT (username) DO UPDATE SET
+            feature_space_id=EXCLUDED.feature_space_id,
+            height_inches=EXCLUDED.height_inches,
+            features=EXCLUDED.features,
+            version=User_Features.version + 1,
+            updated_at=now()
+    '''
+    params = [
+        (username, feature_space.id, int(height), psycopg2.Binary(encode_feature_row(matrix[i])))
+        for i, (username, height) in enumerate(zip(profiles["username"], height_inches(profiles)))
+    ]
+
+    cursor.executemany(statement, params)
+
+    return matrix
+
+# Rebuilds the feature row of a single user from their current profile. Called
+# by the handlers in server.py whenever a user signs up or changes one of the
+# attributes used by the matching algorithm.
+def refresh_user_features(cursor: psycopg2.extensions.cursor,
+                          feature_space: FeatureSpace | None,
+                          username: str) -> None:
+    # Nothing to refresh until the vectorizers have been fitted.
+    if feature_space is None:
+        return
+
+    statement = f"SELECT {', '.join(PROFILE_FEATURE_COLUMNS)} FROM Profiles WHERE username=%s"
+    cursor.execute(statement, [username])
+
+    profiles = load_candidate_table(cursor).fill_missing("")
+    upsert_user_features(cursor, feature_space, profiles)
+
+# Rebuilds the feature rows of every user, e.g. after the vectorizers were refitted.
+def rebuild_feature_store(cursor: psycopg2.extensions.cursor, feature_space: FeatureSpace) -> int:
+    statement = f"SELECT {', '.join(PROFILE_FEATURE_COLUMNS)} FROM Profiles"
+    cursor.execute(statement)
+
+    profiles = load_candidate_table(cursor).fill_missing("")
+    upsert_user_features(cursor, feature_space, profiles)
+
+    return len(profiles)
+
+# Gathers the stored feature rows of the given profiles, in the same order as
+# they appear in the table.
+#
+# Profiles without a row built in the current feature space (e.g. users that
+# signed up before the store existed) have theirs built from the profile and
+# written back, so that the store fills itself in over time.
+#
+# If return_versions is True, the version of each row is returned as well, with
+# -1 for the rows that were just built (and whose version is not known yet).
+def load_user_features(cursor: psycopg2.extensions.cursor,
+                       feature_space: FeatureSpace,
+                       profiles: CandidateTable,
+                       return_versions: bool = False) -> tuple[sp.csr_matrix, np.ndarray] | tuple[sp.csr_matrix, np.ndarray, np.ndarray]:
+    usernames: list[str] = profiles["username"].tolist()
+
+    statement = '''
+        SELECT username, height_inches, features, version FROM User_Features
+        WHERE username = ANY(%s) AND feature_space_id=%s
+    '''
+    cursor.execute(statement, [usernames, feature_space.id])
+
+    stored_rows: dict[str, tuple[int, bytes]] = {}
+    stored_versions: dict[str, int] = {}
+
+    for record in cursor:
+        stored_rows[record[0]] = (record[1], bytes(record[2]))
+        stored_versions[record[0]] = record[3]
+
+    missing_profiles = profiles.take(np.flatnonzero([username not in stored_rows for username in usernames]))
+
+    if len(missing_profiles) > 0:
+        missing_matrix = upsert_user_features(cursor, feature_space, missing_profiles)
+
+        for i, (username, height) in enumerate(zip(missing_profiles["username"], height_inches(missing_profiles))):
+            stored_rows[username] = (height, encode_feature_row(missing_matrix[i]))
+
+    heights = np.array([stored_rows[username][0] for username in usernames], dtype=np.float64)
+    rows = [decode_feature_row(stored_rows[username][1]) for username in usernames]
+    matrix = stack_feature_rows(rows, feature_space.num_columns)
+
+    if return_versions:
+        return matrix, heights, np.array([stored_versions.get(username, -1) for username in usernames], dtype=np.int64)
+
+    return matrix, heights
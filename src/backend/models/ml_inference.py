@@ -0,0 +1,42 @@
+import numpy as np
+
+from .ml_numpy_model import NumpyModel
+
+# Number of candidate rows sent through the model per dispatch.
+# Large enough to amortize the cost of each call into Keras, small
+# enough to keep the intermediate activations of a single chunk
+# from growing with the size of the candidate pool.
+DEFAULT_PREDICT_CHUNK_SIZE = 1024
+
+# The model can either be the Keras model or its NumPy forward pass (see
+# ml_numpy_model.py), as both of them have the same predict_on_batch method.
+#
+# Scores the rows of the preprocessed candidate matrix with the model in chunks
+# of chunk_size rows, yielding the position of the first row of each chunk along
+# with the scores of its rows as soon as they are ready.
+def predict_chunks(model: "keras.Model | NumpyModel",
+                   features: np.ndarray,
+                   chunk_size: int = DEFAULT_PREDICT_CHUNK_SIZE):
+    if chunk_size <= 0:
+        raise ValueError("chunk_size must be a positive integer.")
+
+    features = np.asarray(features, dtype=np.float32)
+
+    for start in range(0, features.shape[0], chunk_size):
+        # predict_on_batch runs the chunk through the model in a single call
+        # without the per-call overhead of model.predict (callbacks, progress
+        # bar, dataset adapters, etc.).
+        yield start, np.asarray(model.predict_on_batch(features[start:start + chunk_size])).reshape(-1)
+
+# Scores every row of the preprocessed candidate matrix with the model in chunks
+# of chunk_size rows, rather than calling model.predict once per candidate, and
+# returns a flat array with one score per row.
+def predict_in_chunks(model: "keras.Model | NumpyModel",
+                      features: np.ndarray,
+                      chunk_size: int = DEFAULT_PREDICT_CHUNK_SIZE) -> np.ndarray:
+    scores = np.empty(np.shape(features)[0], dtype=np.float32)
+
+    for start, chunk_scores in predict_chunks(model, features, chunk_size):
+        scores[start:start + len(chunk_scores)] = chunk_scores
+
+    return scores
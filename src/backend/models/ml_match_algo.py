@@ -1,5 +1,5 @@
 import psycopg2
-import pandas as pd
+import numpy as np
 import os
 
 # Turn off oneDNN optimizations.
@@ -11,174 +11,206 @@ sys.path.append("../helpers/")
 sys.path.append("..")
 
 from .ml_sim_calcs import *
-from helpers.helper import retrieve_age
-from class_models import ColabFilteringModel
-
-# Dictionary to store the index of users
-# based on dataframe.
-user_index = {}
+from .ml_inference import predict_chunks, DEFAULT_PREDICT_CHUNK_SIZE
+from .ml_ranking import TopKSelector, RECOMMENDATION_LIMIT
+from .ml_feature_fitting import vectorizer_registry, fit_feature_vectorizers, FeatureSpace
+from .ml_scoring import get_scoring_kernel
+from .ml_scaler_stats import scaler_stats_registry
+from .ml_score_cache import pair_score_cache, NUM_ATTRIBUTE_SCORES
+from .ml_feature_store import load_user_features
+from .ml_ann_index import select_candidates, ANN_MIN_POOL_SIZE
+from .ml_orientation import encode_orientations, orientation_mask
+from .ml_candidates import CandidateTable, ProfileTable, load_match_candidates, height_inches, PROFILE_METADATA_COLUMNS
+from class_models import get_model_registry
+
+# Request-scoped state of a single run of the matching algorithm.
+#
+# Everything a run loads and calculates is kept on its own context instead of
+# in module-level variables, so that several runs can safely go through the
+# pipeline at the same time (e.g. in a thread pool).
+class MatchContext:
+    def __init__(self, username: str, use_so_filter: bool):
+        self.username = username
+        self.use_so_filter = use_so_filter
+
+        self.candidates: CandidateTable | None = None
+        self.current_user: CandidateTable | None = None
+        self.user_profiles: ProfileTable | None = None
+        self.logged_in_user_profile: dict[str, any] | None = None
+        self.user_features: tuple | None = None
+
+        # Versions of the feature rows of the candidates and of the current user
+        # in the feature store, used to look up their cached scores.
+        self.feature_versions: tuple[np.ndarray, int] | None = None
+
+        # Mask of the candidates that passed the sexual orientation filter, if
+        # the current user decided to use it.
+        self.eligible: np.ndarray | None = None
+
+        # Score matrix of the candidates (see SCORE_COLUMNS), along with the
+        # username of the candidate in each of its rows.
+        self.scores: np.ndarray | None = None
+        self.usernames: np.ndarray | None = None
 
 # Load users from database.
 def load_data(username: str, 
               db: psycopg2.extensions.connection, 
               cursor: psycopg2.extensions.cursor):
     try:
-        statement = '''
-            SELECT username,
-            first_name,
-            middle_name,
-            last_name,
-            interests,
-            height,
-            gender,
-            sexual_orientation,
-            interested_in,
-            state_residence,
-            city_residence,
-            relationship_status,
-            visits 
-            FROM retrieve_possible_matches(%s)
-        '''
-        params = [username]
-        cursor.execute(statement, params)
-        
-        df = pd.DataFrame(cursor.fetchall())
-
-        cursor.execute('SELECT * FROM get_user_profiles(%s)', params)
-        user_profiles = {}
-
-        for record in cursor:
-            if "users" not in user_profiles:
-                user_profiles["users"] = {record[0]: {key[0]: value for key, value in zip(cursor.description, record)}}
-            else:
-                user_profiles["users"][record[0]] = {key[0]: value for key, value in zip(cursor.description, record)}
-
-            user_profiles["users"][record[0]]["uri"] = bytes(user_profiles["users"][record[0]]["uri"]).decode('utf-8')
+        # Load the candidates and the current user in a single round trip (see
+        # sql/match_candidates.sql). The height of each of them is also
+        # retrieved in inches (see sql/profiles_height_inches.sql), so that it
+        # doesn't have to be parsed.
+        candidates, current_user = load_match_candidates(cursor, username)
+
+        # Store the profiles of the candidates in a table keyed by row id. They are
+        # only turned into dictionaries once they are recommended to the user. Their
+        # photos are only loaded for the matches returned to the user (see
+        # hydrate_photos in ml_candidates.py).
+        user_profiles = ProfileTable({name: candidates[name] for name in PROFILE_METADATA_COLUMNS})
+
+        # Encode the gender and gender interests of every user as bitmasks
+        # for the sexual orientation filter.
+        candidates = encode_orientations(candidates)
+
+        logged_in_user_profile: dict[str, any] = {
+            name: values[0:1].tolist()[0] for name, values in current_user.columns.items()
+        }
+
+        return candidates, current_user, user_profiles, logged_in_user_profile
+    
+    except psycopg2.DatabaseError:
+        print("There was an error connecting to the database.")
 
-        for user in user_profiles["users"].keys():
-            user_profiles["users"][user]["age"] = retrieve_age(
-                user_profiles["users"][user]["birth_month"],
-                int(user_profiles["users"][user]["birth_date"]),
-                int(user_profiles["users"][user]["birth_year"])
-            )
-        
-        new_column_names = [
-            "username", 
-            "first_name", 
-            "middle_name", 
-            "last_name", 
-            "interests", 
-            "height", 
-            "gender", 
-            "sexual_orientation", 
-            "interested_in", 
-            "state_residence", 
-            "city_residence", 
-            "relationship_status",
-            "visits"
-        ]
-        
-        for column in df.columns.values:
-            df.rename(columns={column: new_column_names[column]}, inplace=True)
+# Gathers the precomputed feature rows of the candidates and the current user from
+# the feature store, along with the versions of the rows of the candidates and of
+# the current user.
+#
+# Returns None for both, so that the features are calculated from the raw profiles
+# instead, if the vectorizers have not been fitted yet or the feature store can't
+# be read.
+def load_features(candidates: CandidateTable,
+                  current_user: CandidateTable,
+                  db: psycopg2.extensions.connection,
+                  cursor: psycopg2.extensions.cursor):
+    feature_space = vectorizer_registry.get_feature_space()
 
-        # Now exclude the current user from the main dataframe,
-        # randomize it, and return the first 10 users from
-        # the shuffled dataframe.
-        df = df[df["username"] != username]
-        # df = df.sample(frac=1).reset_index(drop=True).head(n=10)
+    if feature_space is None:
+        return None, None
 
-        cursor.execute("SELECT * FROM get_logged_in_user(%s)", [username])
+    try:
+        # The current user's row is gathered along with those of the candidates
+        # and is stored as the last row.
+        profiles = CandidateTable.concat([candidates, current_user])
+        users_matrix, users_heights, versions = load_user_features(cursor, feature_space, profiles, return_versions=True)
         
-        logged_in_user_profile: dict[str, any] = [
-            {key[0]: value for key, value in zip(cursor.description, record)} 
-            for record in cursor
-        ][0]
+        # Commit the rows that were missing from the feature store.
+        db.commit()
 
-        cursor.execute('''
-            SELECT username, first_name, middle_name, last_name, 
-            interests, height, gender, sexual_orientation,
-            interested_in, state_residence, city_residence,
-            relationship_status FROM get_logged_in_user(%s)
-        ''', [username])
+        user_features = (users_matrix[:-1], 
+                         users_heights[:-1], 
+                         feature_space.segment_matrix(users_matrix[-1]), 
+                         users_heights[-1])
 
-        # Make a separate dataframe, but for the current user.
-        current_user_df = pd.DataFrame(cursor.fetchall())
-
-        for column in current_user_df.columns.values:
-            current_user_df.rename(columns={column: new_column_names[column]}, inplace=True)
-
-        cursor.close()
-        db.close()
-        
-        return df, current_user_df, user_profiles, logged_in_user_profile
+        return user_features, (versions[:-1], int(versions[-1]))
     
-    except psycopg2.DatabaseError:
-        print("There was an error connecting to the database.")
+    except psycopg2.DatabaseError as e:
+        db.rollback()
+        print(f"Failed to load features from the feature store: {e}")
+        return None, None
+
+# Builds the feature rows of the candidates and the current user from their raw
+# profiles, for when they could not be gathered from the feature store.
+def build_features(feature_space: FeatureSpace, users: CandidateTable, current_user: CandidateTable):
+    users_matrix = feature_space.transform(users)
+    current_user_matrix = feature_space.transform(current_user)
+
+    return (users_matrix,
+            height_inches(users),
+            feature_space.segment_matrix(current_user_matrix[0]),
+            height_inches(current_user)[0])
+
+# Narrows large candidate pools down to the users whose interests are the most
+# similar to those of the current user using the ANN index. Smaller pools (or all
+# of them, if the vectorizers have not been fitted yet) are returned as they are.
+def narrow_candidates(candidates: CandidateTable,
+                      current_user: CandidateTable,
+                      db: psycopg2.extensions.connection,
+                      cursor: psycopg2.extensions.cursor) -> CandidateTable:
+    feature_space = vectorizer_registry.get_feature_space()
+
+    if feature_space is None or len(candidates) < ANN_MIN_POOL_SIZE:
+        return candidates
 
-def process_data(df: pd.DataFrame, df_current_user: pd.DataFrame, current_user: str):
-    df_users = df[df["username"] != current_user]
+    try:
+        return select_candidates(candidates, current_user, feature_space, cursor)
     
-    for i, user in enumerate(df_users['username'].values):
-        user_index[i] = user
+    except psycopg2.DatabaseError as e:
+        db.rollback()
+        print(f"Failed to narrow down the candidates with the interest index: {e}")
+        return candidates
+
+# Columns of the matrix returned by process_data. Every column but the
+# similarity score is sent through the model.
+SCORE_COLUMNS = ["interests", 
+                 "height", 
+                 "sexual_orientation", 
+                 "residence", 
+                 "relationship_status",
+                 "visits", 
+                 "similarity_score"]
+
+# Calculates the score of each attribute of every candidate, and returns them as
+# a matrix with one row per candidate and one column per score (see SCORE_COLUMNS).
+#
+# If the versions of the feature rows of the candidates and of the current user
+# are given, the attribute scores of the pairs that did not change since they
+# were last scored are taken from the pairwise score cache (see ml_score_cache.py).
+def process_data(candidates: CandidateTable, 
+                 current_user: CandidateTable, 
+                 username: str, 
+                 user_features: tuple | None = None,
+                 feature_versions: tuple[np.ndarray, int] | None = None) -> np.ndarray:
+    users = candidates.exclude(username)
     
     try:
-        if not df_users.empty or not df_current_user.empty:
-            column_labels = ["interests", 
-                             "height", 
-                             "sexual_orientation", 
-                             "residence", 
-                             "relationship_status",
-                             "visits", 
-                             "similarity_score"]
-        
-            users_dictionary = {}
-            
-            # For each attribute (excluding the username, first name, middle name, and last name columns)
-            # insert and update the key value pairs with the corresponding attribute column and username
-            # row by assigning a score of 0 for each user that is inserted.
-            for attr in column_labels:
-                for user in df_users['username'].values:
-                    # If the attribute does not exist in the dictionary,
-                    # create a key for said attribute and create a new
-                    # sub-dictionary with a username key and a score of 0.
-                    if attr not in users_dictionary:
-                        users_dictionary[attr] = {user: 0}
-                        
-                    # Otherwise, add the new user to the current attribute.
-                    else:
-                        users_dictionary[attr].update({user: 0})
-            
-            # Drop the username, first name, middle name, and last name columns.
-            df_users = df_users.drop(columns=['username', 'first_name', 'middle_name', 'last_name'])
-            df_current_user = df_current_user.drop(columns=['username', 'first_name', 'middle_name', 'last_name'])
-            
-            interests_dot_prod(df_users['interests'], 
-                               df_current_user['interests'], 
-                               users_dictionary)
-                
-            height_dot_prod(df_users['height'], 
-                            df_current_user['height'], 
-                            users_dictionary)
-            
-            sexual_orientation_similarity(df_users[['gender', 'interested_in']], 
-                                          df_current_user[['gender', 'interested_in']], 
-                                          users_dictionary)
-            
-            residence_dot_prod(df_users[['city_residence', 'state_residence']], 
-                               df_current_user[['state_residence', 'city_residence']], 
-                               users_dictionary)
-            
-            relationship_status_dot_prod(df_users['relationship_status'], 
-                                         df_current_user['relationship_status'], 
-                                         users_dictionary)
-            
-            users_df = pd.DataFrame.from_dict(users_dictionary)
-            users_df = scale_data(users_df)
-            visit_booster(df_users['visits'], users_dictionary)
-            users_df["visits"] = df_users["visits"]
-            users_df = calculate_similarity_score(users_df, users_dictionary)
-            
-            return users_df
+        if len(users) > 0 or len(current_user) > 0:
+            orientation_scores = None
+
+            # If the precomputed feature rows were not gathered from the feature
+            # store, build them from the raw profiles. If the vectorizers have not
+            # been fitted yet, they are fitted on the candidate pool.
+            if user_features is None:
+                feature_space = vectorizer_registry.get_feature_space() or FeatureSpace(fit_feature_vectorizers(users))
+                user_features = build_features(feature_space, users, current_user)
+
+                # The sexual orientations are still scored by sexual_orientation_similarity
+                # (i.e. from the compatibility table, if the vectorizers were fitted ahead
+                # of time), as the threshold of the scores is sensitive to rounding errors
+                # of the dot products of identical orientations.
+                vectorizers = vectorizer_registry.get() or {}
+                orientation_scores = sexual_orientation_similarity([users['gender'], users['interested_in']], 
+                                                                   [current_user['gender'], current_user['interested_in']], 
+                                                                   None,
+                                                                   vectorizers.get("sexual_orientation"))
+
+            users_matrix, users_heights, segment_matrix, current_user_height = user_features
+
+            # If the scaling statistics have been computed, the similarity scores
+            # are scaled with them rather than with the range of the candidate pool.
+            scaling = scaler_stats_registry.get_scaling()
+
+            if feature_versions is not None:
+                return score_with_cache(users, username, user_features, feature_versions, scaling)
+
+            # Score every attribute of every candidate in a single pass.
+            return get_scoring_kernel().score(users_matrix,
+                                              users_heights,
+                                              segment_matrix,
+                                              current_user_height,
+                                              users['visits'],
+                                              orientation_scores,
+                                              scaling=scaling)
         
         else:
             print("User does not exist.")
@@ -188,160 +220,212 @@ def process_data(df: pd.DataFrame, df_current_user: pd.DataFrame, current_user:
         print("User is not found!")
         exit(0)
 
-def filter_matches(matches: list[dict[str, any]], current_user: dict[str, any]) -> list[dict[str, any]]:
-    try:
-        # If the user is pansexual and/or is interested in anyone, regardless of gender,
-        # then return the list of matches.
-        if current_user["sexual_orientation"] == "Pansexual" or current_user["interested_in"] == "Anyone":
-            return matches
-        
-        # Otherwise...
-        else:
-            # Turn the gender interests of each match into sets to use for the filter
-            # function logic below.
-            for m in matches:
-                m["interested_in"] = set(m["interested_in"].replace("s", "").split(", "))
-            
-            # Do the same as above, but with the current user's gender interests.
-            current_user["interested_in"] = set(current_user["interested_in"].replace("s", "").split(", "))
-            
-            # List that will store user's filtered matches based on their gender interests.
-            filter_matches = []
-            
-            # Iterate through each match.
-            for match in matches:
-                # If the match's gender is in the set of the current user's gender interests,
-                # and the current user's gender is in the set of the match's gender interests,
-                # then append the match's profile to the list.
-                if match["gender"] in current_user["interested_in"] and current_user["gender"] in match["interested_in"]:
-                    filter_matches.append(match)
-                    
-                # Otherwise, if the current user identifies as anything other than male
-                # or female (e.g. non-binary, etc.)...
-                elif current_user["gender"] != "Male" and current_user["gender"] != "Female":
-                    # Check if the match's gender is included in the current user's
-                    # gender interests set. If it is, then append the match's
-                    # profile to the list.
-                    if match["gender"] in current_user["interested_in"]:
-                        filter_matches.append(match)
-
-            return filter_matches
-    
-    except KeyError:
-        raise KeyError
-
-def generate_recommendations(df: pd.DataFrame, 
-                             num_recommendations: int, 
-                             user_profiles: dict,
-                             logged_in_user_profile: dict[str, any],
-                             use_so_filter: bool) -> list[dict[str, any]]:
+# Scores the candidates the same way as process_data, but only scores the
+# attributes of the pairs that are not in the pairwise score cache, and caches
+# them for the next time.
+def score_with_cache(users: CandidateTable,
+                     username: str,
+                     user_features: tuple,
+                     feature_versions: tuple[np.ndarray, int],
+                     scaling: tuple[np.ndarray, np.ndarray] | None) -> np.ndarray:
+    users_matrix, users_heights, segment_matrix, current_user_height = user_features
+    versions, viewer_version = feature_versions
+
+    kernel = get_scoring_kernel()
+    scores = np.empty((len(users), len(SCORE_COLUMNS)), dtype=np.float64)
+    usernames = users['username']
+
+    # Rows that were just built in the feature store don't have a version yet,
+    # so they are neither looked up nor cached.
+    if viewer_version < 0:
+        hits = np.zeros(len(users), dtype=bool)
+    else:
+        hits = pair_score_cache.lookup(username, viewer_version, usernames, versions, scores[:, 0:NUM_ATTRIBUTE_SCORES])
+
+    missed = np.flatnonzero(~hits)
+
+    if len(missed) > 0:
+        dot_prods = (users_matrix[missed] @ segment_matrix).toarray()
+        missed_scores = kernel.score_attributes(dot_prods, users_heights[missed], current_user_height, None, np.empty((len(missed), len(SCORE_COLUMNS))))
+        scores[missed, 0:NUM_ATTRIBUTE_SCORES] = missed_scores[:, 0:NUM_ATTRIBUTE_SCORES]
+
+    # Cache the scores in the order of the current pool, unless it was already
+    # cached as it is.
+    if viewer_version >= 0 and not hits.all():
+        cached = np.flatnonzero(versions >= 0)
+        pair_score_cache.store(username, viewer_version, usernames[cached], versions[cached], scores[cached])
+
+    return kernel.score_similarity(scores, users['visits'], scaling)
+
+# Returns a mask of the users that align with the sexual orientation and gender
+# interests of the current user. If none of them do, every user is kept until more
+# users with a similar sexual orientation and/or gender interest(s) sign up.
+def filter_matches(candidates: CandidateTable, current_user: dict[str, any]) -> np.ndarray:
+    mask = orientation_mask(candidates["gender_bits"], candidates["interest_bits"], current_user)
+
+    if not mask.any():
+        return np.ones(len(candidates), dtype=bool)
+
+    return mask
+
+# Columns of the profiles that are never returned to the user.
+SENSITIVE_COLUMNS = [
+    'birth_date',
+    'birth_month',
+    'birth_year',
+    'gender',
+    'height',
+    'interested_in',
+    'middle_name',
+    'last_name',
+    'rating',
+    'relationship_status',
+    'sexual_orientation'
+]
+
+# Scores the candidates with the model and returns the usernames of the top k
+# (or of every candidate, if k is None) from most to least similar, along with
+# their scores as percentages. The usernames are those of the candidates in
+# each row of the score matrix.
+def rank_candidates(scores: np.ndarray, 
+                    usernames: np.ndarray, 
+                    eligible: np.ndarray | None = None,
+                    predict_chunk_size: int = DEFAULT_PREDICT_CHUNK_SIZE,
+                    top_k: int | None = RECOMMENDATION_LIMIT,
+                    backend: str | None = None) -> tuple[list[str], np.ndarray]:
     
     # Drop the similarity score column for the current user.
-    df_current_user = df.drop(columns=['similarity_score'])
+    features = scores[:, 0:SCORE_COLUMNS.index('similarity_score')]
 
-    # Retrieve the model from the ColabFilteringModel class.
-    model = ColabFilteringModel().model
-    
-    # Dictionary which will the store the user as its key along with their predicted similarity score
-    # as its value.
-    recommended_users = {}
-
-    # Predict the similarity score for each user based on the number of recommendations
-    # provided.
-    for i in range(0, num_recommendations):
-        try:
-            current_user = df_current_user.iloc[i]
-            predicted_score = model.predict(np.array([current_user.values]), batch_size=20, verbose=0)[0][0]
-            recommended_users[user_index[i]] = round((predicted_score * 100), 2)
-        except IndexError:
-            break
-
-    # Sort the dictionary by first accessing the key value pairs in a tuple.
-    # 
-    # Using a lambda function to focus only on the values of the dictionary to sort (in this case,
-    # x[1], which contain the similarity score for each user). 
-    # 
-    # Subsequently convert the sorted list--which still contain the key value pairs in tuple form--into 
-    # a dictionary from the most recommended user to the least recommended user.
-    recommended_users = dict(sorted(recommended_users.items(), key=lambda x: x[1], reverse=True))
-    
-    # Store the most recommended users in a dictionary from most similar to least similar.
-    recommended_users = dict(list(filter(lambda x: x, recommended_users.items())))
-
-    # Store the profiles of users in a list of dictionaries using
-    # the recommended_users list which lists them from most to
-    # least similar.
-    final_users: list[dict[str, any]] = [user_profiles["users"][user] for user in recommended_users.keys()]
-
-    # List of columns to drop.
-    cols_to_drop = [
-        'birth_date',
-        'birth_month',
-        'birth_year',
-        'gender',
-        'height',
-        'interested_in',
-        'middle_name',
-        'last_name',
-        'rating',
-        'relationship_status',
-        'sexual_orientation'
-    ]
+    # Retrieve the warm model shared by every request from the registry of the
+    # given backend (or of the one selected by MATCHING_MODEL_BACKEND).
+    model = get_model_registry(backend).get()
 
-    # If the current user decided to use a sexual orientation filter,
-    # filter the list of users that do not align with their interests.
-    if use_so_filter:
-        filtered_users = filter_matches(final_users, logged_in_user_profile)
-
-        # If there are any matches in the filtered_users list of dictionaries,
-        # then drop the following columns from each recommended match in 
-        # the list.
-        if filtered_users:
-            filtered_users = drop_cols(filtered_users, cols_to_drop)
-            return filtered_users[:10]
-        
-        # Otherwise, return the non-filtered users until more users
-        # with a similar sexual orientation and/or gender interest(s)
-        # sign up.
-        else:
-            final_users = drop_cols(final_users, cols_to_drop)
-            return final_users[:10]
-        
-    # Otherwise, simply drop the columns listed in the cols_to_drop
-    # list.
+    # Usernames of the users that will be scored, in the same order as their rows.
+    candidates: list[str] = list(usernames)
+
+    # If a mask of eligible users was given (e.g. by the sexual orientation filter),
+    # only those users are scored and ranked.
+    if eligible is None:
+        eligible_ids = np.arange(len(candidates))
+    elif len(eligible) != len(candidates):
+        raise ValueError(f"The mask of eligible users has {len(eligible)} entries for {len(candidates)} candidates.")
     else:
-        final_users = drop_cols(final_users, cols_to_drop)
+        eligible_ids = np.flatnonzero(eligible)
+
+    # Predict the similarity score for each user by sending the preprocessed rows through
+    # the model in chunks, and only keep the top k users out of each chunk, rather than
+    # sorting every scored user.
+    candidate_features = features.astype(np.float32)[eligible_ids]
+    selector = TopKSelector(len(eligible_ids) if top_k is None else top_k)
+
+    for start, chunk_scores in predict_chunks(model, candidate_features, predict_chunk_size):
+        # Scores are rounded to percentages with 2 decimal places, the same way
+        # as they are shown to the user, before they are ranked.
+        selector.push(np.round(chunk_scores * np.float32(100), 2), eligible_ids[start:start + len(chunk_scores)])
+
+    ranked_ids, ranked_scores = selector.result()
+
+    return [candidates[i] for i in ranked_ids], ranked_scores
+
+# Ranks the scored candidates of the context and returns the profiles of the top k.
+# The model is served by the given backend ("keras" or "numpy", see class_models.py),
+# or by the one selected by MATCHING_MODEL_BACKEND if none is given.
+def generate_recommendations(context: MatchContext,
+                             predict_chunk_size: int = DEFAULT_PREDICT_CHUNK_SIZE,
+                             top_k: int | None = RECOMMENDATION_LIMIT,
+                             backend: str | None = None) -> list[dict[str, any]]:
+    
+    ranked_users, _ = rank_candidates(context.scores, context.usernames, context.eligible, predict_chunk_size, top_k, backend)
+
+    # Build the profiles of the recommended users (and only those) as a list of
+    # dictionaries from most to least similar.
+    user_profiles = context.user_profiles
+    final_users: list[dict[str, any]] = [user_profiles.profile(user_profiles.row_id(user)) for user in ranked_users]
+
+    # Drop the columns listed in the SENSITIVE_COLUMNS list from each recommended match.
+    final_users = drop_cols(final_users, SENSITIVE_COLUMNS)
 
-    # Return the list of non-filtered users if they decided not to use
-    # the SO filter.
-    return final_users[:10]
+    return final_users
 
 # Function to drop columns with sensitive information.
 def drop_cols(recommended_users: list[dict[str, any]], cols_to_drop: list[str]):
-    recommended_users = pd.DataFrame(recommended_users).drop(columns=cols_to_drop).to_dict('records')
+    recommended_users = [
+        {key: value for key, value in user.items() if key not in cols_to_drop} 
+        for user in recommended_users
+    ]
     return recommended_users
 
+# Loads everything the matching algorithm needs from the database into a new
+# context: the candidates (narrowed down for large pools), the current user, the
+# profiles of the candidates, and their precomputed features. Also applies the
+# sexual orientation filter, if the current user decided to use it.
+def load_match_inputs(username: str,
+                      db: psycopg2.extensions.connection,
+                      cursor: psycopg2.extensions.cursor,
+                      use_so_filter: bool) -> MatchContext:
+    context = MatchContext(username, use_so_filter)
+
+    # Load the data from the database to be used for the recommendation
+    # algorithm.
+    data, context.current_user, context.user_profiles, context.logged_in_user_profile = load_data(username, db, cursor)
+
+    # For large candidate pools, only keep the users whose interests are
+    # the most similar to those of the current user.
+    context.candidates = narrow_candidates(data, context.current_user, db, cursor)
+
+    # Gather the precomputed features of the users from the feature store.
+    context.user_features, context.feature_versions = load_features(context.candidates, context.current_user, db, cursor)
+
+    # If the current user decided to use a sexual orientation filter, only the
+    # users that align with their interests are scored.
+    if use_so_filter:
+        context.eligible = filter_matches(context.candidates, context.logged_in_user_profile)
+
+    return context
+
+# Scores the candidates of the context (see process_data).
+def score_candidates(context: MatchContext) -> MatchContext:
+    rows = np.flatnonzero(context.candidates["username"] != context.username)
+    candidates = context.candidates.take(rows)
+
+    # Keep the mask of eligible users aligned with the rows that are scored.
+    if context.eligible is not None:
+        context.eligible = context.eligible[rows]
+
+    context.scores = process_data(candidates, context.current_user, context.username, context.user_features, context.feature_versions)
+    context.usernames = candidates['username']
+
+    return context
+
+# Closes a connection the matching algorithm is done with. Pooled connections
+# are handed back to their pool instead (see run_match_in_worker in
+# helpers/match_executor.py).
+def close_connection(db: psycopg2.extensions.connection) -> None:
+    db.close()
+
+# The connection is released (with release) as soon as the inputs are loaded,
+# before the candidates are scored.
 def run_algorithm(username: str,
                   cursor: psycopg2.extensions.cursor,
                   db: psycopg2.extensions.connection,
-                  use_so_filter: bool):
+                  use_so_filter: bool,
+                  top_k: int | None = RECOMMENDATION_LIMIT,
+                  release=close_connection):
     
-    # Load the data from the database to be used for the recommendation
-    # algorithm.
-    data, current_user_data, user_profiles, logged_in_user_profile = load_data(username, db, cursor)
+    try:
+        context = load_match_inputs(username, db, cursor, use_so_filter)
+
+    finally:
+        cursor.close()
+        release(db)
 
     # Preprocess the data to serve it to the recommendation algorithm.
-    preprocessed_data = process_data(data, current_user_data, username)
-
-    # Generate a list of top 10 users ranked from most similar
-    # to least similar using the recommendation algorithm.
-    recommendations = generate_recommendations(
-        preprocessed_data,
-        len(preprocessed_data),
-        user_profiles,
-        logged_in_user_profile,
-        use_so_filter
-    )
+    context = score_candidates(context)
+
+    # Generate a list of the top k users (or of every user, if k is None) ranked
+    # from most similar to least similar using the recommendation algorithm.
+    recommendations = generate_recommendations(context, top_k=top_k)
 
     # Return the list of recommended users.
-    return recommendations
\ No newline at end of file
+    return recommendations
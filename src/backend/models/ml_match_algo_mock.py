@@ -10,22 +10,16 @@ import os
 # Turn off oneDNN optimizations.
 os.environ['TF_ENABLE_ONEDNN_OPTS'] = '0'
 
-import keras
 import sys
 
 sys.path.append("../helpers/")
+sys.path.append("..")
 
 from .ml_sim_calcs import *
-
-def change_to_model_dir_for_tests():
-    directories = os.getcwd().split("/")
-
-    if "src" not in directories:
-        os.chdir("./src/backend/models")
-    elif "src" in directories and "backend" not in directories:
-        os.chdir("./backend/models")
-    else:
-        os.chdir("./models")
+from .ml_inference import predict_chunks, DEFAULT_PREDICT_CHUNK_SIZE
+from .ml_ranking import TopKSelector, RECOMMENDATION_LIMIT
+from .ml_scaler_stats import scaler_stats_registry
+from class_models import model_registry
 
 def load_mock_data(mock_profiles: list[dict[str, any]],
                    current_mock_profile: list[dict[str, any]]):
@@ -111,7 +105,7 @@ def process_mock_data(df_users: pd.DataFrame,
                                          users_dictionary)
             
             users_df = pd.DataFrame.from_dict(users_dictionary)
-            users_df = scale_data(users_df)
+            users_df = scale_data(users_df, scaler_stats_registry.get_scaling())
             visit_booster(df_users['visits'], users_dictionary)
             users_df['visits'] = df_users['visits']
             users_df = calculate_similarity_score(users_df, users_dictionary)
@@ -171,51 +165,24 @@ def generate_mock_recommendations(df: pd.DataFrame,
                                   user_profiles: dict,
                                   logged_in_user_profile: dict[str, any],
                                   use_so_filter: bool,
-                                  user_index: dict) -> list[dict[str, any]]:
-    # Change directories in case the folder containing the matching
-    # algorithm model is not found.
-    directory_changed: bool = False
-    prev_changed_dir = os.getcwd()
-
-    if not os.path.isfile("matching_model.h5"):
-        change_to_model_dir_for_tests()
-        directory_changed = True
-
-    model: keras.Model = keras.models.load_model('matching_model.h5')
+                                  user_index: dict,
+                                  predict_chunk_size: int = DEFAULT_PREDICT_CHUNK_SIZE) -> list[dict[str, any]]:
+    # Retrieve the warm model shared by every run from the model registry.
+    model = model_registry.get()
     df_current_user = df.drop(columns=['similarity_score'])
 
-    # Dictionary which will the store the user as its key along with their predicted similarity score
-    # as its value.
-    recommended_users = {}
-
     # Predict the similarity score for each user based on the number of recommendations
-    # provided.
-    for i in range(0, num_recommendations):
-        try:
-            current_user = df_current_user.iloc[i]
-            predicted_score = model.predict(np.array([current_user.values]), batch_size=20, verbose=0)[0][0]
-            recommended_users[user_index[i]] = round((predicted_score * 100), 2)
-        except IndexError:
-            break
+    # provided by sending the preprocessed rows through the model in chunks, and only
+    # keep the 10 highest-scoring users as the chunks come in, rather than sorting every scored user.
+    candidate_features = df_current_user.iloc[0:num_recommendations].to_numpy(dtype=np.float32)
+    selector = TopKSelector(RECOMMENDATION_LIMIT)
 
-    # Sort the dictionary by first accessing the key value pairs in a tuple.
-    # 
-    # Using a lambda function to focus only on the values of the dictionary to sort (in this case,
-    # x[1], which contain the similarity score for each user). 
-    # 
-    # Subsequently convert the sorted list--which still contain the key value pairs in tuple form--into 
-    # a dictionary from the most recommended user to the least recommended user.
-    recommended_users = dict(sorted(recommended_users.items(), key=lambda x: x[1], reverse=True))
-    
-    # Return only the top 10 users.
-    recommended_users = dict(list(filter(lambda x: x, recommended_users.items()))[:10])
+    for start, chunk_scores in predict_chunks(model, candidate_features, predict_chunk_size):
+        selector.push(np.round(chunk_scores * np.float32(100), 2))
 
-    # If the directory did change if the model file could
-    # not be found, change back to the previous directory.
-    if directory_changed:
-        os.chdir(prev_changed_dir)
+    ranked_ids, _ = selector.result()
 
-    final_users: list[dict[str, any]] = [user_profiles["users"][user] for user in recommended_users.keys()]
+    final_users: list[dict[str, any]] = [user_profiles["users"][user_index[i]] for i in ranked_ids]
 
     # List of columns to drop.
     cols_to_drop = [
@@ -263,6 +230,9 @@ def generate_mock_recommendations(df: pd.DataFrame,
 
 # Function to drop columns with sensitive information.
 def drop_cols(recommended_users: list[dict[str, any]], cols_to_drop: list[str]):
+    if not recommended_users:
+        return []
+    
     recommended_users = pd.DataFrame(recommended_users).drop(columns=cols_to_drop).to_dict('records')
     return recommended_users
 
@@ -0,0 +1,270 @@
+# TensorFlow-free serving backend of the matching model.
+#
+# The matching model is a small stack of dense layers, so serving it does not
+# need Keras (or TensorFlow) to be loaded in every server process. The weights
+# of the dense layers are exported once from matching_model.h5 into a compact
+# .npz file, and the forward pass is run with NumPy. Dropout layers are only
+# active while training, so they are left out.
+#
+# The weights can also be served with reduced precision, as float16 or int8
+# (see quantize_model_weights), which shrinks them by 2x or 4x. NumPy has no
+# float16 or int8 matrix products, so the arithmetic itself still runs in
+# float32: float16 weights are upcast layer by layer, and int8 layers multiply
+# the quantized activations by the quantized weights as whole numbers in float32
+# (which is exact, as their sums stay far below 2^24) before scaling them back.
+#
+# To (re)export the weights after the model was retrained, run the following
+# command from the src/backend directory, which also reports how closely the
+# reduced-precision weights rank a synthetic set of candidates compared to the
+# full-precision ones:
+#
+#   python -m models.ml_numpy_model
+
+import numpy as np
+import os
+
+from .ml_ranking import TopKSelector, RECOMMENDATION_LIMIT
+
+# Precisions the weights of the NumPy backend can be stored in.
+MODEL_PRECISIONS = ["float32", "float16", "int8"]
+
+# Largest magnitude of an int8 value used by the quantized weights and
+# activations (symmetric, so that 0 stays exactly 0).
+INT8_MAX = 127
+
+# Activations of the dense layers that the NumPy forward pass supports.
+def relu(x: np.ndarray) -> np.ndarray:
+    return np.maximum(x, 0, out=x)
+
+def sigmoid(x: np.ndarray) -> np.ndarray:
+    np.negative(x, out=x)
+    np.exp(x, out=x)
+    np.add(x, 1, out=x)
+    return np.reciprocal(x, out=x)
+
+def linear(x: np.ndarray) -> np.ndarray:
+    return x
+
+ACTIVATIONS = {
+    "relu": relu,
+    "sigmoid": sigmoid,
+    "linear": linear
+}
+
+# Layers that do nothing at inference time.
+SKIPPED_LAYERS = ["Dropout", "InputLayer"]
+
+# Extracts the weights and activations of the dense layers of the Keras model
+# stored at h5_path, in order, into an .npz file at npz_path.
+def export_model_weights(h5_path: str, npz_path: str) -> None:
+    import keras
+
+    model = keras.models.load_model(h5_path, compile=False)
+    arrays: dict[str, np.ndarray] = {}
+    activations: list[str] = []
+
+    for layer in model.layers:
+        layer_type = layer.__class__.__name__
+
+        if layer_type in SKIPPED_LAYERS:
+            continue
+
+        activation = layer.get_config().get("activation")
+
+        if layer_type != "Dense" or activation not in ACTIVATIONS:
+            raise ValueError(f"Cannot export layer {layer.name} ({layer_type}, activation={activation}).")
+
+        weights = layer.get_weights()
+        kernel = weights[0]
+        bias = weights[1] if len(weights) > 1 else np.zeros(kernel.shape[1])
+
+        arrays[f"kernel_{len(activations)}"] = np.asarray(kernel, dtype=np.float32)
+        arrays[f"bias_{len(activations)}"] = np.asarray(bias, dtype=np.float32)
+        activations.append(activation)
+
+    arrays["activations"] = np.array(activations)
+    arrays["precision"] = np.array("float32")
+
+    save_model_weights(arrays, npz_path)
+
+def save_model_weights(arrays: dict[str, np.ndarray], npz_path: str) -> None:
+    # Write to a temporary file first and then move it in place, so that a
+    # server reloading the weights never reads a half-written file.
+    temp_path = f"{npz_path}.tmp"
+
+    with open(temp_path, "wb") as f:
+        np.savez(f, **arrays)
+
+    os.replace(temp_path, npz_path)
+
+# Synthetic preprocessed candidate rows (see SCORE_COLUMNS in ml_match_algo.py,
+# without the similarity score), drawn from the same values the attribute
+# scores and visits of real candidates take. Used to calibrate the int8
+# weights and to check the rankings of the reduced-precision weights.
+def synthetic_features(num_rows: int = 20000, seed: int = 0) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+
+    return np.column_stack([
+        np.round(rng.beta(0.6, 2., num_rows), 2),                                 # interests
+        np.round(1 - np.abs(rng.normal(0, 6, num_rows)).clip(0, 30) / 100, 2),    # height
+        rng.choice([-1., 1.], num_rows),                                          # sexual orientation
+        rng.choice([0., 0.38, 0.5, 0.71, 1.], num_rows, p=[0.6, 0.1, 0.1, 0.1, 0.1]),  # residence
+        rng.choice([0., 1.], num_rows, p=[0.7, 0.3]),                             # relationship status
+        rng.poisson(3, num_rows).astype(np.float64)                               # visits
+    ]).astype(np.float32)
+
+# Converts the float32 weights stored at npz_path into the given precision and
+# saves them to out_path.
+#
+# For int8, the scale of each input of each layer is calibrated on the largest
+# value that input takes over the calibration rows (synthetic ones, if none are
+# given), so that e.g. the visits do not crush the attribute scores. The input
+# scales are folded into the kernel, which is then quantized per output column.
+def quantize_model_weights(npz_path: str,
+                           out_path: str,
+                           precision: str,
+                           calibration_features: np.ndarray | None = None) -> None:
+    if precision not in MODEL_PRECISIONS:
+        raise ValueError(f"Unknown precision: {precision}.")
+
+    model = NumpyModel(npz_path)
+
+    if model.precision != "float32":
+        raise ValueError("Only float32 weights can be quantized.")
+
+    arrays: dict[str, np.ndarray] = {
+        "activations": np.array([activation for _, _, activation in model.layers]),
+        "precision": np.array(precision)
+    }
+
+    if calibration_features is None:
+        calibration_features = synthetic_features()
+
+    x = np.asarray(calibration_features, dtype=np.float32)
+
+    for i, (kernel, bias, activation) in enumerate(model.layers):
+        arrays[f"bias_{i}"] = bias
+
+        if precision == "int8":
+            # Inputs that were always 0 (e.g. units the ReLU never activated)
+            # get the largest scale of the layer.
+            input_scale = np.abs(x).max(axis=0) / INT8_MAX
+            input_scale[input_scale == 0] = input_scale.max() if input_scale.any() else 1.
+
+            scaled_kernel = kernel * input_scale[:, np.newaxis]
+            kernel_scale = np.abs(scaled_kernel).max(axis=0) / INT8_MAX
+            kernel_scale[kernel_scale == 0] = 1.
+
+            arrays[f"kernel_{i}"] = np.round(scaled_kernel / kernel_scale).astype(np.int8)
+            arrays[f"kernel_scale_{i}"] = kernel_scale.astype(np.float32)
+            arrays[f"input_scale_{i}"] = input_scale.astype(np.float32)
+        else:
+            arrays[f"kernel_{i}"] = kernel.astype(precision)
+
+        # The next layer is calibrated on the full-precision outputs of this one.
+        x = ACTIVATIONS[activation](x @ kernel + bias)
+
+    save_model_weights(arrays, out_path)
+
+# Compares the rankings of the same candidates by a model and by a reference
+# (full-precision) model. The candidates are split into pools of pool_size rows,
+# as if each pool belonged to a different user, and the top k of each pool is
+# selected the same way as in rank_candidates.
+#
+# Returns the average share of the reference top k found in the model's top k,
+# the share of pools whose top k is in exactly the same order, and the largest
+# difference between the scores (as percentages) of the two models.
+def compare_rankings(reference_model,
+                     model,
+                     features: np.ndarray | None = None,
+                     k: int = RECOMMENDATION_LIMIT,
+                     pool_size: int = 1000) -> dict[str, float]:
+    if features is None:
+        features = synthetic_features()
+
+    reference_scores = np.round(np.asarray(reference_model.predict_on_batch(features)).reshape(-1) * np.float32(100), 2)
+    scores = np.round(np.asarray(model.predict_on_batch(features)).reshape(-1) * np.float32(100), 2)
+
+    overlaps: list[float] = []
+    same_order: list[bool] = []
+
+    for start in range(0, len(features), pool_size):
+        rankings = []
+
+        for pool_scores in [reference_scores, scores]:
+            selector = TopKSelector(k)
+            selector.push(pool_scores[start:start + pool_size])
+            rankings.append(selector.result()[0].tolist())
+
+        overlaps.append(len(set(rankings[0]) & set(rankings[1])) / max(len(rankings[0]), 1))
+        same_order.append(rankings[0] == rankings[1])
+
+    return {
+        "top_k_overlap": float(np.mean(overlaps)),
+        "same_order": float(np.mean(same_order)),
+        "max_score_difference": float(np.abs(scores - reference_scores).max())
+    }
+
+# Forward pass of the exported dense layers. It has the same predict_on_batch
+# method and input_shape attribute as the Keras model, so that it can be used
+# in its place (see predict_chunks in ml_inference.py).
+#
+# The weights are kept in the precision they were stored in (see
+# quantize_model_weights).
+class NumpyModel:
+    def __init__(self, path: str):
+        with np.load(path) as weights:
+            activations: list[str] = weights["activations"].tolist()
+            self.precision: str = str(weights["precision"]) if "precision" in weights else "float32"
+
+            self.layers: list[tuple[np.ndarray, np.ndarray, str]] = [
+                (weights[f"kernel_{i}"], weights[f"bias_{i}"], activation)
+                for i, activation in enumerate(activations)
+            ]
+
+            # Scales of the quantized kernels (per output column) and of the
+            # inputs (per input column) of each layer.
+            if self.precision == "int8":
+                self.scales: list[tuple[np.ndarray, np.ndarray]] = [
+                    (weights[f"kernel_scale_{i}"], weights[f"input_scale_{i}"])
+                    for i in range(len(activations))
+                ]
+
+        self.input_shape: tuple = (None, self.layers[0][0].shape[0])
+
+    # Total size of the weights in bytes.
+    def nbytes(self) -> int:
+        return sum(kernel.nbytes + bias.nbytes for kernel, bias, _ in self.layers)
+
+    def predict_on_batch(self, features: np.ndarray) -> np.ndarray:
+        x = np.asarray(features, dtype=np.float32)
+
+        for i, (kernel, bias, activation) in enumerate(self.layers):
+            if self.precision == "int8":
+                kernel_scale, input_scale = self.scales[i]
+
+                x = np.clip(np.rint(x / input_scale), -INT8_MAX, INT8_MAX)
+                x = x @ kernel.astype(np.float32)
+                x *= kernel_scale
+            else:
+                x = x @ kernel.astype(np.float32, copy=False)
+
+            x += bias
+            x = ACTIVATIONS[activation](x)
+
+        return x
+
+if __name__ == "__main__":
+    from class_models import MODEL_PATH, NUMPY_MODEL_PATH, QUANTIZED_MODEL_PATHS
+
+    export_model_weights(MODEL_PATH, NUMPY_MODEL_PATH)
+    print(f"Exported the weights of {MODEL_PATH} to {NUMPY_MODEL_PATH}.")
+
+    reference_model = NumpyModel(NUMPY_MODEL_PATH)
+    check_features = synthetic_features(seed=1)
+
+    for precision, path in QUANTIZED_MODEL_PATHS.items():
+        quantize_model_weights(NUMPY_MODEL_PATH, path, precision)
+        model = NumpyModel(path)
+
+        print(f"Exported the {precision} weights ({model.nbytes()} bytes) to {path}: {compare_rankings(reference_model, model, check_features)}")
@@ -0,0 +1,99 @@
+# Sexual orientation filter of the matching algorithm.
+#
+# The gender of every candidate, and each of their gender interests, is
+# encoded as a bit in a small integer when the candidates are loaded, so that
+# checking whether a candidate and the current user are interested in each
+# other's gender is a single vectorized mask over all of the candidates.
+
+import numpy as np
+import pandas as pd
+import threading
+
+from .ml_candidates import CandidateTable
+
+# Genders that can be selected when signing up. Each of them is given a fixed
+# bit, and any other gender or gender interest is given the next free one.
+KNOWN_GENDERS = ["Male", "Female", "Non-binary", "Transgender Man", "Transgender Woman", "Other"]
+
+# Genders for which both users have to be interested in each other's gender.
+# Users of any other gender only need the candidate's gender to be among
+# their own gender interests.
+BINARY_GENDERS = ["Male", "Female"]
+
+MAX_ORIENTATION_BITS = 64
+
+# Splits the gender interests of a user the same way the original filter did,
+# e.g. "Males, Females" into ["Male", "Female"].
+def split_gender_interests(interested_in: str) -> list[str]:
+    return interested_in.replace("s", "").split(", ")
+
+# Process-wide mapping of genders (and gender interests) to bits.
+class OrientationVocabulary:
+    def __init__(self, known_genders: list[str] = KNOWN_GENDERS):
+        self._bits: dict[str, int] = {gender: i for i, gender in enumerate(known_genders)}
+        self._lock = threading.Lock()
+
+    def bit(self, value: str) -> int:
+        bit = self._bits.get(value)
+
+        if bit is None:
+            with self._lock:
+                bit = self._bits.get(value)
+
+                if bit is None:
+                    if len(self._bits) >= MAX_ORIENTATION_BITS:
+                        raise ValueError(f"Cannot encode more than {MAX_ORIENTATION_BITS} genders and gender interests.")
+
+                    bit = len(self._bits)
+                    self._bits[value] = bit
+
+        return 1 << bit
+
+    def encode_gender(self, gender: str | None) -> int:
+        return self.bit(gender or "")
+
+    def encode_gender_interests(self, interested_in: str | None) -> int:
+        mask = 0
+
+        for interest in split_gender_interests(interested_in or ""):
+            mask |= self.bit(interest)
+
+        return mask
+
+# Vocabulary shared by every request in the current process.
+orientation_vocabulary = OrientationVocabulary()
+
+# Encodes the gender and gender interests of every candidate as bitmasks,
+# stored in the gender_bits and interest_bits columns of the table (or DataFrame).
+def encode_orientations(df: CandidateTable | pd.DataFrame) -> CandidateTable | pd.DataFrame:
+    genders = np.asarray(df["gender"], dtype=object)
+    gender_interests = np.asarray(df["interested_in"], dtype=object)
+
+    # Encode each distinct value once, as many candidates share the same ones.
+    gender_codes = {value: orientation_vocabulary.encode_gender(value) for value in set(genders)}
+    interest_codes = {value: orientation_vocabulary.encode_gender_interests(value) for value in set(gender_interests)}
+
+    df["gender_bits"] = np.array([gender_codes[value] for value in genders], dtype=np.uint64)
+    df["interest_bits"] = np.array([interest_codes[value] for value in gender_interests], dtype=np.uint64)
+
+    return df
+
+# Returns a mask of the candidates whose gender is among the gender interests
+# of the current user and, unless the current user identifies as anything
+# other than male or female, who are interested in the current user's gender.
+#
+# Every candidate passes if the current user is pansexual and/or interested
+# in anyone, regardless of gender.
+def orientation_mask(gender_bits: np.ndarray, interest_bits: np.ndarray, current_user: dict[str, any]) -> np.ndarray:
+    if current_user["sexual_orientation"] == "Pansexual" or current_user["interested_in"] == "Anyone":
+        return np.ones(len(gender_bits), dtype=bool)
+
+    current_user_gender = np.uint64(orientation_vocabulary.encode_gender(current_user["gender"]))
+    current_user_interests = np.uint64(orientation_vocabulary.encode_gender_interests(current_user["interested_in"]))
+
+    mask = (gender_bits & current_user_interests) != 0
+
+    if current_user["gender"] in BINARY_GENDERS:
+        mask &= (interest_bits & current_user_gender) != 0
+
+    return mask
@@ -0,0 +1,154 @@
+# Batch recommendation job and the precomputed match lists it writes.
+#
+# Instead of running the matching algorithm for every user while they wait
+# for /match, the job ranks the candidates of every user in batches (see
+# ml_batch_matching.py) and writes their top matches (with their scores) to the Precomputed_Matches table
+# (see sql/precomputed_matches.sql). /match then serves them with a single
+# indexed read, and only recomputes the matches of users whose list is stale:
+# they (or one of their top matches) changed their profile after it was
+# computed, or it is older than PRECOMPUTED_MATCH_MAX_AGE.
+#
+# To run the job (e.g. nightly), run the following command from the
+# src/backend directory:
+#
+#   python -m models.ml_precomputed_matches
+
+from dotenv import load_dotenv
+import numpy as np
+import psycopg2
+import time
+import os
+
+from .ml_match_algo import drop_cols, SENSITIVE_COLUMNS
+from .ml_candidates import load_profile_table, PROFILE_METADATA_COLUMNS
+from .ml_batch_matching import run_batch_algorithm
+from .ml_ranking import RECOMMENDATION_LIMIT
+
+# Number of matches stored for each user.
+PRECOMPUTED_MATCH_LIMIT = int(os.environ.get("PRECOMPUTED_MATCH_LIMIT", 1000))
+
+# Number of users whose matches are ranked together (see ml_batch_matching.py).
+PRECOMPUTE_BATCH_SIZE = int(os.environ.get("PRECOMPUTE_BATCH_SIZE", 500))
+
+# Number of seconds a stored match list is served for. Matches ranked below the
+# top ones are not checked for profile changes, so lists older than this are
+# recomputed instead. Defaults to 36 hours, so that the lists of a nightly job
+# are still served if it runs late.
+PRECOMPUTED_MATCH_MAX_AGE = int(os.environ.get("PRECOMPUTED_MATCH_MAX_AGE", 129600))
+
+# Replaces the stored match list of a user.
+def store_matches(cursor: psycopg2.extensions.cursor,
+                  username: str,
+                  use_so_filter: bool,
+                  matches: list[str],
+                  scores: np.ndarray) -> None:
+    cursor.execute("DELETE FROM Precomputed_Matches WHERE username=%s AND use_so_filter=%s", [username, use_so_filter])
+
+    statement = '''
+        INSERT INTO Precomputed_Matches (username, use_so_filter, rank, match_username, score, computed_at)
+        VALUES (%s, %s, %s, %s, %s, now())
+    '''
+    params = [
+        (username, use_so_filter, rank, match, round(float(score), 2))
+        for rank, (match, score) in enumerate(zip(matches, scores))
+    ]
+
+    cursor.executemany(statement, params)
+
+# Computes and stores the match lists of the given users (or of every user).
+# Returns the number of users whose matches were stored.
+def precompute_matches(db: psycopg2.extensions.connection,
+                       cursor: psycopg2.extensions.cursor,
+                       usernames: list[str] | None = None,
+                       top_n: int = PRECOMPUTED_MATCH_LIMIT) -> int:
+    if usernames is None:
+        cursor.execute("SELECT username FROM Profiles")
+        usernames = [record[0] for record in cursor.fetchall()]
+
+    num_stored = 0
+
+    for start in range(0, len(usernames), PRECOMPUTE_BATCH_SIZE):
+        batch = usernames[start:start + PRECOMPUTE_BATCH_SIZE]
+
+        # Rank the matches of the whole batch at once, for both settings of the
+        # sexual orientation filter.
+        try:
+            rankings = run_batch_algorithm(batch, db, cursor, [False, True], top_n)
+
+        except (psycopg2.DatabaseError, ValueError, TypeError) as e:
+            db.rollback()
+            print(f"Failed to precompute the matches of {len(batch)} users: {e}")
+            continue
+
+        for username in batch:
+            try:
+                for use_so_filter, (ranked_users, scores) in rankings[username].items():
+                    store_matches(cursor, username, use_so_filter, ranked_users, scores)
+
+                # Commit each user on their own, so that a failure doesn't
+                # discard the lists of the users before them.
+                db.commit()
+                num_stored += 1
+
+            except (psycopg2.DatabaseError, ValueError, TypeError) as e:
+                db.rollback()
+                print(f"Failed to precompute the matches of {username}: {e}")
+
+    return num_stored
+
+# Returns the stored matches of a user as profiles (from most to least similar),
+# or None if they have not been computed yet or are stale: the user or one of
+# their top num_checked matches changed their profile after they were computed,
+# or they are older than PRECOMPUTED_MATCH_MAX_AGE.
+def load_precomputed_matches(cursor: psycopg2.extensions.cursor,
+                             username: str,
+                             use_so_filter: bool,
+                             num_checked: int = RECOMMENDATION_LIMIT) -> list[dict[str, any]] | None:
+    statement = '''
+        SELECT m.match_username, m.rank < %s AND EXISTS (
+            SELECT 1 FROM User_Features f
+            WHERE f.username=m.match_username AND f.updated_at > m.computed_at
+        )
+        FROM Precomputed_Matches m
+        WHERE m.username=%s AND m.use_so_filter=%s
+        AND m.computed_at > now() - make_interval(secs => %s) AND NOT EXISTS (
+            SELECT 1 FROM User_Features f
+            WHERE f.username=m.username AND f.updated_at > m.computed_at
+        )
+        ORDER BY m.rank
+    '''
+    cursor.execute(statement, [num_checked, username, use_so_filter, PRECOMPUTED_MATCH_MAX_AGE])
+    records: list[tuple] = cursor.fetchall()
+
+    # The scores of the top matches that changed their profile may have changed
+    # as well, so they may no longer be in the right order.
+    if not records or any(changed for _, changed in records):
+        return None
+
+    ranked_users: list[str] = [record[0] for record in records]
+
+    # Only the profiles of the stored matches are loaded, without their photos
+    # (see hydrate_photos in ml_candidates.py). Matches that are no longer
+    # candidates of the user are left out.
+    statement = f"SELECT {', '.join(PROFILE_METADATA_COLUMNS)} FROM get_user_profiles(%s) WHERE username = ANY(%s)"
+    cursor.execute(statement, [username, ranked_users])
+    user_profiles = load_profile_table(cursor)
+
+    matches = [user_profiles.profile(user_profiles.row_id(user)) for user in ranked_users if user in user_profiles]
+
+    return drop_cols(matches, SENSITIVE_COLUMNS)
+
+if __name__ == "__main__":
+    load_dotenv("secret.env")
+
+    db = psycopg2.connect(os.environ.get("DB_KEY"))
+    cursor = db.cursor()
+
+    try:
+        start = time.time()
+        num_stored = precompute_matches(db, cursor)
+        print(f"Precomputed the matches of {num_stored} users in {round(time.time() - start, 2)} seconds.")
+
+    finally:
+        cursor.close()
+        db.close()
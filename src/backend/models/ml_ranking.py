@@ -0,0 +1,62 @@
+import numpy as np
+
+# Number of recommendations returned by the matching algorithm.
+RECOMMENDATION_LIMIT = 10
+
+# Keeps the k highest scores (and the ids of the users they belong to) out of
+# the scores pushed into it, chunk by chunk, so that ranking the candidates
+# no longer requires sorting all of them.
+#
+# Users with the same score are ranked in the order they were pushed, which
+# is the order a stable sort from highest to lowest score would give them.
+class TopKSelector:
+    def __init__(self, k: int):
+        if k < 0:
+            raise ValueError("k must not be negative.")
+
+        self.k = k
+        self.scores = np.empty(0, dtype=np.float64)
+        self.ids = np.empty(0, dtype=np.int64)
+        self._num_pushed = 0
+
+    # Pushes a chunk of scores into the selector. If no ids are given, the
+    # position of each score among all the scores pushed so far is used.
+    def push(self, scores: np.ndarray, ids: np.ndarray | None = None) -> None:
+        scores = np.asarray(scores, dtype=np.float64).reshape(-1)
+
+        if ids is None:
+            ids = np.arange(self._num_pushed, self._num_pushed + len(scores), dtype=np.int64)
+        else:
+            ids = np.asarray(ids, dtype=np.int64).reshape(-1)
+
+        self._num_pushed += len(scores)
+
+        self.scores = np.concatenate([self.scores, scores])
+        self.ids = np.concatenate([self.ids, ids])
+
+        if len(self.scores) > self.k:
+            keep = select_top_k(self.scores, self.ids, self.k)
+            self.scores, self.ids = self.scores[keep], self.ids[keep]
+
+    # Returns the ids and scores that were kept, from highest to lowest score.
+    def result(self) -> tuple[np.ndarray, np.ndarray]:
+        order = np.lexsort((self.ids, -self.scores))
+        return self.ids[order], self.scores[order]
+
+# Returns the positions of the k highest scores (unordered) in O(N) with
+# argpartition. Scores tied with the k-th highest one are broken in favor of
+# the lowest ids.
+def select_top_k(scores: np.ndarray, ids: np.ndarray, k: int) -> np.ndarray:
+    if k <= 0:
+        return np.empty(0, dtype=np.int64)
+
+    if len(scores) <= k:
+        return np.arange(len(scores))
+
+    kth_score = scores[np.argpartition(-scores, k - 1)[k - 1]]
+
+    above = np.flatnonzero(scores > kth_score)
+    tied = np.flatnonzero(scores == kth_score)
+    tied = tied[np.argsort(ids[tied], kind="stable")][0:k - len(above)]
+
+    return np.concatenate([above, tied])
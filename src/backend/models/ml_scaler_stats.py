@@ -0,0 +1,197 @@
+# Scaling statistics of the similarity score.
+#
+# The similarity score of each candidate is the average of their attribute
+# scores scaled to [0, 1] and their visits. Instead of fitting a MinMaxScaler on
+# the candidate pool of every request, which takes a full pass over the scores
+# and makes the similarity score of a candidate depend on who else happens to be
+# in the pool, the scores are scaled with the range each attribute score can
+# take across every profile. The ranges are computed offline and saved to disk,
+# so that scaling the scores of a request is a single multiply-add.
+#
+# The similarity score is not an input of the model, so the statistics are
+# only recomputed from time to time instead of on every profile change. Heights
+# outside of the saved range merely scale to just outside of [0, 1] until then.
+#
+# The text attribute scores are dot products of L2-normalized TF-IDF vectors, so
+# they always lie in [0, 1] (or are either -1 or 1 for the sexual orientation).
+# The height score depends on the difference between the heights of two users,
+# so its range follows the running minimum and maximum height of every profile.
+#
+# To (re)compute the statistics from every profile, run the following command
+# from the src/backend directory (the running servers pick them up on their own):
+#
+#   python -m models.ml_scaler_stats
+
+from dotenv import load_dotenv
+import numpy as np
+import psycopg2
+import threading
+import os
+
+# Location of the saved statistics. It can be overridden with the
+# SCALER_STATS_PATH environment variable.
+SCALER_STATS_PATH = os.environ.get(
+    "SCALER_STATS_PATH",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "scaler_stats.npz")
+)
+
+# Attribute scores that are scaled, in the same order as in the score matrix
+# (see SCORE_COLUMNS in ml_match_algo.py).
+ATTRIBUTE_SCORES = ["interests", "height", "sexual_orientation", "residence", "relationship_status"]
+
+# Ranges of the attribute scores that do not depend on the profiles.
+TEXT_SCORE_RANGES = {
+    "interests": (0., 1.),
+    "sexual_orientation": (-1., 1.),
+    "residence": (0., 1.),
+    "relationship_status": (0., 1.)
+}
+
+class ScalerStats:
+    def __init__(self, min_height: float = np.inf, max_height: float = -np.inf):
+        self.min_height = min_height
+        self.max_height = max_height
+        self._update_scaling()
+
+    # Widens the range of heights with the heights (in inches) of the given
+    # profiles. Returns True if it changed.
+    def update(self, heights: np.ndarray) -> bool:
+        heights = np.asarray(heights, dtype=np.float64)
+        heights = heights[~np.isnan(heights)]
+
+        if len(heights) == 0:
+            return False
+
+        min_height = min(self.min_height, float(heights.min()))
+        max_height = max(self.max_height, float(heights.max()))
+
+        if (min_height, max_height) == (self.min_height, self.max_height):
+            return False
+
+        self.min_height, self.max_height = min_height, max_height
+        self._update_scaling()
+
+        return True
+
+    # Smallest and largest value of each attribute score.
+    def data_range(self) -> tuple[np.ndarray, np.ndarray]:
+        ranges = dict(TEXT_SCORE_RANGES)
+
+        # From the users furthest apart in height to users of the same height.
+        if self.min_height <= self.max_height:
+            ranges["height"] = (1 - (self.max_height - self.min_height) / 100, 1.)
+        else:
+            ranges["height"] = (0., 1.)
+
+        data_min = np.array([ranges[score][0] for score in ATTRIBUTE_SCORES])
+        data_max = np.array([ranges[score][1] for score in ATTRIBUTE_SCORES])
+
+        return data_min, data_max
+
+    # The scale and offset of each attribute score are replaced together, so
+    # that requests scoring concurrently never mix the two.
+    def _update_scaling(self) -> None:
+        data_min, data_max = self.data_range()
+
+        # Same as MinMaxScaler, which leaves constant scores unscaled.
+        data_range = data_max - data_min
+        data_range[data_range < 10 * np.finfo(np.float64).eps] = 1.
+        scale = 1. / data_range
+
+        self.scaling: tuple[np.ndarray, np.ndarray] = (scale, 0. - data_min * scale)
+
+def save_scaler_stats(stats: ScalerStats, path: str = SCALER_STATS_PATH) -> None:
+    # Write to a temporary file first and then move it in place, so that a
+    # server reloading the statistics never reads a half-written file.
+    temp_path = f"{path}.{os.getpid()}.tmp"
+
+    with open(temp_path, "wb") as f:
+        np.savez(f, heights=np.array([stats.min_height, stats.max_height]))
+
+    os.replace(temp_path, path)
+
+def load_scaler_stats(path: str = SCALER_STATS_PATH) -> ScalerStats:
+    with np.load(path) as arrays:
+        min_height, max_height = arrays["heights"].tolist()
+
+    return ScalerStats(min_height, max_height)
+
+# Computes the statistics from the heights of every profile.
+def fit_scaler_stats(cursor: psycopg2.extensions.cursor) -> ScalerStats:
+    from .ml_candidates import load_candidate_table, height_inches
+
+    cursor.execute("SELECT height, height_inches FROM Profiles")
+
+    stats = ScalerStats()
+    stats.update(height_inches(load_candidate_table(cursor)))
+
+    return stats
+
+# Process-wide registry of the scaling statistics, following the same pattern
+# as the VectorizerRegistry in ml_feature_fitting.py.
+#
+# If the statistics have not been computed yet, get() returns None and the
+# scores of each request are scaled with the range of the candidate pool.
+class ScalerStatsRegistry:
+    def __init__(self, path: str = SCALER_STATS_PATH):
+        self.path: str = path
+        self._stats: ScalerStats | None = None
+        self._loaded_mtime: float | None = None
+        self._lock = threading.Lock()
+
+    def get(self) -> ScalerStats | None:
+        stats = self._stats
+
+        if stats is None and os.path.isfile(self.path):
+            with self._lock:
+                if self._stats is None:
+                    self._loaded_mtime = os.path.getmtime(self.path)
+                    self._stats = load_scaler_stats(self.path)
+
+                stats = self._stats
+
+        return stats
+
+    # Returns the scale and offset of each attribute score, or None if the
+    # statistics have not been computed yet.
+    def get_scaling(self) -> tuple[np.ndarray, np.ndarray] | None:
+        stats = self.get()
+
+        return None if stats is None else stats.scaling
+
+    # Swaps the statistics if they were recomputed since they were last loaded.
+    # Returns True if they were swapped.
+    def reload_if_changed(self) -> bool:
+        try:
+            mtime = os.path.getmtime(self.path)
+        except OSError:
+            return False
+
+        if self._loaded_mtime is not None and mtime != self._loaded_mtime:
+            stats = load_scaler_stats(self.path)
+
+            with self._lock:
+                self._stats = stats
+                self._loaded_mtime = mtime
+
+            return True
+
+        return False
+
+# Registry shared by every request in the current process.
+scaler_stats_registry = ScalerStatsRegistry()
+
+if __name__ == "__main__":
+    load_dotenv("secret.env")
+
+    db = psycopg2.connect(os.environ.get("DB_KEY"))
+    cursor = db.cursor()
+
+    try:
+        stats = fit_scaler_stats(cursor)
+        save_scaler_stats(stats)
+        print(f"Computed the scaling statistics (heights from {stats.min_height} to {stats.max_height} inches) and saved them to {SCALER_STATS_PATH}.")
+
+    finally:
+        cursor.close()
+        db.close()
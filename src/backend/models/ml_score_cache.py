@@ -0,0 +1,148 @@
+# Pairwise score cache of the matching algorithm.
+#
+# Most profiles rarely change, so the attribute scores of a user and one of their
+# candidates are usually the same from one match to the next. The cache keeps the
+# attribute scores (see score_attributes in ml_scoring.py) of every pair scored by
+# the feature store path, keyed by (viewer, candidate, viewer version, candidate
+# version), where the versions are those of the users' rows in the feature store
+# (bumped every time a user updates their profile, see ml_feature_store.py). A
+# pair is only scored again once either of the two users changed. As the
+# versions are part of the key, outdated scores are never returned, even by
+# processes (e.g. the match workers) whose own cache was not invalidated.
+#
+# The pairs are stored per viewer version, in the order of the viewer's last
+# candidate pool. As the candidates of a user usually come back in the same order
+# from one match to the next, the scores of a whole pool are then looked up at
+# once instead of pair by pair. Viewers are evicted from the least recently used
+# one once the cache holds more than its memory cap.
+
+from collections import OrderedDict
+import numpy as np
+import threading
+import sys
+import os
+
+# Memory cap of the cache in bytes. Set to 0 to disable it.
+SCORE_CACHE_MAX_BYTES = int(os.environ.get("SCORE_CACHE_MAX_BYTES", 64 * 2 ** 20))
+
+# Number of attribute scores cached for each pair.
+NUM_ATTRIBUTE_SCORES = 5
+
+# Memory taken by a username besides its characters.
+USERNAME_OVERHEAD = sys.getsizeof("")
+
+# Cached scores of the candidates of one version of a viewer.
+class ViewerScores:
+    def __init__(self, usernames: np.ndarray, versions: np.ndarray, scores: np.ndarray):
+        self.usernames: np.ndarray = np.array(usernames, dtype=object)
+        self.versions: np.ndarray = np.array(versions, dtype=np.int64)
+        self.scores: np.ndarray = np.array(scores[:, 0:NUM_ATTRIBUTE_SCORES], dtype=np.float64)
+
+        self.nbytes: int = (self.usernames.nbytes + self.versions.nbytes + self.scores.nbytes
+                            + len(self.usernames) * USERNAME_OVERHEAD + sum(map(len, self.usernames)))
+
+    # Copies the cached scores of the given candidates into out, and returns a
+    # mask of the candidates that were found with the same version.
+    def lookup(self, usernames: np.ndarray, versions: np.ndarray, out: np.ndarray) -> np.ndarray:
+        if len(usernames) == len(self.usernames) and (usernames == self.usernames).all():
+            hits = self.versions == versions
+
+            if hits.all():
+                out[:] = self.scores
+            else:
+                out[hits] = self.scores[hits]
+
+            return hits
+
+        # The pool changed since it was cached, so each candidate is looked up
+        # on their own.
+        row_ids = {username: i for i, username in enumerate(self.usernames)}
+        rows = np.fromiter((row_ids.get(username, -1) for username in usernames), dtype=np.int64, count=len(usernames))
+
+        hits = rows >= 0
+        hits[hits] = self.versions[rows[hits]] == versions[hits]
+        out[hits] = self.scores[rows[hits]]
+
+        return hits
+
+class PairScoreCache:
+    def __init__(self, max_bytes: int = SCORE_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._viewers: OrderedDict[tuple[str, int], ViewerScores] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._viewers)
+
+    # Copies the cached attribute scores of the given candidates of the given
+    # version of the viewer into out, and returns a mask of the candidates that
+    # were found.
+    def lookup(self,
+               viewer: str,
+               viewer_version: int,
+               usernames: np.ndarray,
+               versions: np.ndarray,
+               out: np.ndarray) -> np.ndarray:
+        with self._lock:
+            entry = self._viewers.get((viewer, viewer_version))
+
+            if entry is not None:
+                self._viewers.move_to_end((viewer, viewer_version))
+
+        hits = np.zeros(len(usernames), dtype=bool) if entry is None else entry.lookup(usernames, versions, out)
+
+        with self._lock:
+            self.hits += int(hits.sum())
+            self.misses += len(hits) - int(hits.sum())
+
+        return hits
+
+    # Replaces the cached scores of the given version of the viewer with the
+    # scores of the given candidates, and evicts the least recently used viewers
+    # until the cache fits in its memory cap again.
+    def store(self,
+              viewer: str,
+              viewer_version: int,
+              usernames: np.ndarray,
+              versions: np.ndarray,
+              scores: np.ndarray) -> None:
+        entry = ViewerScores(usernames, versions, scores)
+
+        # Pools too large to ever fit are not cached.
+        if entry.nbytes > self.max_bytes:
+            return
+
+        with self._lock:
+            previous = self._viewers.pop((viewer, viewer_version), None)
+
+            if previous is not None:
+                self.nbytes -= previous.nbytes
+
+            self._viewers[(viewer, viewer_version)] = entry
+            self.nbytes += entry.nbytes
+
+            while self.nbytes > self.max_bytes:
+                _, evicted = self._viewers.popitem(last=False)
+                self.nbytes -= evicted.nbytes
+
+    # Drops every cached version of the given viewer, e.g. once they updated
+    # their profile, as their scores can no longer be looked up.
+    def invalidate(self, viewer: str) -> None:
+        with self._lock:
+            for key in [key for key in self._viewers if key[0] == viewer]:
+                self.nbytes -= self._viewers.pop(key).nbytes
+
+    def metrics(self) -> dict[str, int]:
+        with self._lock:
+            return {
+                "viewers": len(self._viewers),
+                "bytes": self.nbytes,
+                "hits": self.hits,
+                "misses": self.misses
+            }
+
+# Cache shared by every request in the current process.
+pair_score_cache = PairScoreCache()
@@ -0,0 +1,180 @@
+# Fused scoring kernel of the matching algorithm.
+#
+# Instead of scoring each attribute with its own vectorizer, normalizer, and
+# temporary arrays, the kernel takes the packed feature rows of the candidates
+# (see FeatureSpace in ml_feature_fitting.py) and the segment matrix of the
+# current user, and fills in every column of the score matrix (see
+# SCORE_COLUMNS in ml_match_algo.py) in one pass. Its intermediate arrays are
+# allocated once and reused by every request handled by the same thread.
+
+import scipy.sparse as sp
+import numpy as np
+import threading
+
+from .ml_sim_calcs import round_decimals
+
+# Number of candidates the buffers of a new kernel can hold. They grow on
+# demand for larger candidate pools.
+SCORING_KERNEL_CAPACITY = 1024
+
+# Number of scores in each row of the score matrix: the five attribute scores,
+# the visits, and the similarity score.
+NUM_SCORES = 7
+
+class ScoringKernel:
+    def __init__(self, capacity: int = SCORING_KERNEL_CAPACITY):
+        self.capacity = 0
+        self._reserve(capacity)
+
+    def _reserve(self, num_rows: int) -> None:
+        if num_rows <= self.capacity:
+            return
+
+        self.capacity = max(num_rows, 2 * self.capacity)
+
+        # Dot products of the text features (interests, sexual orientation,
+        # residence, and relationship status).
+        self._dot_prods = np.empty((self.capacity, 4), dtype=np.float64)
+
+        # Attribute scores scaled to [0, 1] for the similarity score.
+        self._scaled = np.empty((self.capacity, 5), dtype=np.float64)
+
+        self._column = np.empty(self.capacity, dtype=np.float64)
+        self._scratch = np.empty(self.capacity, dtype=np.float64)
+
+    # Scores every candidate and returns the score matrix, written into out if
+    # it is given.
+    #
+    # If the sexual orientation scores were already calculated (e.g. from the
+    # compatibility table in ml_sim_calcs.py), they are used instead of the
+    # thresholded dot products.
+    #
+    # If the scale and offset of each attribute score are given (see
+    # ml_scaler_stats.py), they are used to scale the scores for the similarity
+    # score instead of the range of the candidate pool.
+    def score(self,
+              users_matrix: sp.csr_matrix,
+              users_heights: np.ndarray,
+              segment_matrix: sp.csr_matrix,
+              current_user_height: float,
+              visits: np.ndarray,
+              orientation_scores: np.ndarray | None = None,
+              out: np.ndarray | None = None,
+              scaling: tuple[np.ndarray, np.ndarray] | None = None) -> np.ndarray:
+        num_rows = users_matrix.shape[0]
+        self._reserve(num_rows)
+
+        dot_prods = self._dot_prods[0:num_rows]
+        (users_matrix @ segment_matrix).toarray(out=dot_prods)
+
+        return self.score_dot_prods(dot_prods, users_heights, current_user_height, visits, orientation_scores, out, scaling)
+
+    # Same as score, but from the dot products of the text features that were
+    # already calculated, e.g. for many users at once (see ml_batch_matching.py).
+    def score_dot_prods(self,
+                        dot_prods: np.ndarray,
+                        users_heights: np.ndarray,
+                        current_user_height: float,
+                        visits: np.ndarray,
+                        orientation_scores: np.ndarray | None = None,
+                        out: np.ndarray | None = None,
+                        scaling: tuple[np.ndarray, np.ndarray] | None = None) -> np.ndarray:
+        num_rows = dot_prods.shape[0]
+
+        if out is None:
+            out = np.empty((num_rows, NUM_SCORES), dtype=np.float64)
+
+        self.score_attributes(dot_prods, users_heights, current_user_height, orientation_scores, out)
+
+        return self.score_similarity(out, visits, scaling)
+
+    # Fills in the attribute scores (the first five columns of the score
+    # matrix) from the dot products of the text features. Each row only
+    # depends on the features of its own candidate and of the current user.
+    def score_attributes(self,
+                         dot_prods: np.ndarray,
+                         users_heights: np.ndarray,
+                         current_user_height: float,
+                         orientation_scores: np.ndarray | None,
+                         out: np.ndarray) -> np.ndarray:
+        num_rows = dot_prods.shape[0]
+        self._reserve(num_rows)
+
+        column = self._column[0:num_rows]
+        scratch = self._scratch[0:num_rows]
+
+        # Interests, sexual orientation, residence, and relationship status.
+        for score_column, dot_column in [(0, 0), (2, 1), (3, 2), (4, 3)]:
+            if score_column == 2 and orientation_scores is not None:
+                column[:] = orientation_scores
+            else:
+                column[:] = dot_prods[:, dot_column]
+
+            # Same thresholds as threshold_orientation_similarity.
+            if score_column == 2 and orientation_scores is None:
+                dissimilar = column <= 0.45
+                column[(column > 0.45) & (column <= 1.)] = -1
+                column[dissimilar] = 1
+
+            round_decimals(column, 2, out=out[:, score_column], scratch=scratch)
+
+        # Height.
+        np.subtract(users_heights, current_user_height, out=column)
+        np.abs(column, out=column)
+        np.subtract(100, column, out=column)
+        np.divide(column, 100, out=column)
+        round_decimals(column, 2, out=out[:, 1], scratch=scratch)
+
+        return out
+
+    # Fills in the visits and the similarity score of a score matrix whose
+    # attribute scores were already filled in (e.g. by score_attributes, or
+    # from the pairwise score cache in ml_score_cache.py).
+    def score_similarity(self,
+                         out: np.ndarray,
+                         visits: np.ndarray,
+                         scaling: tuple[np.ndarray, np.ndarray] | None = None) -> np.ndarray:
+        num_rows = out.shape[0]
+        self._reserve(num_rows)
+
+        scaled = self._scaled[0:num_rows]
+        column = self._column[0:num_rows]
+        scratch = self._scratch[0:num_rows]
+
+        out[:, 5] = visits
+
+        # Similarity score, i.e. the average of the attribute scores scaled to
+        # [0, 1] (the same way as MinMaxScaler does) and the visits.
+        attr_scores = out[:, 0:5]
+
+        if scaling is None and num_rows > 0:
+            data_min = attr_scores.min(axis=0)
+            data_range = attr_scores.max(axis=0) - data_min
+            data_range[data_range < 10 * np.finfo(np.float64).eps] = 1.
+            scale = 1. / data_range
+            scaling = (scale, 0. - data_min * scale)
+
+        if scaling is not None:
+            np.multiply(attr_scores, scaling[0], out=scaled)
+            np.add(scaled, scaling[1], out=scaled)
+
+        np.sum(scaled, axis=1, out=column)
+        np.add(column, visits, out=column)
+        np.divide(column, attr_scores.shape[1] + 1, out=column)
+        np.round(column, 3, out=column)
+        round_decimals(column, 2, out=out[:, 6], scratch=scratch)
+
+        return out
+
+_kernels = threading.local()
+
+# Returns the kernel of the current thread, so that concurrent requests never
+# share buffers.
+def get_scoring_kernel() -> ScoringKernel:
+    kernel = getattr(_kernels, "kernel", None)
+
+    if kernel is None:
+        kernel = ScoringKernel()
+        _kernels.kernel = kernel
+
+    return kernel
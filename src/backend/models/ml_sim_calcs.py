@@ -1,8 +1,11 @@
 import pandas as pd
 import numpy as np
+import scipy.sparse as sp
 from sklearn.feature_extraction.text import TfidfVectorizer
 from sklearn.preprocessing import Normalizer, MinMaxScaler
 from sklearn.metrics.pairwise import euclidean_distances, cosine_similarity
+import threading
+import weakref
 
 def initialize_vectorizer():
     return TfidfVectorizer(stop_words='english')
@@ -13,6 +16,113 @@ def initialize_normalizer():
 def initialize_min_max_scaler():
     return MinMaxScaler()
 
+# Turns the text of the candidates (df1) and the current user (df2) into
+# TF-IDF vectors.
+#
+# If a vectorizer that was already fitted by the feature-fitting stage
+# (see ml_feature_fitting.py) is provided, it is only used to transform
+# the text. Otherwise, a new vectorizer is fitted on the candidate pool.
+def vectorize_text(df1: pd.Series, df2: pd.Series, vectorizer: TfidfVectorizer | None = None):
+    if vectorizer is None:
+        vectorizer = initialize_vectorizer()
+        users_vect = vectorizer.fit_transform(df1)
+    else:
+        users_vect = vectorizer.transform(df1)
+
+    current_users_vect = vectorizer.transform(df2)
+
+    return users_vect, current_users_vect
+
+# Converts a height such as 5'9'' into inches.
+def parse_height_inches(height: str) -> int:
+    feet, inches = height.split("'")[0:2]
+    return (int(feet) * 12) + int(inches)
+
+# Joins the text of several columns (a DataFrame or a list of arrays) row by
+# row, e.g. the gender and gender interests of each user.
+def join_text_columns(columns: pd.DataFrame | list[np.ndarray]) -> list[str]:
+    if isinstance(columns, pd.DataFrame):
+        columns = [columns[column].values for column in columns.columns]
+
+    return [', '.join(values) for values in zip(*columns)]
+
+# Rounds an array to the given number of decimal places, giving the exact same
+# results as Python's round.
+#
+# np.round scales the values up, rounds them, and scales them back down, which
+# is what Python's round does too, except for values that land (almost) halfway
+# between two roundings once scaled up, where the rounding error of the scaling
+# can tip them the wrong way. Those values are rounded with round_halfway.
+#
+# The rounded scores are inputs of the matching model, so a tie rounded the
+# other way would change the predictions (and the rankings) compared with the
+# scores of the original pipeline, which rounds them with Python's round.
+def round_decimals(values: np.ndarray,
+                   decimals: int,
+                   out: np.ndarray | None = None,
+                   scratch: np.ndarray | None = None) -> np.ndarray:
+    values = np.asarray(values, dtype=np.float64)
+    scale = 10. ** decimals
+
+    if out is None:
+        out = np.empty(values.shape, dtype=np.float64)
+    if scratch is None:
+        scratch = np.empty(values.shape, dtype=np.float64)
+
+    np.multiply(values, scale, out=scratch)
+    np.rint(scratch, out=out)
+    np.subtract(scratch, out, out=scratch)
+    np.abs(scratch, out=scratch)
+
+    halfway = np.flatnonzero(np.abs(scratch - 0.5) < 1e-6)
+
+    np.divide(out, scale, out=out)
+
+    if len(halfway) > 0:
+        out[halfway] = round_halfway(values[halfway], decimals)
+
+    return out
+
+# Splits each value into a high and a low half of 26 bits each (Veltkamp's
+# split), so that products of the halves are exact.
+def split_float(values: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    c = values * 134217729.
+    high = c - (c - values)
+
+    return high, values - high
+
+# Rounds values that are (almost) halfway between two roundings to the given
+# number of decimal places, the same way as Python's round: to the nearest
+# rounding of their exact binary value, and to the even one on exact ties.
+#
+# Whether a value lies below or above the decimal midpoint (2k + 1) / (2 * 10^d)
+# is decided exactly by the sign of value * 2 * 10^d - (2k + 1), with the error
+# of the product recovered exactly (Dekker's product).
+def round_halfway(values: np.ndarray, decimals: int) -> np.ndarray:
+    scale = 10. ** decimals
+    lower = np.floor(values * scale)
+    midpoint = 2 * lower + 1
+
+    product = values * (2 * scale)
+    values_high, values_low = split_float(values)
+    scale_high, scale_low = split_float(np.float64(2 * scale))
+    error = (((values_high * scale_high - product) + values_high * scale_low + values_low * scale_high)
+             + values_low * scale_low)
+
+    # The difference between the product and the midpoint is exact, as they are
+    # within a factor of 2 of each other.
+    sign = np.sign((product - midpoint) + error)
+    rounded = np.where((sign > 0) | ((sign == 0) & (lower % 2 == 1)), lower + 1, lower)
+
+    # Negative values that round up to 0 keep their sign, as they do with round.
+    return np.copysign(rounded / scale, values)
+
+# Rounds a column of scores to 2 decimal places, the same way update_user_numbers does.
+def round_scores(scores: np.ndarray) -> np.ndarray:
+    return round_decimals(np.asarray(scores, dtype=np.float64).reshape(-1), 2)
+
+# Each of the functions below returns the (rounded) scores of the candidates,
+# and also stores them in the user dictionary if one is given.
 def update_user_numbers(dot_prod: np.array, user_dict: dict, attr_index: str):
     for percentage, user in zip(dot_prod, user_dict[attr_index].keys()):
         if attr_index != "visits":
@@ -20,96 +130,187 @@ def update_user_numbers(dot_prod: np.array, user_dict: dict, attr_index: str):
         else:
             user_dict[attr_index][user] = percentage
 
-def interests_dot_prod(df1: pd.DataFrame, df2: pd.DataFrame, user_dict: dict):
+def interests_dot_prod(df1: pd.DataFrame, df2: pd.DataFrame, user_dict: dict | None, vectorizer: TfidfVectorizer | None = None):
     # TODO: Calculate the dot product of interests between df1 and df2
-    vectorizer = initialize_vectorizer()
     normalizer = initialize_normalizer()
 
-    users_vect = vectorizer.fit_transform(df1).toarray()
-    current_users_vect = vectorizer.transform(df2).toarray()
+    users_vect, current_users_vect = vectorize_text(df1, df2, vectorizer)
     
     users_vect = normalizer.fit_transform(users_vect)
     current_users_vect = normalizer.transform(current_users_vect)
     
-    interests_dot_prod = np.dot(users_vect, current_users_vect.T)
-    update_user_numbers(interests_dot_prod, user_dict, "interests")
+    interests_dot_prod = (users_vect @ current_users_vect.T).toarray()
 
-def height_dot_prod(df1: pd.DataFrame, df2: pd.DataFrame, user_dict: dict):
+    if user_dict is not None:
+        update_user_numbers(interests_dot_prod, user_dict, "interests")
+
+    return round_scores(interests_dot_prod)
+
+def height_dot_prod(df1: pd.DataFrame, df2: pd.DataFrame, user_dict: dict | None):
     # TODO: Calculate the dot product of height between df1 and df2
-    df1 = df1.apply(func=lambda x: ((int(x.split("'")[0]) * 12) + int(x.split("'")[1])))
-    df2 = df2.apply(func=lambda y: ((int(y.split("'")[0]) * 12) + int(y.split("'")[1])))
-    np_df1 = np.array([df1]).T
-    np_df2 = np.array([df2])
+    np_df1 = np.array([[parse_height_inches(x) for x in df1]]).T
+    np_df2 = np.array([[parse_height_inches(y) for y in df2]])
     height_similarity = (100 - euclidean_distances(np_df1, np_df2)) / 100
     
-    update_user_numbers(height_similarity, user_dict, "height")
+    if user_dict is not None:
+        update_user_numbers(height_similarity, user_dict, "height")
 
-def sexual_orientation_similarity(df1: pd.DataFrame, df2: pd.DataFrame, user_dict: dict):
+    return round_scores(height_similarity)
+
+def sexual_orientation_similarity(df1: pd.DataFrame, df2: pd.DataFrame, user_dict: dict | None, vectorizer: TfidfVectorizer | None = None):
     # TODO: Calculate the dot product of sexual orientation between df1 and df2
-    df1 = df1.apply(lambda x: ', '.join(x), axis=1)
-    df2 = df2.apply(lambda y: ', '.join(y), axis=1) 
-    
-    vectorizer = initialize_vectorizer()
-    normalizer = initialize_normalizer()
-    
-    users_vect = vectorizer.fit_transform(df1).toarray()
-    current_users_vect = vectorizer.transform(df2).toarray()
-    
-    users_vect = normalizer.fit_transform(users_vect)
-    current_users_vect = normalizer.transform(current_users_vect).T
-    
-    # Added variable y to retrieve the number of rows in the current_users_vect
-    # array.
-    y = current_users_vect.shape[0]
-    np_df1 = np.array(users_vect)
-    np_df2 = np.array(current_users_vect).reshape(1, y)
+    df1 = join_text_columns(df1)
+    df2 = join_text_columns(df2)
 
-    sexual_orientation_sim = cosine_similarity(np_df1, np_df2)
-    
-    for sim in sexual_orientation_sim:
-        if sim > 0.45 and sim <= 1.:
-            sim[0] = -1
-        elif sim <= 0.45:
-            sim[0] = 1
-    
-    update_user_numbers(sexual_orientation_sim, user_dict, "sexual_orientation")
+    # If the vectorizers were fitted ahead of time, the score of each pair of
+    # orientations is looked up in a compatibility table shared by every request.
+    if vectorizer is not None:
+        compatibility = orientation_compatibility(vectorizer)
+        sexual_orientation_sim = compatibility.lookup(compatibility.ids(df1), compatibility.ids(df2))
+
+    # Otherwise, the vectorizer is still fitted on the whole candidate pool, but
+    # the similarity is only calculated once for each distinct orientation (the
+    # joined gender and gender interests), as candidates share a handful of them.
+    else:
+        normalizer = initialize_normalizer()
 
-def residence_dot_prod(df1: pd.DataFrame, df2: pd.DataFrame, user_dict: dict):
+        users_vect, current_users_vect = vectorize_text(df1, df2)
+        _, first_rows, orientation_ids = np.unique(np.array(df1, dtype=object), return_index=True, return_inverse=True)
+
+        users_vect = normalizer.fit_transform(users_vect[first_rows])
+        current_users_vect = normalizer.transform(current_users_vect)
+
+        sexual_orientation_sim = cosine_similarity(users_vect, current_users_vect)
+        sexual_orientation_sim = threshold_orientation_similarity(sexual_orientation_sim)[orientation_ids.reshape(-1)]
+
+    if user_dict is not None:
+        update_user_numbers(sexual_orientation_sim, user_dict, "sexual_orientation")
+
+    return round_scores(sexual_orientation_sim)
+
+# Turns the cosine similarities of the sexual orientations into scores of -1
+# (similar) or 1 (dissimilar). Similarities above 1 (due to rounding errors)
+# are left as they are.
+def threshold_orientation_similarity(sexual_orientation_sim: np.ndarray) -> np.ndarray:
+    sexual_orientation_sim = np.array(sexual_orientation_sim, dtype=np.float64)
+
+    similar = (sexual_orientation_sim > 0.45) & (sexual_orientation_sim <= 1.)
+    dissimilar = sexual_orientation_sim <= 0.45
+
+    sexual_orientation_sim[similar] = -1
+    sexual_orientation_sim[dissimilar] = 1
+
+    return sexual_orientation_sim
+
+# Compatibility table of the orientations (the joined gender and gender
+# interests of a user) known to a fitted vectorizer.
+#
+# Each orientation is given an integer id the first time it is seen, and the
+# score (-1 or 1) of a pair of orientations is calculated the first time it is
+# needed, so that scoring the candidates is a gather from the table. Each
+# orientation is vectorized and normalized the same way as the rows of
+# sexual_orientation_similarity, so the table holds the exact same scores.
+class OrientationCompatibility:
+    def __init__(self, vectorizer: TfidfVectorizer):
+        self.vectorizer = vectorizer
+        self.orientation_ids: dict[str, int] = {}
+        self.vectors: sp.csr_matrix | None = None
+        self.table: np.ndarray = np.empty((0, 0))
+        self._lock = threading.Lock()
+
+    # Returns the id of the orientation of each user, adding new orientations
+    # to the table.
+    def ids(self, orientations: list[str]) -> np.ndarray:
+        distinct, inverse = np.unique(np.array(orientations, dtype=object), return_inverse=True)
+        new_orientations = [orientation for orientation in distinct if orientation not in self.orientation_ids]
+
+        if new_orientations:
+            with self._lock:
+                new_orientations = [orientation for orientation in new_orientations if orientation not in self.orientation_ids]
+
+                if new_orientations:
+                    vectors = initialize_normalizer().fit_transform(self.vectorizer.transform(new_orientations))
+                    self.vectors = vectors if self.vectors is None else sp.vstack([self.vectors, vectors], format="csr")
+
+                    # Pairs involving a new orientation are marked as not calculated yet.
+                    num_known = len(self.orientation_ids)
+                    table = np.full((num_known + len(new_orientations),) * 2, np.nan)
+                    table[:num_known, :num_known] = self.table
+
+                    for orientation in new_orientations:
+                        self.orientation_ids[orientation] = len(self.orientation_ids)
+
+                    self.table = table
+
+        return np.array([self.orientation_ids[orientation] for orientation in distinct], dtype=np.int64)[inverse.reshape(-1)]
+
+    # Returns the scores of the given candidates (rows) against the given
+    # current users (columns), from the ids of their orientations.
+    def lookup(self, users_ids: np.ndarray, current_users_ids: np.ndarray) -> np.ndarray:
+        table = self.table
+        rows, columns = np.unique(users_ids), np.unique(current_users_ids)
+
+        if np.isnan(table[np.ix_(rows, columns)]).any():
+            with self._lock:
+                scores = threshold_orientation_similarity(cosine_similarity(self.vectors[rows], self.vectors[columns]))
+
+                # The table is replaced rather than updated in place, so that
+                # concurrent lookups never see a partially filled table.
+                table = self.table.copy()
+                table[np.ix_(rows, columns)] = scores
+                self.table = table
+
+        return table[np.ix_(users_ids, current_users_ids)]
+
+_orientation_compatibilities: "weakref.WeakKeyDictionary[TfidfVectorizer, OrientationCompatibility]" = weakref.WeakKeyDictionary()
+_orientation_compatibilities_lock = threading.Lock()
+
+# Returns the compatibility table of a fitted vectorizer. The table is dropped
+# along with the vectorizer, e.g. when the vectorizers are refitted.
+def orientation_compatibility(vectorizer: TfidfVectorizer) -> OrientationCompatibility:
+    with _orientation_compatibilities_lock:
+        compatibility = _orientation_compatibilities.get(vectorizer)
+
+        if compatibility is None:
+            compatibility = OrientationCompatibility(vectorizer)
+            _orientation_compatibilities[vectorizer] = compatibility
+
+        return compatibility
+
+def residence_dot_prod(df1: pd.DataFrame, df2: pd.DataFrame, user_dict: dict | None, vectorizer: TfidfVectorizer | None = None):
     # TODO: Calculate the dot product of residence between df1 and df2
-    df1 = df1.apply(lambda x: ', '.join(x), axis=1)
-    df2 = df2.apply(lambda y: ', '.join(y), axis=1)
+    df1 = join_text_columns(df1)
+    df2 = join_text_columns(df2)
     
-    vectorizer = initialize_vectorizer()
     normalizer = initialize_normalizer()
     
-    users_vect = vectorizer.fit_transform(df1).toarray()
-    current_users_vect = vectorizer.transform(df2).toarray()
+    users_vect, current_users_vect = vectorize_text(df1, df2, vectorizer)
     
     users_vect = normalizer.fit_transform(users_vect)
-    current_users_vect = normalizer.transform(current_users_vect).T
+    current_users_vect = normalizer.transform(current_users_vect)
     
-    np_df1 = np.array(users_vect)
-    np_df2 = np.array(current_users_vect)
-    np_dot = np.dot(np_df1, np_df2)
+    np_dot = (users_vect @ current_users_vect.T).toarray()
     
-    update_user_numbers(np_dot, user_dict, "residence")
+    if user_dict is not None:
+        update_user_numbers(np_dot, user_dict, "residence")
 
-def relationship_status_dot_prod(df1: pd.DataFrame, df2: pd.DataFrame, user_dict: dict):
+    return round_scores(np_dot)
+
+def relationship_status_dot_prod(df1: pd.DataFrame, df2: pd.DataFrame, user_dict: dict | None, vectorizer: TfidfVectorizer | None = None):
     # TODO: Calculate the dot product of relationship status between df1 and df2
-    vectorizer = initialize_vectorizer()
     normalizer = initialize_normalizer()
     
-    users_vect = vectorizer.fit_transform(df1).toarray()
-    current_users_vect = vectorizer.transform(df2).toarray()
+    users_vect, current_users_vect = vectorize_text(df1, df2, vectorizer)
     
     users_vect = normalizer.fit_transform(users_vect)
     current_users_vect = normalizer.transform(current_users_vect)
     
-    np_df1, np_df2 = np.array(users_vect), np.array(current_users_vect).T
-    
-    relationship_status_dot_prod = np.dot(np_df1, np_df2)
+    relationship_status_dot_prod = (users_vect @ current_users_vect.T).toarray()
 
-    update_user_numbers(relationship_status_dot_prod, user_dict, "relationship_status")
+    if user_dict is not None:
+        update_user_numbers(relationship_status_dot_prod, user_dict, "relationship_status")
+
+    return round_scores(relationship_status_dot_prod)
 
 def visit_booster(df: pd.DataFrame, user_dict: dict):
     update_user_numbers(df.values.tolist(), user_dict, "visits")
@@ -123,10 +324,20 @@ def calculate_similarity_score(df: pd.DataFrame, user_dict: dict):
     
     return final_df
 
-def scale_data(users_df: pd.DataFrame):
-    min_max_scaler = initialize_min_max_scaler()
-    
-    scaled_users_df = min_max_scaler.fit_transform(users_df)
+# Scales the scores of the candidates to [0, 1]. If the scale and offset of each
+# attribute score are given (see ml_scaler_stats.py), the attribute scores are
+# scaled with them, in the order of their columns, and the other columns (which
+# have not been filled in yet) are left as is. Otherwise, the scores are scaled
+# with the range of the candidate pool.
+def scale_data(users_df: pd.DataFrame, scaling: tuple[np.ndarray, np.ndarray] | None = None):
+    if scaling is not None:
+        num_scaled = len(scaling[0])
+        scaled_users_df = users_df.to_numpy(dtype=np.float64)
+        scaled_users_df[:, 0:num_scaled] = scaled_users_df[:, 0:num_scaled] * scaling[0] + scaling[1]
+    else:
+        min_max_scaler = initialize_min_max_scaler()
+        scaled_users_df = min_max_scaler.fit_transform(users_df)
+
     scaled_users_df = pd.DataFrame(scaled_users_df, columns=users_df.columns)
     
     return scaled_users_df
\ No newline at end of file
@@ -0,0 +1,168 @@
+# Streaming mode of the matching algorithm for very large candidate pools.
+#
+# run_algorithm loads the whole candidate pool of the current user into memory
+# before it scores any of them. In streaming mode, the candidates are instead
+# read from a named (server-side) cursor over get_match_candidates (see
+# sql/match_candidates.sql), STREAM_ITERSIZE rows at a time. Each chunk is
+# scored and sent through the model as soon as it arrives, and only the top k
+# candidates seen so far (along with their profiles) are kept, so that memory
+# stays flat no matter how many candidates the user has.
+#
+# The candidates are scored from their rows in the feature store, so streaming
+# requires the vectorizers to have been fitted ahead of time (run_algorithm is
+# used otherwise). Unlike run_algorithm, the pool is not narrowed down with the
+# interest index, and the pairwise score cache is not used, as both need the
+# whole pool at once.
+
+import psycopg2
+import numpy as np
+import uuid
+import sys
+import os
+
+from .ml_candidates import iter_candidate_tables, ProfileTable, MATCH_CANDIDATE_COLUMNS, PROFILE_METADATA_COLUMNS
+from .ml_feature_fitting import vectorizer_registry
+from .ml_feature_store import load_user_features
+from .ml_inference import predict_in_chunks, DEFAULT_PREDICT_CHUNK_SIZE
+from .ml_orientation import encode_orientations, orientation_mask
+from .ml_ranking import TopKSelector, RECOMMENDATION_LIMIT
+from .ml_scoring import get_scoring_kernel
+from .ml_scaler_stats import scaler_stats_registry
+from .ml_match_algo import run_algorithm, close_connection, drop_cols, SCORE_COLUMNS, SENSITIVE_COLUMNS
+from class_models import get_model_registry
+
+# Whether the matches are computed in streaming mode (see run_matching_algorithm
+# in main.py).
+MATCH_STREAMING = os.environ.get("MATCH_STREAMING", "false").lower() == "true"
+
+# Number of candidates fetched from the server-side cursor (and scored) at a time.
+STREAM_ITERSIZE = int(os.environ.get("STREAM_ITERSIZE", 5000))
+
+# Running top k of the streamed candidates, along with the profiles of the
+# candidates that are in it.
+#
+# If the sexual orientation filter is used, the candidates that pass it are
+# ranked apart from the rest. Every candidate is ranked if none of them pass
+# it, the same way as filter_matches does, which can only be known once the
+# whole pool was streamed.
+class StreamingTopK:
+    def __init__(self, k: int | None, use_so_filter: bool):
+        k = sys.maxsize if k is None else k
+
+        self.selector = TopKSelector(k)
+        self.eligible_selector: TopKSelector | None = TopKSelector(k) if use_so_filter else None
+        self.profiles: dict[int, dict[str, any]] = {}
+        self.num_eligible = 0
+
+    # Pushes the scores of a chunk of candidates, identified by their position
+    # in the pool, and keeps the profiles of the ones that made it into the top k.
+    def push(self,
+             scores: np.ndarray,
+             ids: np.ndarray,
+             profiles: ProfileTable,
+             eligible: np.ndarray | None = None) -> None:
+        self.selector.push(scores, ids)
+
+        if self.eligible_selector is not None:
+            self.eligible_selector.push(scores[eligible], ids[eligible])
+            self.num_eligible += int(eligible.sum())
+
+        kept = set(self.selector.ids.tolist())
+
+        if self.eligible_selector is not None:
+            kept.update(self.eligible_selector.ids.tolist())
+
+        self.profiles = {i: profile for i, profile in self.profiles.items() if i in kept}
+
+        for row, i in enumerate(ids.tolist()):
+            if i in kept:
+                self.profiles[i] = profiles.profile(row)
+
+    # Returns the profiles of the top k candidates, from most to least similar.
+    def result(self) -> list[dict[str, any]]:
+        selector = self.eligible_selector if self.eligible_selector is not None and self.num_eligible > 0 else self.selector
+        ranked_ids, _ = selector.result()
+
+        return [self.profiles[i] for i in ranked_ids.tolist()]
+
+# Streams, scores, and ranks the candidates of the given user, and returns the
+# profiles of the top k (or of every candidate, if k is None), the same way as
+# run_algorithm does. The cursor is closed, and the connection released with
+# release (closed by default).
+def run_streaming_algorithm(username: str,
+                            cursor: psycopg2.extensions.cursor,
+                            db: psycopg2.extensions.connection,
+                            use_so_filter: bool,
+                            top_k: int | None = RECOMMENDATION_LIMIT,
+                            itersize: int = STREAM_ITERSIZE,
+                            predict_chunk_size: int = DEFAULT_PREDICT_CHUNK_SIZE,
+                            backend: str | None = None,
+                            release=close_connection) -> list[dict[str, any]]:
+    feature_space = vectorizer_registry.get_feature_space()
+
+    if feature_space is None:
+        return run_algorithm(username, cursor, db, use_so_filter, top_k, release)
+
+    model = get_model_registry(backend).get()
+    scaling = scaler_stats_registry.get_scaling()
+    kernel = get_scoring_kernel()
+    ranking = StreamingTopK(top_k, use_so_filter)
+
+    # Server-side cursors need a unique name within the connection.
+    stream = db.cursor(name=f"match_candidates_{uuid.uuid4().hex}")
+    stream.itersize = itersize
+
+    try:
+        stream.execute(f"SELECT is_viewer, {', '.join(MATCH_CANDIDATE_COLUMNS)} FROM get_match_candidates(%s)", [username])
+
+        current_user = None
+        num_candidates = 0
+
+        for rows in iter_candidate_tables(stream, itersize):
+            is_viewer = rows.columns.pop("is_viewer")
+
+            # The current user's row comes first.
+            if current_user is None:
+                if not is_viewer.any():
+                    print("User is not found!")
+                    return []
+
+                current_user = rows.take(np.flatnonzero(is_viewer)[0:1])
+                current_user_profile = {name: values[0:1].tolist()[0] for name, values in current_user.columns.items()}
+
+                current_user_matrix, current_user_heights = load_user_features(cursor, feature_space, current_user)
+                segment_matrix = feature_space.segment_matrix(current_user_matrix[0])
+
+            candidates = encode_orientations(rows.take(np.flatnonzero(~is_viewer)).exclude(username))
+
+            if len(candidates) == 0:
+                continue
+
+            # Score the chunk and send it through the model, without the
+            # similarity score column.
+            users_matrix, users_heights = load_user_features(cursor, feature_space, candidates)
+            scores = kernel.score(users_matrix, users_heights, segment_matrix, current_user_heights[0], candidates['visits'], scaling=scaling)
+            features = scores[:, 0:SCORE_COLUMNS.index('similarity_score')].astype(np.float32)
+
+            predictions = predict_in_chunks(model, features, predict_chunk_size)
+
+            # Scores are rounded to percentages with 2 decimal places before
+            # they are ranked, the same way as in rank_candidates.
+            eligible = orientation_mask(candidates["gender_bits"], candidates["interest_bits"], current_user_profile) if use_so_filter else None
+
+            ranking.push(np.round(predictions * np.float32(100), 2),
+                         np.arange(num_candidates, num_candidates + len(candidates)),
+                         ProfileTable({name: candidates[name] for name in PROFILE_METADATA_COLUMNS}),
+                         eligible)
+
+            num_candidates += len(candidates)
+
+        # Commit the rows that were missing from the feature store.
+        db.commit()
+
+    finally:
+        stream.close()
+        cursor.close()
+        release(db)
+
+    return drop_cols(ranking.result(), SENSITIVE_COLUMNS)
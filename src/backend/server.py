@@ -6,17 +6,26 @@ from slowapi import Limiter, _rate_limit_exceeded_handler
 from slowapi.util import get_remote_address
 from slowapi.errors import RateLimitExceeded
 from dotenv import load_dotenv
-from main import run_matching_algorithm
+from class_models import model_registry
+from models.ml_feature_fitting import vectorizer_registry
+from models.ml_feature_store import refresh_user_features
+from models.ml_scaler_stats import scaler_stats_registry
+from models.ml_score_cache import pair_score_cache
+from models.ml_precomputed_matches import load_precomputed_matches
+from models.ml_candidates import hydrate_photos
 from rating_sys import (calculate_rating, 
                         average_rating, 
                         update_rating, 
                         delete_rating, 
                         insert_rating)
-from key_pref.key_prefixes import visit_key_func, matches_key
+from key_pref.key_prefixes import visit_key_func, read_json_body
 from helpers.helper import *
+from helpers.match_sessions import match_sessions, InvalidCursorError, MATCH_SESSION_MAX_RESULTS, MATCH_PAGE_LIMIT
+from helpers.match_executor import match_executor, run_match_in_worker, MatchQueueFullError
+from helpers.db_pool import db_pool, PoolTimeoutError
+from helpers.db_async import AsyncConnection, AsyncCursor, run_blocking
 from fastapi_cache import FastAPICache
 from fastapi_cache.backends.inmemory import InMemoryBackend
-from fastapi_cache.decorator import cache
 
 import jwt
 import datetime as dt
@@ -56,10 +65,66 @@ server.add_middleware(
     allow_headers=["*"]
 )
 
+# How often (in seconds) the server checks whether the matching model file
+# was replaced on disk so it can be hot-swapped. Set to 0 to disable.
+MODEL_RELOAD_INTERVAL = int(os.environ.get("MODEL_RELOAD_INTERVAL", 60))
+
+# Periodically hot-swaps the matching model if a new .h5 file was
+# written in place of the one currently being served, as well as the
+# feature vectorizers if they were refitted and the scaling statistics
+# if they were recomputed.
+async def watch_matching_model():
+    while True:
+        await asyncio.sleep(MODEL_RELOAD_INTERVAL)
+
+        try:
+            if await asyncio.to_thread(model_registry.reload_if_changed):
+                print(f"Reloaded matching model from {model_registry.path}.")
+
+            if await asyncio.to_thread(vectorizer_registry.reload_if_changed):
+                print(f"Reloaded feature vectorizers from {vectorizer_registry.path}.")
+
+            if await asyncio.to_thread(scaler_stats_registry.reload_if_changed):
+                print(f"Reloaded scaling statistics from {scaler_stats_registry.path}.")
+        
+        except Exception as e:
+            print(f"Failed to reload matching model: {e}")
+
 @server.on_event('startup')
 async def startup():
+    # Match sessions are kept in the memory of the server process (see
+    # helpers/match_sessions.py), so the cursors handed out by one process
+    # can't be resolved by another. The API has to be served by a single
+    # process, while the matching algorithm scales with MATCH_WORKERS.
+    if int(os.environ.get("WEB_CONCURRENCY", 1)) > 1:
+        raise RuntimeError("The API must be served by a single process, as match sessions are kept in its memory.")
+
     FastAPICache.init(InMemoryBackend(), prefix="fastapi-cache")
 
+    # Load and warm up the matching model once so that requests to /match
+    # share it instead of loading it from disk every time.
+    model_registry.load()
+    vectorizer_registry.get()
+    scaler_stats_registry.get()
+
+    if MODEL_RELOAD_INTERVAL > 0:
+        asyncio.create_task(watch_matching_model())
+
+    # Start the worker processes that run the matching algorithm off the event loop.
+    match_executor.start()
+
+    # Open the first connections of the pool ahead of the first requests.
+    try:
+        await asyncio.to_thread(db_pool.open)
+
+    except p.DatabaseError as e:
+        print(f"Failed to open the database connection pool: {e}")
+
+@server.on_event('shutdown')
+async def shutdown():
+    match_executor.shutdown()
+    db_pool.close()
+
 # Mount socket into the server as an ASGI app, as the FastAPI server
 # also uses ASGI to run.
 server.mount("/socket.io", socketio.ASGIApp(sio))
@@ -76,25 +141,57 @@ limit = Limiter(
 server.state.limiter = limit
 server.add_exception_handler(RateLimitExceeded, _rate_limit_exceeded_handler)
 
-async def create_connection() -> p.extensions.connection:
+# Draws a connection from the shared pool (see helpers/db_pool.py), whose
+# statements are awaited (see helpers/db_async.py). Connections are drawn in a
+# separate thread, as opening a new one (or waiting for one to be handed back)
+# would block the event loop.
+async def create_connection() -> AsyncConnection:
     try:
-        db: p.extensions.connection = p.connect(DB_KEY)       
-        return db
+        db: p.extensions.connection = await asyncio.to_thread(db_pool.acquire)
+        return AsyncConnection(db)
     
+    except PoolTimeoutError as e:
+        raise HTTPException(503, {"message": str(e)})
+
     except p.DatabaseError:
         print(os.environ.get("DB_KEY"))
-        return p.extensions.connection(DB_KEY)
+        return AsyncConnection(await asyncio.to_thread(p.extensions.connection, DB_KEY))
 
-async def terminate_connection(db: p.extensions.connection):
-    db.close()
+# Hands the connection back to the pool.
+async def terminate_connection(db: AsyncConnection):
+    await run_blocking(db_pool.release, db.raw)
     
+# Rebuilds the user's row in the feature store used by the matching algorithm
+# after they sign up or change one of the attributes it uses. A failure here
+# does not fail the request, since the profile itself was already updated.
+async def update_user_features(username: str, db: AsyncConnection, cursor: AsyncCursor):
+    try:
+        await cursor.run(refresh_user_features, vectorizer_registry.get_feature_space(), username)
+        await db.commit()
+
+        # The user's stored matches were ranked with their previous profile.
+        # Their cached pairwise scores can no longer be looked up either, as
+        # the version of their feature row was bumped.
+        match_sessions.invalidate(username)
+        pair_score_cache.invalidate(username)
+
+    except p.DatabaseError as e:
+        await db.rollback()
+        print(f"Failed to update the features of {username}: {e}")
+
 async def check_token(request: Request):
     if request.cookies.get("user_session") != None:
         try:
             decode_token: dict = jwt.decode(request.cookies.get("user_session"), str(SK_KEY), ["HS256"], verify=True)
             
             if decode_token and decode_token["iss"] == request.headers.get('referer'):
-                session_verified = await verify_session(request.cookies.get("username"), request.cookies.get("user_session"), str(DB_KEY), str(SK_KEY), request)
+                db: AsyncConnection = await create_connection()
+
+                try:
+                    session_verified = await verify_session(request.cookies.get("username"), request.cookies.get("user_session"), db, str(SK_KEY), request)
+
+                finally:
+                    await terminate_connection(db)
                 
                 if session_verified:
                     return True
@@ -133,6 +230,15 @@ async def disconnect(sid: str):
 async def index():
     return {"status": "Working!"}
 
+# Reports the depth of the queue of the executor running the matching algorithm.
+@server.get("/match_metrics")
+async def match_metrics():
+    return match_executor.metrics()
+
+@server.get("/db_pool_metrics")
+async def db_pool_metrics():
+    return db_pool.metrics()
+
 @server.post("/login")
 async def login(request: Request, response: Response):
     data = await request.form()
@@ -149,11 +255,12 @@ async def login(request: Request, response: Response):
         "exp": int((dt.datetime.now() + dt.timedelta(hours=2, minutes=0)).timestamp())
     }
     
+    db: AsyncConnection = await create_connection()
+    cursor: AsyncCursor = db.cursor()
+    
     # Handle exceptions in case a malicious actor attempts to make
     # unauthorized requests to any of the endpoints below.
     try:
-        db: p.extensions.connection = await create_connection()
-        cursor: p.extensions.cursor = db.cursor()
         verified_user = await user_verified(data["username"], data["password"], cursor)
         
         if verified_user:
@@ -200,7 +307,12 @@ async def logout(request: Request, response: Response):
         cursor = db.cursor()
 
         # Destroy both the user_session and username cookies to render the tokens unusable by any malicious actors.
-        await delete_session(request.cookies.get("username"), request.cookies.get("user_session"), db, cursor)
+        try:
+            await delete_session(request.cookies.get("username"), request.cookies.get("user_session"), db, cursor)
+
+        finally:
+            await terminate_connection(db)
+
         response.set_cookie(key="user_session", value=request.cookies.get("user_session"), max_age=0, path="/", domain="localhost", secure=True, httponly=True, samesite='strict')
         response.set_cookie(key="username", value="", max_age=0, path="/", domain="localhost", secure=True, httponly=True, samesite='strict')
 
@@ -214,8 +326,6 @@ async def logout(request: Request, response: Response):
 @server.post("/signup")
 async def signup(request: Request):
     data: dict = await request.json()
-    db: p.extensions.connection = await create_connection()
-    cursor: p.extensions.cursor = db.cursor()
     
     hash_password = context.hash(data["password"])
     
@@ -224,6 +334,9 @@ async def signup(request: Request):
     age_verified = await verify_age(data["age"], data["state"])
     
     if age_verified:
+        db: AsyncConnection = await create_connection()
+        cursor: AsyncCursor = db.cursor()
+        
         try:
             statement = '''
                 CALL sign_up(%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s,
@@ -258,8 +371,15 @@ async def signup(request: Request):
                       data["pic"]
                     ]
             
-            cursor.execute(statement, params)
-            db.commit()
+            await cursor.execute(statement, params)
+
+            # Also store the height in inches for the matching algorithm.
+            statement = "UPDATE Profiles SET height_inches=%s WHERE username=%s"
+            params = [height_to_inches(data["height_feet"], data["height_inches"]), data["username"]]
+            await cursor.execute(statement, params)
+            await db.commit()
+
+            await update_user_features(data["username"], db, cursor)
 
             # Return response.
             return {"message": "Successfully registered for an account!"}
@@ -281,9 +401,9 @@ async def check_login(request: Request):
     session_tok = request.cookies.get("user_session")
     username_cookie = request.cookies.get("username")
     
+    db: AsyncConnection = await create_connection()
+    
     try:
-        db: p.extensions.connection = await create_connection()
-        
         user = await retrieve_banned_user(db, username_cookie)
         
         if "username" in user and user["username"] == username_cookie:
@@ -301,16 +421,16 @@ async def check_login(request: Request):
     finally:
         await terminate_connection(db)
         
-@protected_route.post("/visit")
+@protected_route.post("/visit", dependencies=[Depends(read_json_body)])
 @limit.limit(os.environ.get("VISIT_LIMIT"), key_func=visit_key_func)
-def visit(request: Request):
-    data: dict = asyncio.run(request.json())
-    db: p.extensions.connection = asyncio.run(create_connection())
-    cursor: p.extensions.cursor = db.cursor()
+async def visit(request: Request):
+    data: dict = await request.json()
+    db: AsyncConnection = await create_connection()
+    cursor: AsyncCursor = db.cursor()
     current_user: str = request.cookies.get("username")
     
     try:
-        asyncio.run(log_visit(current_user, data["visiting_user"], db, cursor))
+        await log_visit(current_user, data["visiting_user"], db, cursor)
         return {"message": "Successfully counted visit!"}
     
     except db.DatabaseError:
@@ -320,7 +440,7 @@ def visit(request: Request):
         return {"message": "Server error. Please try again."}, 500
     
     finally:
-        asyncio.run(terminate_connection(db))
+        await terminate_connection(db)
         
 @server.post("/retrieve_pic")
 async def retrieve_pic(request: Request):
@@ -336,8 +456,8 @@ async def protected_root():
 
 @protected_route.route("/update_profile_pic", methods=["POST"])
 async def update_profile_pic(request: Request):
-    db: p.extensions.connection = await create_connection()
-    cursor: p.extensions.cursor = db.cursor()
+    db: AsyncConnection = await create_connection()
+    cursor: AsyncCursor = db.cursor()
     
     try:
         # The name within the bracket of the .files and .form functions
@@ -349,8 +469,8 @@ async def update_profile_pic(request: Request):
         # Commit new profile pic to database.
         update_information = [image_uri, username]
         update_stmt = "UPDATE Photos SET uri=%s WHERE username=%s"
-        cursor.execute(update_stmt, update_information)
-        db.commit()
+        await cursor.execute(update_stmt, update_information)
+        await db.commit()
 
         return RedirectResponse("http://localhost:5173/profile/options/update", status_code=302)
     
@@ -363,22 +483,22 @@ async def update_profile_pic(request: Request):
 @protected_route.put("/update_profile/name")
 async def update_name(request: Request):
     data: dict = await request.json()
-    db: p.extensions.connection = await create_connection()
-    cursor: p.extensions.cursor = db.cursor()
+    db: AsyncConnection = await create_connection()
+    cursor: AsyncCursor = db.cursor()
     
     try:
         # Update first, middle name, and last name of user where possible in the Users table.
         statement = "UPDATE Users SET first_name=%s, middle_name=%s, last_name=%s WHERE username=%s"
         params = [data["first_name"], data["middle_name"], data["last_name"], request.cookies.get("username")]
-        cursor.execute(statement, params)
-        db.commit()
+        await cursor.execute(statement, params)
+        await db.commit()
         
         try:
             # Update first, middle name, and last name of user where possible in the Profiles table.
             statement = "UPDATE Profiles SET first_name=%s, middle_name=%s, last_name=%s WHERE username=%s"
             params = [data["first_name"], data["middle_name"], data["last_name"], request.cookies.get("username")]
-            cursor.execute(statement, params)
-            db.commit()
+            await cursor.execute(statement, params)
+            await db.commit()
             
             return {"message": "Successfully updated name!"}
             
@@ -394,8 +514,8 @@ async def update_name(request: Request):
 @protected_route.put("/update_profile/DOB")
 async def update_DOB(request: Request):
     data: dict = await request.json()
-    db: p.extensions.connection = await create_connection()
-    cursor: p.extensions.cursor = db.cursor()
+    db: AsyncConnection = await create_connection()
+    cursor: AsyncCursor = db.cursor()
     
     try:
         # Check if the user was lying about their DOB when they originally registered for an account.
@@ -406,8 +526,8 @@ async def update_DOB(request: Request):
         if they_told_the_truth:
             statement = "UPDATE Users SET birth_month=%s, birth_date=%s, birth_year=%s WHERE username=%s"
             params = [data["birth_month"], data["birth_date"], data["birth_year"], request.cookies.get("username")]
-            cursor.execute(statement, params)
-            db.commit()
+            await cursor.execute(statement, params)
+            await db.commit()
         
             return {"message": "Successfully updated birthday!"}
         
@@ -415,8 +535,8 @@ async def update_DOB(request: Request):
         else:
             statement = "INSERT INTO Banned (username, time_banned, reason, ban_lift_time) VALUES (%s, %s, %s, %s)"
             params = [request.cookies.get("username"), "now()", "Registered for an account while underage", "now()"]
-            cursor.execute(statement, params)
-            db.commit()
+            await cursor.execute(statement, params)
+            await db.commit()
             
             raise HTTPException(403, {"message": "Failed to update birthday. You were underage when you originally registered for an account."})
 
@@ -430,15 +550,15 @@ async def update_DOB(request: Request):
 @protected_route.put("/update_profile/username")
 async def update_username(request: Request, response: Response):
     data: dict = await request.json()
-    db: p.extensions.connection = await create_connection()
-    cursor: p.extensions.cursor = db.cursor()
+    db: AsyncConnection = await create_connection()
+    cursor: AsyncCursor = db.cursor()
     
     try:
         statement = "UPDATE Users SET username=%s WHERE username=%s"
         params = [data["new_username"], request.cookies.get("username")]
         
-        cursor.execute(statement, params)
-        db.commit()
+        await cursor.execute(statement, params)
+        await db.commit()
         
         response.set_cookie("username", data["new_username"], max_age=dt.timedelta(hours=2).seconds, path="/", domain="localhost", secure=True, httponly=True, samesite='strict')
         
@@ -453,16 +573,20 @@ async def update_username(request: Request, response: Response):
 @protected_route.put("/update_profile/height")
 async def update_height(request: Request):
     data: dict = await request.json()
-    db: p.extensions.connection = await create_connection()
-    cursor: p.extensions.cursor = db.cursor()
     
     new_height: str = data["new_height_feet"] + "'" + data["new_height_inches"] + "''"
+    new_height_inches: int = height_to_inches(data["new_height_feet"], data["new_height_inches"])
+    
+    db: AsyncConnection = await create_connection()
+    cursor: AsyncCursor = db.cursor()
     
     try:
-        statement: str = "UPDATE Profiles SET height=%s WHERE username=%s"
-        params: list = [new_height, request.cookies.get("username")]
-        cursor.execute(statement, params)
-        db.commit()
+        statement: str = "UPDATE Profiles SET height=%s, height_inches=%s WHERE username=%s"
+        params: list = [new_height, new_height_inches, request.cookies.get("username")]
+        await cursor.execute(statement, params)
+        await db.commit()
+
+        await update_user_features(request.cookies.get("username"), db, cursor)
         
         return {"message": "Successfully updated height!"}
     
@@ -475,14 +599,16 @@ async def update_height(request: Request):
 @protected_route.put("/update_profile/gender")
 async def update_gender(request: Request):
     data: dict = await request.json()
-    db: p.extensions.connection = await create_connection()
-    cursor: p.extensions.cursor = db.cursor()
+    db: AsyncConnection = await create_connection()
+    cursor: AsyncCursor = db.cursor()
     
     try:
         statement = "UPDATE Profiles SET gender=%s WHERE username=%s"
         params = [data["new_gender"], request.cookies.get("username")]
-        cursor.execute(statement, params)
-        db.commit() 
+        await cursor.execute(statement, params)
+        await db.commit()
+
+        await update_user_features(request.cookies.get("username"), db, cursor)
         
         return {"message": "Successfully updated gender!"}
         
@@ -495,14 +621,16 @@ async def update_gender(request: Request):
 @protected_route.put("/update_profile/sexual_orientation")
 async def update_sexual_orientation(request: Request):
     data: dict = await request.json()
-    db: p.extensions.connection = await create_connection()
-    cursor: p.extensions.cursor = db.cursor()
+    db: AsyncConnection = await create_connection()
+    cursor: AsyncCursor = db.cursor()
     
     try:
         statement = "UPDATE Profiles SET sexual_orientation=%s WHERE username=%s"
         params = [data["new_sexual_orientation"], request.cookies.get("username")]
-        cursor.execute(statement, params)
-        db.commit()
+        await cursor.execute(statement, params)
+        await db.commit()
+
+        await update_user_features(request.cookies.get("username"), db, cursor)
         
         return {"message": "Successfully updated sexual orientation!"}
         
@@ -515,15 +643,17 @@ async def update_sexual_orientation(request: Request):
 @protected_route.put("/update_profile/relationship_status")
 async def update_relationship_status(request: Request):
     data: dict = await request.json()
-    db: p.extensions.connection = await create_connection()
-    cursor: p.extensions.cursor = db.cursor()
+    db: AsyncConnection = await create_connection()
+    cursor: AsyncCursor = db.cursor()
     
     try:
         statement = "UPDATE Profiles SET relationship_status=%s WHERE username=%s"
         params = [data["new_relationship_status"], request.cookies.get("username")]
-        cursor.execute(statement, params)
-        db.commit()
+        await cursor.execute(statement, params)
+        await db.commit()
 
+        await update_user_features(request.cookies.get("username"), db, cursor)
+        
         return {"message": "Successfully updated relationship status!"}
     
     except db.DatabaseError:
@@ -535,14 +665,16 @@ async def update_relationship_status(request: Request):
 @protected_route.put("/update_profile/bio")
 async def update_bio(request: Request):
     data: dict = await request.json()
-    db: p.extensions.connection = await create_connection()
-    cursor: p.extensions.cursor = db.cursor()
+    db: AsyncConnection = await create_connection()
+    cursor: AsyncCursor = db.cursor()
     
     try:
         statement = "UPDATE Profiles SET interests=%s WHERE username=%s"
         params = [data["new_bio"], request.cookies.get("username")]
-        cursor.execute(statement, params)
-        db.commit()
+        await cursor.execute(statement, params)
+        await db.commit()
+
+        await update_user_features(request.cookies.get("username"), db, cursor)
         
         return {"message": "Successfully updated bio!"}
     
@@ -552,20 +684,20 @@ async def update_bio(request: Request):
     finally:
         await terminate_connection(db)
 
-@protected_route.post("/privacy/make_chat_request")
+@protected_route.post("/privacy/make_chat_request", dependencies=[Depends(read_json_body)])
 @limit.limit(os.environ.get("REQUEST_LIMIT"), key_func=visit_key_func)
-def make_chat_request(request: Request):
-    data: dict = asyncio.run(request.json())
+async def make_chat_request(request: Request):
+    data: dict = await request.json()
     username: str = request.cookies.get("username")
     
-    db: p.extensions.connection = asyncio.run(create_connection())
-    cursor: p.extensions.cursor = db.cursor()
+    db: AsyncConnection = await create_connection()
+    cursor: AsyncCursor = db.cursor()
 
     try:
         make_req: str = "CALL make_chat_request(%s, %s)"
         params: list = [username, data["requestee"]]
-        cursor.execute(make_req, params)
-        db.commit()
+        await cursor.execute(make_req, params)
+        await db.commit()
 
         return {"message": "Chat request successfully made!"}
 
@@ -576,7 +708,7 @@ def make_chat_request(request: Request):
         raise HTTPException(500, {"message": "Error! Try again later!"})
 
     finally:
-        asyncio.run(terminate_connection(db))
+        await terminate_connection(db)
 
 @protected_route.put("/privacy/chat_request_response")
 async def chat_request_response(request: Request):
@@ -584,25 +716,25 @@ async def chat_request_response(request: Request):
     username: str = request.cookies.get("username")
     query: str = request.query_params.get("r")
 
-    db: p.extensions.connection = await create_connection()
-    cursor: p.extensions.cursor = db.cursor()
+    db: AsyncConnection = await create_connection()
+    cursor: AsyncCursor = db.cursor()
 
     try:
         if query == "approve":
             statement = "CALL approve_chat_request(%s, %s)"
             params = [data["requestor"], username]
-            cursor.execute(statement, params)
-            db.commit()
+            await cursor.execute(statement, params)
+            await db.commit()
 
         elif query == "deny":
             statement = "CALL deny_chat_request(%s, %s)"
             params = [data["requestor"], username]
-            cursor.execute(statement, params)
-            db.commit()
+            await cursor.execute(statement, params)
+            await db.commit()
 
         statement = "SELECT * FROM retrieve_chat_reqs(%s)"
         params = [username]
-        cursor.execute(statement, params)
+        await cursor.execute(statement, params)
 
         chat_reqs: list[dict[str, any]] = [{column.name: record 
                                             for column, record 
@@ -630,14 +762,14 @@ async def delete_chat_request(request: Request):
     data: dict = await request.json()
     username: str = request.cookies.get("username")
 
-    db: p.extensions.connection = await create_connection()
-    cursor: p.extensions.cursor = db.cursor()
+    db: AsyncConnection = await create_connection()
+    cursor: AsyncCursor = db.cursor()
 
     try:
         del_req: str = "CALL delete_chat_request(%s, %s)"
         params: list = [username, data["requestee"]]
-        cursor.execute(del_req, params)
-        db.commit()
+        await cursor.execute(del_req, params)
+        await db.commit()
 
         return {"message": "Chat request successfully deleted!"}
     
@@ -656,21 +788,21 @@ async def change_recommendation_settings(request: Request):
     username: str = request.cookies.get("username")
     query: str = request.query_params.get("rs")
     
-    db: p.extensions.connection = await create_connection()
-    cursor: p.extensions.cursor = db.cursor()
+    db: AsyncConnection = await create_connection()
+    cursor: AsyncCursor = db.cursor()
     
     try:
         if query == 'match':
             params: list = [data["check_value"], username]
             statement: str = "UPDATE Recommendation_Settings SET used=%s WHERE username=%s"
-            cursor.execute(statement, params)
-            db.commit()
+            await cursor.execute(statement, params)
+            await db.commit()
         
         elif query == 'so_filter':
             params: list = [data["check_value"], username]
             statement: str = "UPDATE Recommendation_Settings SET use_so_filter=%s WHERE username=%s"
-            cursor.execute(statement, params)
-            db.commit()
+            await cursor.execute(statement, params)
+            await db.commit()
             
         else:
             raise HTTPException(400, {"message": "Invalid query or request"})
@@ -701,11 +833,11 @@ async def download_data(request: Request):
         # computer in JSON format.
         json_user_info: dict = {}
 
-        try:
-            # Create database connection and cursor.
-            db: p.extensions.connection = await create_connection()
-            cursor: p.extensions.cursor = db.cursor()
+        # Create database connection and cursor.
+        db: AsyncConnection = await create_connection()
+        cursor: AsyncCursor = db.cursor()
 
+        try:
             # Verify the entered password with password of the current user stored in the database.
             password_verified = await user_verified(request.cookies.get("username"), requested_info["confirmed_password"], cursor)
             
@@ -724,7 +856,7 @@ async def download_data(request: Request):
                     
                     params = [request.cookies.get("username")]
                     
-                    cursor.execute(statement, params)
+                    await cursor.execute(statement, params)
                     
                     json_user_info["user_profile"] = [
                         {
@@ -753,7 +885,7 @@ async def download_data(request: Request):
                     statement = "SELECT * FROM Messages WHERE message_from=%s ORDER BY date_and_time DESC"
                     params = [request.cookies.get("username")]
                     
-                    cursor.execute(statement, params)
+                    await cursor.execute(statement, params)
 
                     json_user_info["messages"] = [
                         {
@@ -772,7 +904,7 @@ async def download_data(request: Request):
                     statement = "SELECT rater, ratee, rating_type, rating_made FROM User_Rating_Labels WHERE rater=%s ORDER BY rating_made DESC"
                     params = [request.cookies.get("username")]
                     
-                    cursor.execute(statement, params)
+                    await cursor.execute(statement, params)
                     
                     json_user_info["rating_history"] = [
                         {
@@ -819,10 +951,10 @@ async def report_user(request: Request,
                       file2: UploadFile = File(..., alias="file2"),
                       file3: UploadFile = File(..., alias="file3")):
     
-    try:
-        db = await create_connection()
-        cursor = db.cursor()
+    db = await create_connection()
+    cursor = db.cursor()
 
+    try:
         data: dict = await request.form()
         params: list = [
             request.cookies.get("username"),
@@ -854,8 +986,8 @@ async def report_user(request: Request,
             (%s, %s, %s, %s, %s, %s, %s, %s)
         '''
 
-        cursor.execute(statement, params)
-        db.commit()
+        await cursor.execute(statement, params)
+        await db.commit()
 
         return RedirectResponse(
             "http://localhost:5173/profile/options/privacy/view_blocked_users", 
@@ -878,14 +1010,15 @@ async def report_user(request: Request,
 async def search(request: Request):
     statement = "SELECT * FROM get_user_profiles(%s)"
     
-    db: p.extensions.connection = await create_connection()
-    cursor: p.extensions.cursor = db.cursor()
     data: dict = await request.json()
     
     params = [data["username"]]
     
+    db: AsyncConnection = await create_connection()
+    cursor: AsyncCursor = db.cursor()
+    
     try:
-        cursor.execute(statement, params)
+        await cursor.execute(statement, params)
 
         search_results: list[dict[str, any]] = [
             {col[0]: record for col, record in zip(cursor.description, records)} 
@@ -904,17 +1037,17 @@ async def search(request: Request):
         await terminate_connection(db)
         
 @protected_route.post("/insert_search_history")
-def insert_search_history(request: Request):
-    db: p.extensions.connection = asyncio.run(create_connection())
-    cursor: p.extensions.cursor = db.cursor()
-    data: dict = asyncio.run(request.json())
+async def insert_search_history(request: Request):
+    data: dict = await request.json()
+    db: AsyncConnection = await create_connection()
+    cursor: AsyncCursor = db.cursor()
     
     try:
         # Attempt to retrieve the search term from the database associated with the user's search
         # history.
         statement = "SELECT search_term FROM Search_History WHERE username=%s AND search_term=%s"
         params = [request.cookies.get("username"), data["search_term"]]
-        cursor.execute(statement, params)
+        await cursor.execute(statement, params)
         
         # Stores the retrieved search term from the database in a list
         # should it exist.
@@ -932,8 +1065,8 @@ def insert_search_history(request: Request):
             params = [request.cookies.get("username"), data["search_term"]]
             
             # Execute and commit the query into the database.
-            cursor.execute(statement, params)
-            db.commit()
+            await cursor.execute(statement, params)
+            await db.commit()
             
             # Return a status code of 200 to indicate that the search term has been inserted.
             return {"message": "Search term has been inserted!"}
@@ -947,8 +1080,8 @@ def insert_search_history(request: Request):
             params = [request.cookies.get("username"), data["search_term"]]
             
             # Execute and commit the query into the database.
-            cursor.execute(statement, params)
-            db.commit()
+            await cursor.execute(statement, params)
+            await db.commit()
             
             # Return a status code of 200 to indicate the search term date and time have been updated.
             return {"message": "Search term time has been updated!"}
@@ -960,19 +1093,19 @@ def insert_search_history(request: Request):
         return {"message": "Failed to insert or update search term."}, 500
     
     finally:
-        asyncio.run(terminate_connection(db))
+        await terminate_connection(db)
         
 @protected_route.post("/clear_search_history")
 async def clear_search_history(request: Request):
-    db: p.extensions.connection = await create_connection()
-    cursor: p.extensions.cursor = db.cursor()
+    db: AsyncConnection = await create_connection()
+    cursor: AsyncCursor = db.cursor()
     
     try:
         statement = "DELETE FROM Search_History WHERE username=%s"
         params = [request.cookies.get("username")]
         
-        cursor.execute(statement, params)
-        db.commit()
+        await cursor.execute(statement, params)
+        await db.commit()
         
         return {"message": "Search history cleared!"}
     
@@ -988,20 +1121,20 @@ async def clear_search_history_term(request: Request):
     username = request.cookies.get("username")
     params = [username, search_term]
     
-    db: p.extensions.connection = await create_connection()
-    cursor: p.extensions.cursor = db.cursor()
+    db: AsyncConnection = await create_connection()
+    cursor: AsyncCursor = db.cursor()
     
     try:
         statement = "DELETE FROM Search_History WHERE username=%s AND search_term=%s"
-        cursor.execute(statement, params)
-        db.commit()
+        await cursor.execute(statement, params)
+        await db.commit()
         
         # Send updated search history to user after search term is deleted.
         try:
             statement = "SELECT search_term FROM Search_History WHERE username=%s ORDER BY date_and_time DESC LIMIT 10"
             params = [username]
-            cursor.execute(statement, params)
-            db.commit()
+            await cursor.execute(statement, params)
+            await db.commit()
             
             updated_search_history = [{"search_term": record[0]} for record in cursor]
             
@@ -1018,10 +1151,10 @@ async def clear_search_history_term(request: Request):
         
 @protected_route.post("/post_message")
 async def post_message(request: Request):
-    db: p.extensions.connection = await create_connection()
-    cursor: p.extensions.cursor = db.cursor()
     data: dict = await request.json()
     sender: str = request.cookies.get("username")
+    db: AsyncConnection = await create_connection()
+    cursor: AsyncCursor = db.cursor()
     
     try:
         statement = '''
@@ -1030,8 +1163,8 @@ async def post_message(request: Request):
         '''
         params = [sender, data["recipient_user"], data["message"]]
         
-        cursor.execute(statement, params)
-        db.commit()
+        await cursor.execute(statement, params)
+        await db.commit()
             
         try:
             statement = '''
@@ -1039,8 +1172,8 @@ async def post_message(request: Request):
             '''
             params = [data["recipient_user"]]
             
-            cursor.execute(statement, params)
-            db.commit()
+            await cursor.execute(statement, params)
+            await db.commit()
                         
             try:
                 statement = '''
@@ -1049,7 +1182,7 @@ async def post_message(request: Request):
                 '''
                 params = [sender, data["recipient_user"], data["recipient_user"], sender]
 
-                cursor.execute(statement, params)
+                await cursor.execute(statement, params)
                 
                 messages = [
                     {
@@ -1074,21 +1207,21 @@ async def post_message(request: Request):
         await terminate_connection(db)
     
 @protected_route.put("/clear_notification_count")
-def clear_notification_count(request: Request):
+async def clear_notification_count(request: Request):
     username = request.query_params.get("username")
-    db: p.extensions.connection = asyncio.run(create_connection())
-    cursor: p.extensions.cursor = db.cursor()
+    db: AsyncConnection = await create_connection()
+    cursor: AsyncCursor = db.cursor()
     
     try:
         statement = "UPDATE Notifications SET notification_counter=%s WHERE username=%s"
         params = [0, username]
-        cursor.execute(statement, params)
-        db.commit()
+        await cursor.execute(statement, params)
+        await db.commit()
         
         try:
             statement = "SELECT notification_counter FROM Notifications WHERE username=%s"
             params = [username]
-            cursor.execute(statement, params)
+            await cursor.execute(statement, params)
             
             notification_count = [{"notification_counter": record[0]} for record in cursor]
             
@@ -1101,7 +1234,7 @@ def clear_notification_count(request: Request):
         return {"message": "Failed to clear notification counter."}, 500
     
     finally:
-        asyncio.run(terminate_connection(db))
+        await terminate_connection(db)
         
 @protected_route.put("/update_password")
 async def update_password(request: Request):
@@ -1109,13 +1242,13 @@ async def update_password(request: Request):
     username = request.cookies.get("username")
     new_password = context.hash(data["new_password"])
     
-    db: p.extensions.connection = await create_connection()
-    cursor: p.extensions.cursor = db.cursor()
+    db: AsyncConnection = await create_connection()
+    cursor: AsyncCursor = db.cursor()
     
     try:
         statement = "SELECT password FROM Users WHERE username=%s"
         params = [username]
-        cursor.execute(statement, params)
+        await cursor.execute(statement, params)
         
         selected_password = [{"password": record[0]} for record in cursor][0]
         
@@ -1125,8 +1258,8 @@ async def update_password(request: Request):
             try:
                 statement = "UPDATE Users SET password=%s WHERE username=%s"
                 params = [new_password, username]
-                cursor.execute(statement, params)
-                db.commit()
+                await cursor.execute(statement, params)
+                await db.commit()
                 
                 return {"message": "Password successfully updated!"}
             
@@ -1150,14 +1283,14 @@ async def delete_account(request: Request, response: Response):
     data: dict = await request.json()
     
     # Initialize the database connection and cursor.
-    db: p.extensions.connection = await create_connection()
-    cursor: p.extensions.cursor = db.cursor()
+    db: AsyncConnection = await create_connection()
+    cursor: AsyncCursor = db.cursor()
     
     try:
         # Verify password before proceeding with actual account deletion.
         statement: str = "SELECT password FROM Users WHERE username=%s"
         params: list = [username]
-        cursor.execute(statement, params)
+        await cursor.execute(statement, params)
         
         retrieved_password = [db_pwd[0] for db_pwd in cursor.fetchall()][0]
         
@@ -1166,8 +1299,14 @@ async def delete_account(request: Request, response: Response):
         if password_verified:
             statement: str = "DELETE FROM Users WHERE username=%s"
             params: list = [username]
-            cursor.execute(statement, params)
-            db.commit()
+            await cursor.execute(statement, params)
+            await db.commit()
+
+            # Drop their stored matches and cached scores. They are dropped from
+            # the interest index of every process by its next sync (see
+            # InterestIndexRegistry in models/ml_ann_index.py).
+            match_sessions.invalidate(username)
+            pair_score_cache.invalidate(username)
             
             response.set_cookie('user_session', value="", max_age=0, path="/", domain="localhost", secure=True, httponly=True, samesite='strict')
             response.set_cookie('username', value="", max_age=0, path="/", domain="localhost", secure=True, httponly=True, samesite='strict')
@@ -1186,14 +1325,16 @@ async def delete_account(request: Request, response: Response):
 @protected_route.post("/block")
 async def block(request: Request):
     data: dict = await request.json()
-    db: p.extensions.connection = await create_connection()
-    cursor: p.extensions.cursor = db.cursor()
+    block_requested: bool = data["block_requested"]
     username = request.cookies.get("username")
     
+    db: AsyncConnection = await create_connection()
+    cursor: AsyncCursor = db.cursor()
+    
     # If the user is not blocked, but the logged in user (the blocker) is intending
     # to do so, then enforce the block using the blocker's username and intended
     # blockee's username.
-    if not data["block_requested"]:
+    if not block_requested:
         try:
             statement = '''
                 SELECT B.blockee from Blocked B WHERE 
@@ -1203,7 +1344,7 @@ async def block(request: Request):
             params = [username, data["profile_user"], data["profile_user"], username]
             blocked_already = False
 
-            cursor.execute(statement, params)
+            await cursor.execute(statement, params)
             
             blocked_user_record = [blocked for blocked in cursor]
             
@@ -1220,14 +1361,14 @@ async def block(request: Request):
                 try:
                     statement = "INSERT INTO Blocked (blocker, blockee) VALUES (%s, %s)"
                     params = [username, data["profile_user"]]
-                    cursor.execute(statement, params)
-                    db.commit()
+                    await cursor.execute(statement, params)
+                    await db.commit()
                     
                     # Unfollow the user after they have been blocked.
                     statement: str = "CALL delete_chat_request(%s, %s)"
                     params: list = [username, data["profile_user"]]
-                    cursor.execute(statement, params)
-                    db.commit()
+                    await cursor.execute(statement, params)
+                    await db.commit()
                     
                     return {"message": "Blocked user."}
                     
@@ -1255,8 +1396,8 @@ async def block(request: Request):
             statement = "DELETE FROM Blocked WHERE blocker=%s AND blockee=%s"
             params = [username, data["profile_user"]]
             
-            cursor.execute(statement, params)
-            db.commit()
+            await cursor.execute(statement, params)
+            await db.commit()
             
             return {"message": "You have unblocked %s." % data["profile_user"]}
         
@@ -1280,8 +1421,8 @@ async def get_location(request: Request):
     
 @protected_route.post("/rating")
 async def rating(request: Request):
-    db: p.extensions.connection = await create_connection()
-    cursor: p.extensions.cursor = db.cursor()
+    db: AsyncConnection = await create_connection()
+    cursor: AsyncCursor = db.cursor()
     
     try:
         rating_type = request.query_params.get('rt')
@@ -1292,7 +1433,7 @@ async def rating(request: Request):
         # exist.
         statement = "SELECT rater, ratee FROM User_Rating_Labels WHERE rater=%s AND ratee=%s"
         rating_list_parameters = [logged_in_user, username]
-        cursor.execute(statement, rating_list_parameters)
+        await cursor.execute(statement, rating_list_parameters)
         
         # Access the tuple containing the username of the rater and the ratee
         rater_ratee_record = [record for record in cursor]
@@ -1304,21 +1445,21 @@ async def rating(request: Request):
         # If the list is empty, insert the record in the table.
         if not rater_ratee_record:
             # Update the ratee's rating score in the database.
-            rating = calculate_rating(cursor, username, logged_in_user, rating_type)
+            rating = await cursor.run(calculate_rating, username, logged_in_user, rating_type)
             
             # Update the rating made by the rater (the one who rates the user),
             # as well as that of the ratee (the one who was rated).
-            insert_rating(cursor, logged_in_user, username, rating_type, rating)
+            await cursor.run(insert_rating, logged_in_user, username, rating_type, rating)
             
             # Commit changes to database.
-            db.commit()
+            await db.commit()
         
         else:
             # Check to see if the user is clicking on the same rating type as the one
             # they have used to originally rate them.
             statement = "SELECT rating_type FROM User_Rating_Labels WHERE ratee=%s AND rater=%s"
             rating_list_parameters = [username, logged_in_user]
-            cursor.execute(statement, rating_list_parameters)
+            await cursor.execute(statement, rating_list_parameters)
             
             # Store the original rating type from the database into a list.
             retrieved_rate_type = [record[0] for record in cursor]
@@ -1329,16 +1470,16 @@ async def rating(request: Request):
             if rating_type in retrieved_rate_type:
                 # Delete the record of the rater's rating of the ratee
                 # and update the latter's rating score to 0.
-                delete_rating(cursor, logged_in_user, username)
+                await cursor.run(delete_rating, logged_in_user, username)
                 
                 # Commit changes to database.
-                db.commit()
+                await db.commit()
                 
                 # Update the ratee's rating score.
-                update_rating(cursor, username)
+                await cursor.run(update_rating, username)
                 
                 # Again, commit the changes to the database.
-                db.commit()
+                await db.commit()
             
             # Otherwise, change it to the new rating type that they have been given by the current user.
             else: 
@@ -1352,30 +1493,30 @@ async def rating(request: Request):
                 # once the new rating is calculated below, it can
                 # be used to subsequently replace the ratee's original 
                 # rating score.
-                delete_rating(cursor, logged_in_user, username)
-                db.commit()
-                update_rating(cursor, username)
-                db.commit()
+                await cursor.run(delete_rating, logged_in_user, username)
+                await db.commit()
+                await cursor.run(update_rating, username)
+                await db.commit()
                 
                 # Calculate the new rating score of the ratee based on how they were
                 # rated by the rater.
-                score = calculate_rating(cursor, username, logged_in_user, rating_type)
+                score = await cursor.run(calculate_rating, username, logged_in_user, rating_type)
 
                 # Insert the the new rating of the ratee,
                 # as well as other information, such as
                 # the user who rated the former, what time
                 # the rating was made, etc.
-                insert_rating(cursor, logged_in_user, username, rating_type, score)
-                db.commit()
+                await cursor.run(insert_rating, logged_in_user, username, rating_type, score)
+                await db.commit()
         
         # Retrieve the average rating of the ratee from the ratings assigned to them by
         # other users in the User_Rating_Labels table.        
-        rating = average_rating(cursor, username)
+        rating = await cursor.run(average_rating, username)
         
         # Update ratee's current rating with the average rating in the Ratings table.
         statement = "UPDATE Ratings SET rating=%s WHERE username=%s"
         rating_list_parameters = [rating, username]
-        cursor.execute(statement, rating_list_parameters)
+        await cursor.execute(statement, rating_list_parameters)
         
         # Return the updated data in JSON format.
         return {"message": "Rating successfully updated!"}
@@ -1386,40 +1527,96 @@ async def rating(request: Request):
     finally:
         await terminate_connection(db)
         
+# Reads the user's precomputed matches. Returns None if they have to be computed
+# on demand instead.
+async def read_precomputed_matches(username: str, use_so_filter: bool) -> list[dict[str, any]] | None:
+    db: AsyncConnection = await create_connection()
+    cursor: AsyncCursor = db.cursor()
+    
+    try:
+        return await cursor.run(load_precomputed_matches, username, use_so_filter, MATCH_PAGE_LIMIT)
+    
+    except p.DatabaseError as e:
+        print(f"Failed to read the precomputed matches of {username}: {e}")
+        return None
+    
+    finally:
+        await terminate_connection(db)
+
+# Loads the photos of the matches of a page (and only those) in a single query, as
+# the matches are ranked and stored in the match sessions without them. If they
+# can't be loaded, the matches are returned without them.
+async def hydrate_match_page(page: tuple[list[dict[str, any]], bool, str | None]) -> list:
+    matches, has_more, next_cursor = page
+
+    db: AsyncConnection = await create_connection()
+    cursor: AsyncCursor = db.cursor()
+
+    try:
+        matches = await cursor.run(hydrate_photos, matches)
+
+    except p.DatabaseError as e:
+        print(f"Failed to load the photos of the matches: {e}")
+
+    finally:
+        await terminate_connection(db)
+
+    return [matches, has_more, next_cursor]
+
+# Returns a page of the user's matches, along with whether there are more matches
+# to request and the cursor to request them with.
+#
+# The first request runs the matching algorithm and stores the whole ranked list
+# in a match session (see helpers/match_sessions.py). Requests that include the
+# cursor of the next page are served from the stored list without running the
+# matching algorithm again.
 @protected_route.post("/match")
-@cache(expire=30, key_builder=matches_key)
 async def match(r: Request):
     try:
         # Stores payload information sent from the client as an object variable.
         request_info: dict = await r.json()
-        db: p.extensions.connection = await create_connection()
-
-        cursor: p.extensions.cursor = db.cursor()
+        username: str = r.cookies.get("username")
+        limit: int = request_info.get("initial_limit") or MATCH_PAGE_LIMIT
+        
+        if request_info.get("cursor"):
+            session, offset = match_sessions.resolve(username, request_info["cursor"])
+            return await hydrate_match_page(session.page(offset, limit))
         
         if request_info["algo_config"]:
-            # Run matching algorithm using the list of profiles (excluding the current user) to compare with the
-            # profile of the logged in user.
-            matches: list[dict[str, any]] = run_matching_algorithm(
-                                                username=r.cookies.get("username"),
-                                                db=db,
-                                                cursor=cursor,
-                                                use_so_filter=request_info["use_so_filter"]
-                                            )
+            # Reuse the user's latest session if it has not expired yet.
+            session = match_sessions.latest(username, request_info["use_so_filter"])
             
-            # If the limit of the number of searches retrieved is less than the
-            # actual number of matched users, then let the
-            # client continue requesting for more searches by including True
-            # in the return result below.
-            if request_info["initial_limit"] <= len(matches):
-                return [matches[0:request_info["initial_limit"]], True]
+            # Otherwise, serve the matches precomputed by the batch recommendation job,
+            # unless the user changed their profile since they were computed.
+            if session is None:
+                matches: list[dict[str, any]] | None = await read_precomputed_matches(username, request_info["use_so_filter"])
+                
+                if matches is not None:
+                    session = match_sessions.create(username, request_info["use_so_filter"], matches)
             
-            # Otherwise, if the limit of the number of searches is equal to the
-            # length of the number of matched users, then let the client know
-            # that no more searches will be requested as there are no more
-            # matching profiles to request.
-            else:
-                return [matches[0:request_info["initial_limit"]], False]
-        
+            if session is None:
+                # Run matching algorithm using the list of profiles (excluding the current user) to compare with the
+                # profile of the logged in user in one of the matching workers, so that the event loop
+                # keeps serving other requests in the meantime.
+                matches: list[dict[str, any]] = await match_executor.submit(
+                                                    run_match_in_worker,
+                                                    username,
+                                                    request_info["use_so_filter"],
+                                                    MATCH_SESSION_MAX_RESULTS
+                                                )
+                
+                session = match_sessions.create(username, request_info["use_so_filter"], matches)
+            
+            # If there are more matches than the ones in the first page, then let the
+            # client continue requesting for more of them with the returned cursor.
+            return await hydrate_match_page(session.page(0, limit))
+    
+    except InvalidCursorError as e:
+        raise HTTPException(410, {"message": str(e)})
+    
+    except (MatchQueueFullError, PoolTimeoutError) as e:
+        raise HTTPException(503, {"message": str(e)})
+
     except KeyError as k:
         print(k)
         raise HTTPException(500, {"message": "Failed to retrieve information from dictionary."})
@@ -1,4 +1,7 @@
-from server import server
+from server import server, check_token
+from fastapi import HTTPException
+from helpers.db_async import AsyncConnection
+from unittest.mock import patch
 from fastapi.testclient import TestClient
 from dotenv import load_dotenv
 import os
@@ -620,5 +623,87 @@ class TestChatRequestOps(unittest.TestCase):
         delete_dummy_user(self.dummy_user_2, self.db_inst.db, self.db_inst.cursor)
         self.db_inst.db.close()
 
+class MockDatabase:
+    def cursor(self) -> "MockDatabase":
+        return self
+
+    def execute(self, statement: str, params: list | None = None) -> None:
+        pass
+
+    def commit(self) -> None:
+        pass
+
+async def mock_create_connection() -> AsyncConnection:
+    return AsyncConnection(MockDatabase())
+
+async def mock_terminate_connection(db: AsyncConnection):
+    pass
+
+class TestRateLimitedRoutes(unittest.TestCase):
+    def setUp(self):
+        server.dependency_overrides[check_token] = lambda: True
+
+        self.patches = [patch("server.create_connection", mock_create_connection),
+                        patch("server.terminate_connection", mock_terminate_connection)]
+
+        for p in self.patches:
+            p.start()
+
+        self.client = TestClient(server)
+        self.client.cookies.set("username", f_user()[3])
+
+    # The key functions of the rate limiter read the body of the request, which
+    # should not fail on async routes.
+    def test_rate_limited_routes(self):
+        visit_req = self.client.post('/visit', json={"visiting_user": f_user()[3]})
+        chat_req = self.client.post('/privacy/make_chat_request', json={"requestee": f_user()[3]})
+
+        self.assertEqual(visit_req.status_code, 200)
+        self.assertEqual(chat_req.status_code, 200)
+
+    def tearDown(self):
+        for p in self.patches:
+            p.stop()
+
+        server.dependency_overrides.pop(check_token)
+
+# Connections drawn by the routes that were not handed back yet.
+open_connections: list[AsyncConnection] = []
+
+async def mock_counted_connection() -> AsyncConnection:
+    db = AsyncConnection(MockDatabase())
+    open_connections.append(db)
+    return db
+
+async def mock_counted_termination(db: AsyncConnection):
+    open_connections.remove(db)
+
+async def mock_pool_timeout() -> AsyncConnection:
+    raise HTTPException(503, {"message": "Timed out waiting for a database connection. Try again later."})
+
+class TestConnectionRelease(unittest.TestCase):
+    def setUp(self):
+        open_connections.clear()
+        self.client = TestClient(server)
+
+    # Underage users should not hold on to a connection of the pool.
+    def test_underage_signup(self):
+        user_info = {"username": f_user()[3], "password": "password", "age": 17, "state": "Texas",
+                     "height_feet": "5", "height_inches": "10"}
+
+        with patch("server.create_connection", mock_counted_connection), patch("server.terminate_connection", mock_counted_termination):
+            signup_response = self.client.post('/signup', json=user_info)
+
+        self.assertEqual(signup_response.status_code, 403)
+        self.assertEqual(open_connections, [])
+
+    # Requests should be told to try again later once the pool runs out of
+    # connections.
+    def test_pool_timeout(self):
+        with patch("server.create_connection", mock_pool_timeout):
+            login_response = self.client.post('/login', data={"username": f_user()[3], "password": "password"})
+
+        self.assertEqual(login_response.status_code, 503)
+
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,53 @@
+-- Candidates of a user along with the user themselves, in a single round trip
+-- (see load_match_candidates in models/ml_candidates.py).
+--
+-- Replaces the separate calls to retrieve_possible_matches, get_user_profiles,
+-- and get_logged_in_user made by the matching algorithm, and only returns the
+-- columns it uses. The photos of the candidates are left out, as they are only
+-- loaded for the matches returned to the user.
+--
+-- The user's own row comes first (with is_viewer set), followed by their
+-- candidates in the same order as retrieve_possible_matches returns them.
+CREATE OR REPLACE FUNCTION get_match_candidates(viewer Users.username%TYPE)
+RETURNS TABLE (
+    position BIGINT,
+    is_viewer BOOLEAN,
+    username Profiles.username%TYPE,
+    first_name Profiles.first_name%TYPE,
+    middle_name Profiles.middle_name%TYPE,
+    last_name Profiles.last_name%TYPE,
+    interests Profiles.interests%TYPE,
+    height Profiles.height%TYPE,
+    gender Profiles.gender%TYPE,
+    sexual_orientation Profiles.sexual_orientation%TYPE,
+    interested_in Profiles.interested_in%TYPE,
+    state_residence Profiles.state_residence%TYPE,
+    city_residence Profiles.city_residence%TYPE,
+    relationship_status Profiles.relationship_status%TYPE,
+    birth_month Users.birth_month%TYPE,
+    birth_date Users.birth_date%TYPE,
+    birth_year Users.birth_year%TYPE,
+    rating Ratings.rating%TYPE,
+    visits DOUBLE PRECISION,
+    height_inches Profiles.height_inches%TYPE
+) AS $$
+    SELECT 0::BIGINT, TRUE, U.username, U.first_name, U.middle_name, U.last_name,
+    U.interests, U.height, U.gender, U.sexual_orientation, U.interested_in,
+    U.state_residence, U.city_residence, U.relationship_status,
+    NULL, NULL, NULL, NULL, 0::DOUBLE PRECISION, P.height_inches
+    FROM get_logged_in_user(viewer) U
+    LEFT JOIN Profiles P ON P.username = U.username
+
+    UNION ALL
+
+    SELECT M.ordinality, FALSE, M.username, M.first_name, M.middle_name,
+    M.last_name, M.interests, M.height, M.gender, M.sexual_orientation,
+    M.interested_in, M.state_residence, M.city_residence, M.relationship_status,
+    G.birth_month, G.birth_date, G.birth_year, G.rating, M.visits::DOUBLE PRECISION, P.height_inches
+    FROM retrieve_possible_matches(viewer) WITH ORDINALITY AS M
+    LEFT JOIN get_user_profiles(viewer) G ON G.username = M.username
+    LEFT JOIN Profiles P ON P.username = M.username
+    WHERE M.username <> viewer
+
+    ORDER BY 1
+$$ LANGUAGE SQL STABLE;
@@ -0,0 +1,17 @@
+-- Ranked match lists written by the batch recommendation job (see
+-- models/ml_precomputed_matches.py) and served by /match.
+--
+-- Each user has one list per setting of the sexual orientation filter. A
+-- list is considered stale once the row in User_Features of the user (or of
+-- one of their top matches) was rebuilt after it was computed, or once it is
+-- too old, in which case /match recomputes the user's matches.
+CREATE TABLE IF NOT EXISTS Precomputed_Matches (
+    username VARCHAR NOT NULL REFERENCES Users(username) ON UPDATE CASCADE ON DELETE CASCADE,
+    use_so_filter BOOLEAN NOT NULL,
+    rank INTEGER NOT NULL,
+    match_username VARCHAR NOT NULL REFERENCES Users(username) ON UPDATE CASCADE ON DELETE CASCADE,
+    -- Score predicted by the matching model, as a percentage.
+    score REAL NOT NULL,
+    computed_at TIMESTAMP NOT NULL DEFAULT now(),
+    PRIMARY KEY (username, use_so_filter, rank)
+);
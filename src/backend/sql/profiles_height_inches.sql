@@ -0,0 +1,13 @@
+-- Stores the height of every profile as an integer number of inches next to
+-- its text form (e.g. 5'9''), so that the matching algorithm doesn't have to
+-- parse it, and so that profiles can be filtered by a range of heights.
+--
+-- The column is written by /signup and /update_profile/height.
+ALTER TABLE Profiles ADD COLUMN IF NOT EXISTS height_inches SMALLINT;
+
+-- Backfill the heights of the existing profiles.
+UPDATE Profiles
+SET height_inches = (split_part(height, '''', 1)::SMALLINT * 12) + split_part(height, '''', 2)::SMALLINT
+WHERE height_inches IS NULL AND height ~ '^[0-9]+''[0-9]+';
+
+CREATE INDEX IF NOT EXISTS profiles_height_inches_idx ON Profiles (height_inches);
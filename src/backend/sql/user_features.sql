@@ -0,0 +1,60 @@
+-- Feature store used by the matching algorithm (see models/ml_feature_store.py).
+--
+-- Each user has one precomputed feature row, which is rebuilt whenever they
+-- sign up or update one of the attributes used by the matching algorithm.
+CREATE TABLE IF NOT EXISTS User_Features (
+    username VARCHAR PRIMARY KEY REFERENCES Users(username) ON UPDATE CASCADE ON DELETE CASCADE,
+    -- Fingerprint of the fitted vectorizers the features were built with.
+    feature_space_id VARCHAR(40) NOT NULL,
+    height_inches SMALLINT NOT NULL,
+    -- int32 column indices followed by the float64 values of the sparse
+    -- feature row.
+    features BYTEA NOT NULL,
+    -- Bumped every time the row is rebuilt.
+    version INTEGER NOT NULL DEFAULT 1,
+    updated_at TIMESTAMP NOT NULL DEFAULT now(),
+    -- Id of the transaction that last wrote the row, which the interest index
+    -- is synced on (see InterestIndexRegistry in models/ml_ann_index.py). Set by
+    -- the user_feature_changes trigger below.
+    change_txid BIGINT NOT NULL DEFAULT txid_current()
+);
+
+ALTER TABLE User_Features ADD COLUMN IF NOT EXISTS change_txid BIGINT NOT NULL DEFAULT txid_current();
+
+CREATE INDEX IF NOT EXISTS user_features_change_txid_idx ON User_Features (change_txid);
+
+-- Users whose feature row was deleted (e.g. along with their account) or
+-- renamed, so that the interest index can drop them as well.
+CREATE TABLE IF NOT EXISTS User_Feature_Deletions (
+    username VARCHAR PRIMARY KEY,
+    change_txid BIGINT NOT NULL DEFAULT txid_current()
+);
+
+CREATE INDEX IF NOT EXISTS user_feature_deletions_change_txid_idx ON User_Feature_Deletions (change_txid);
+
+CREATE OR REPLACE FUNCTION record_user_feature_change() RETURNS TRIGGER AS $$
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        INSERT INTO User_Feature_Deletions (username, change_txid)
+        VALUES (OLD.username, txid_current())
+        ON CONFLICT (username) DO UPDATE SET change_txid = EXCLUDED.change_txid;
+
+        RETURN OLD;
+    END IF;
+
+    IF NEW.username <> OLD.username THEN
+        INSERT INTO User_Feature_Deletions (username, change_txid)
+        VALUES (OLD.username, txid_current())
+        ON CONFLICT (username) DO UPDATE SET change_txid = EXCLUDED.change_txid;
+    END IF;
+
+    NEW.change_txid := txid_current();
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS user_feature_changes ON User_Features;
+
+CREATE TRIGGER user_feature_changes
+BEFORE UPDATE OR DELETE ON User_Features
+FOR EACH ROW EXECUTE FUNCTION record_user_feature_change();